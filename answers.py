@@ -0,0 +1,122 @@
+"""
+Matching of open-ended captcha answers.
+
+Answers and replies are normalized the same way: NFKC, Unicode casefolding,
+punctuation and whitespace collapsed to single spaces, and English number
+words turned into digits, so "Four", "4", " four! " and "٤" all match the
+answer "4". The correct answers of a captcha are compiled once into an
+AnswerMatcher holding their normalized forms, which compile_answers() caches
+by the stored answer string; matching a reply is then one set probe. An
+optional edit distance tolerates typos in answers that are words.
+"""
+import re
+import unicodedata
+from functools import lru_cache
+
+_TOKEN = re.compile(r'-?\d+(?:\.\d+)?|[^\W_]+')
+
+_UNITS = {word: value for value, word in enumerate(
+    "zero one two three four five six seven eight nine ten eleven twelve thirteen fourteen fifteen "
+    "sixteen seventeen eighteen nineteen".split())}
+_TENS = {word: value * 10 for value, word in enumerate("twenty thirty forty fifty sixty seventy eighty ninety".split(), start=2)}
+_SCALES = {'hundred': 100, 'thousand': 1000, 'million': 1000000}
+
+
+def _is_number_word(token):
+    return token in _UNITS or token in _TENS or token in _SCALES
+
+
+def _number_values(words):
+    """
+    Numbers spelled by a run of number words: ['two', 'hundred', 'and', 'five'] is [205],
+    while words that cannot continue a number start the next one: ['one', 'two'] is [1, 2].
+    """
+    values = []
+    total = current = 0
+    last = None  # 'tens' or 'unit' when the lowest digits of the current number are already spelled
+    for word in words:
+        if word == 'and':
+            continue
+        # A unit may follow tens ("twenty four"), anything else that repeats a position starts a new number
+        continues = last is None or (last == 'tens' and word in _UNITS and _UNITS[word] < 10) or word in _SCALES
+        if not continues:
+            values.append(total + current)
+            total = current = 0
+        if word in _UNITS:
+            current += _UNITS[word]
+            last = 'unit'
+        elif word in _TENS:
+            current += _TENS[word]
+            last = 'tens'
+        elif word == 'hundred':
+            current = (current or 1) * 100
+            last = None
+        else:
+            total += (current or 1) * _SCALES[word]
+            current = 0
+            last = None
+    values.append(total + current)
+    return values
+
+
+def normalize(text):
+    """Canonical form of an answer or a reply."""
+    tokens = _TOKEN.findall(unicodedata.normalize('NFKC', text).casefold())
+    normalized = []
+    run = []
+    for token in tokens + [None]:
+        # "and" only belongs to a number after a scale word ("one hundred and five")
+        if token is not None and (_is_number_word(token) or (token == 'and' and run and run[-1] in _SCALES)):
+            run.append(token)
+            continue
+        if run:
+            trailing_and = run[-1] == 'and'
+            if trailing_and:
+                run.pop()
+            normalized.extend(str(value) for value in _number_values(run))
+            if trailing_and:
+                normalized.append('and')
+            run = []
+        if token is not None:
+            # isdigit() also accepts digits int() rejects, such as the Ethiopic "፩"
+            if token.lstrip('-').isdecimal():
+                token = str(int(token))
+            normalized.append(token)
+    return ' '.join(normalized)
+
+
+def _within_distance(a, b, limit):
+    """Whether the Levenshtein distance of a and b is at most `limit`, stopping early once it is exceeded."""
+    if abs(len(a) - len(b)) > limit:
+        return False
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, start=1):
+        current = [i]
+        for j, char_b in enumerate(b, start=1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        if min(current) > limit:
+            return False
+        previous = current
+    return previous[-1] <= limit
+
+
+class AnswerMatcher:
+    def __init__(self, answers, max_distance=0):
+        """`answers` are the correct answers as entered; the ones that normalize to nothing are ignored."""
+        self.answers = frozenset(filter(None, (normalize(answer) for answer in answers)))
+        self.max_distance = max_distance
+        # Numbers must match exactly, and short words would accept too many other words
+        self._fuzzy = tuple(answer for answer in self.answers
+                            if not any(char.isdigit() for char in answer) and len(answer) > 3 * max_distance) if max_distance else ()
+
+    def matches(self, reply):
+        normalized = normalize(reply)
+        if normalized in self.answers:
+            return True
+        return any(_within_distance(normalized, answer, self.max_distance) for answer in self._fuzzy)
+
+
+@lru_cache(maxsize=4096)
+def compile_answers(answers, max_distance=0):
+    """Return the cached AnswerMatcher of a comma-separated answer string as stored in the database."""
+    return AnswerMatcher(answers.split(','), max_distance)
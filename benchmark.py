@@ -0,0 +1,619 @@
+"""
+Load benchmark of the captcha flow.
+
+Drives handle_new_member, check_captcha_answer, button_callback and kick_user
+with synthetic update streams against a fake Bot API and an in-memory stand-in
+of the database (--storage memory) or the SQLite backend (--storage sqlite),
+and reports throughput, p50/p99 latency and the number of
+Bot API and database calls per scenario:
+
+    chatter  ordinary messages from users without a captcha (filtered like in main())
+    raid     a join raid of --users members, one join update each
+    answers  open-ended answers to pending captchas, --correct-ratio of them right
+    buttons  multiple-choice button presses, --correct-ratio of them right
+    kicks    deadlines of unanswered captchas expiring
+    neighbours  answers in other chats while one chat is raided
+
+Like the bot, the runs use the configured rate limits and deletion window
+unless --no-rate-limits or --delete-window say otherwise.
+
+    python3 benchmark.py --users 2000 --json results.json
+    python3 benchmark.py --users 2000 --baseline results.json
+
+With --baseline, the run fails when a scenario's p99 latency grows by more
+than --tolerance (and more than --min-delta ms) or when it makes more Bot API
+or database calls than the baseline did. --api-latency and --db-latency add a delay in ms to every call.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+os.environ.setdefault('LOG_FILE', os.devnull)
+
+from telegram import Chat, Message, Update
+from telegram.ext import filters
+
+import captcha_bot
+from caches import PendingCaptchaIndex, SettingsCache
+from deadlines import DeadlineScheduler
+from outbound import DeletionBatcher, OutboundScheduler
+from sqlite_database import SQLiteDatabase
+from storage import Storage
+from update_filters import PendingChallengeFilter
+
+OPEN_CAPTCHA = {'mode': 'open', 'question': "What is 2+2?", 'answers': "4,four"}
+MULTIPLE_CAPTCHA = {'mode': 'multiple', 'question': "What is 2+2?", 'answers': "4,3,5,22"}
+# Sender of the captcha messages the buttons are attached to
+BOT_USER_ID = 1
+
+
+class FakeBot:
+    """Records Bot API calls and answers them after `latency` seconds."""
+
+    defaults = None
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.calls = Counter()
+        self._message_ids = itertools.count(1_000_000)
+
+    async def _call(self, method):
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def _message(self, chat_id, text=None, message_id=None, reply_markup=None):
+        return Message(
+            message_id=message_id or next(self._message_ids),
+            date=datetime.now(timezone.utc),
+            chat=Chat(id=chat_id, type=Chat.SUPERGROUP),
+            text=text,
+            reply_markup=reply_markup
+        )
+
+    async def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+        await self._call('send_message')
+        return self._message(chat_id, text, reply_markup=reply_markup)
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, reply_markup=None, **kwargs):
+        await self._call('edit_message_text')
+        return self._message(chat_id, text, message_id=message_id, reply_markup=reply_markup)
+
+    async def answer_callback_query(self, callback_query_id, **kwargs):
+        await self._call('answer_callback_query')
+        return True
+
+    async def delete_message(self, chat_id, message_id, **kwargs):
+        await self._call('delete_message')
+        return True
+
+    async def delete_messages(self, chat_id, message_ids, **kwargs):
+        await self._call('delete_messages')
+        return True
+
+    async def ban_chat_member(self, chat_id, user_id, **kwargs):
+        await self._call('ban_chat_member')
+        return True
+
+    async def unban_chat_member(self, chat_id, user_id, **kwargs):
+        await self._call('unban_chat_member')
+        return True
+
+
+class MemoryStorage(Storage):
+    """Storage kept in dicts, the stand-in for a database with no query cost of its own."""
+
+    def __init__(self):
+        self.settings = {}
+        self.captchas = {}
+        self.pending = {}  # (chat_id, user_id) -> row
+        self.statistics = []
+        self.leases = {}  # name -> (holder, monotonic expiry)
+
+    async def migrate(self):
+        return []
+
+    async def ping(self):
+        pass
+
+    def stats(self):
+        return {'backend': 'memory'}
+
+    def close(self):
+        pass
+
+    async def get_chat_settings(self, chat_id):
+        return dict(self.settings[chat_id]) if chat_id in self.settings else None
+
+    async def set_chat_setting(self, chat_id, column, value):
+        self.settings.setdefault(chat_id, {'chat_id': chat_id, 'timeout': 60, 'attempt_limit': 3, 'welcome_message': None,
+                                           'strict_mode': False, 'welcome_timeout': 10})[column] = value
+
+    async def get_chat_ids(self):
+        return list(self.settings)
+
+    async def get_captcha(self, chat_id):
+        return dict(self.captchas[chat_id]) if chat_id in self.captchas else None
+
+    async def set_captcha(self, chat_id, mode, question, answers):
+        self.captchas[chat_id] = {'chat_id': chat_id, 'mode': mode, 'question': question, 'answers': answers}
+
+    async def get_pending_captcha(self, chat_id, user_id):
+        row = self.pending.get((chat_id, user_id))
+        return dict(row) if row else None
+
+    async def add_pending_captchas(self, captchas):
+        now = datetime.now()
+        for user_id, chat_id, correct_answers, captcha_message_id, messages_to_delete, question, user_name, timeout in captchas:
+            self.pending[(chat_id, user_id)] = {
+                'chat_id': chat_id, 'user_id': user_id, 'correct_answers': ','.join(correct_answers),
+                'captcha_message_id': captcha_message_id, 'messages_to_delete': json.dumps(messages_to_delete),
+                'question': question, 'attempts': 0, 'user_name': user_name,
+                'created_at': now, 'expires_at': now + timedelta(seconds=timeout)
+            }
+
+    async def update_pending_captcha(self, chat_id, user_id, attempts, messages_to_delete=None):
+        row = self.pending.get((chat_id, user_id))
+        if row:
+            row['attempts'] = attempts
+            if messages_to_delete is not None:
+                row['messages_to_delete'] = json.dumps(messages_to_delete)
+
+    async def delete_pending_captcha(self, chat_id, user_id):
+        self.pending.pop((chat_id, user_id), None)
+
+    async def get_stale_pending_captchas(self, created_before, limit, after=None):
+        keys = sorted(key for key, row in self.pending.items() if row['created_at'] < created_before and (after is None or key > after))
+        return keys[:limit]
+
+    async def delete_pending_captchas(self, keys):
+        for key in keys:
+            self.pending.pop(tuple(key), None)
+
+    async def get_pending_deadlines(self):
+        now = datetime.now()
+        return [{'chat_id': row['chat_id'], 'user_id': row['user_id'], 'user_name': row['user_name'],
+                 'captcha_message_id': row['captcha_message_id'], 'remaining': int((row['expires_at'] - now).total_seconds())}
+                for row in self.pending.values()]
+
+    async def get_expired_pending_captchas(self, min_age, max_age):
+        now = datetime.now()
+        return [{'chat_id': row['chat_id'], 'user_id': row['user_id'], 'user_name': row['user_name'],
+                 'captcha_message_id': row['captcha_message_id']}
+                for row in self.pending.values()
+                if now - timedelta(seconds=max_age) < row['expires_at'] <= now - timedelta(seconds=min_age)]
+
+    async def get_pending_captcha_keys(self):
+        return list(self.pending)
+
+    async def acquire_lease(self, name, holder, ttl):
+        current = self.leases.get(name)
+        if current is None or current[0] == holder or current[1] <= time.monotonic():
+            self.leases[name] = (holder, time.monotonic() + ttl)
+        return self.leases[name][0] == holder
+
+    async def release_lease(self, name, holder):
+        if self.leases.get(name, (None,))[0] == holder:
+            del self.leases[name]
+
+    async def add_group_statistics(self, rows):
+        self.statistics.extend(rows)
+
+
+class CountedStorage:
+    """Wraps a storage backend, counting its method calls and delaying each by `latency` seconds."""
+
+    def __init__(self, storage, latency=0.0):
+        self._storage = storage
+        self.latency = latency
+        self.calls = Counter()
+
+    def __getattr__(self, name):
+        attribute = getattr(self._storage, name)
+        if not asyncio.iscoroutinefunction(attribute):
+            return attribute
+
+        async def call(*args, **kwargs):
+            self.calls[name] += 1
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            return await attribute(*args, **kwargs)
+        return call
+
+
+class FakeJob:
+    def __init__(self, callback, data, name):
+        self.callback = callback
+        self.data = data
+        self.name = name
+        self.removed = False
+
+    def schedule_removal(self):
+        self.removed = True
+
+
+class FakeJobQueue:
+    """Collects run_once() jobs; the benchmark decides when they run."""
+
+    def __init__(self):
+        self.jobs = []
+
+    def run_once(self, callback, when, data=None, name=None):
+        job = FakeJob(callback, data, name)
+        self.jobs.append(job)
+        return job
+
+    def run_repeating(self, callback, interval, first=None, name=None):
+        job = FakeJob(callback, None, name)
+        self.jobs.append(job)
+        return job
+
+    def take(self, prefix):
+        """Remove and return the live jobs whose name starts with `prefix`."""
+        taken = [job for job in self.jobs if not job.removed and job.name and job.name.startswith(prefix)]
+        self.jobs = [job for job in self.jobs if job not in taken and not job.removed]
+        return taken
+
+
+class FakeApplication:
+    """Keeps the tasks handlers start with create_task(), so the benchmark can wait for them."""
+
+    def __init__(self):
+        self.tasks = set()
+
+    def create_task(self, coroutine, update=None, name=None):
+        task = asyncio.get_running_loop().create_task(coroutine, name=name)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    async def wait(self):
+        while self.tasks:
+            await asyncio.gather(*self.tasks)
+
+
+class FakeContext:
+    def __init__(self, bot, job_queue, application, job=None):
+        self.bot = bot
+        self.job_queue = job_queue
+        self.application = application
+        self.job = job
+        self.args = []
+
+
+class Harness:
+    """Points the bot module's globals at fakes, so handlers run exactly as in production."""
+
+    def __init__(self, args):
+        self.args = args
+        self.bot = FakeBot(args.api_latency / 1000)
+        backend = SQLiteDatabase(':memory:') if args.storage == 'sqlite' else MemoryStorage()
+        self.storage = CountedStorage(backend, args.db_latency / 1000)
+        self.job_queue = FakeJobQueue()
+        self.application = FakeApplication()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._user_ids = itertools.count(10_000)
+        self.chat_ids = [-1_000_000_000_000 - i for i in range(args.chats)]
+
+        captcha_bot.db = self.storage
+        captcha_bot.settings_cache = SettingsCache(self.storage)
+        captcha_bot.pending_index = PendingCaptchaIndex()
+        if args.rate_limits:
+            captcha_bot.outbound = OutboundScheduler(global_rate=captcha_bot.OUTBOUND_GLOBAL_RATE,
+                                                     chat_rate_per_minute=captcha_bot.OUTBOUND_CHAT_RATE)
+        else:
+            captcha_bot.outbound = OutboundScheduler(global_rate=10 ** 9, chat_rate_per_minute=10 ** 9, max_in_flight=10 ** 6)
+        captcha_bot.deleter = DeletionBatcher(captcha_bot.outbound, window=args.delete_window)
+        captcha_bot.deadlines = DeadlineScheduler()
+        captcha_bot.deadlines.bind(self.job_queue, captcha_bot.kick_user)
+
+        # The same chain of filters main() registers check_captcha_answer with
+        self.answer_filter = (filters.UpdateType.MESSAGE & filters.TEXT & ~filters.COMMAND
+                              & PendingChallengeFilter(captcha_bot.pending_index))
+
+    async def setup(self):
+        await self.storage.migrate()
+        for chat_id in self.chat_ids:
+            await self.storage.set_chat_setting(chat_id, 'welcome_message', "Welcome!")
+            await self.storage.set_captcha(chat_id, **OPEN_CAPTCHA)
+
+    def context(self, job=None):
+        return FakeContext(self.bot, self.job_queue, self.application, job)
+
+    def _user(self, user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}"}
+
+    def _message(self, chat_id, user_id, **fields):
+        return {'message_id': next(self._message_ids), 'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'supergroup'}, 'from': self._user(user_id), **fields}
+
+    def message_update(self, chat_id, user_id, text):
+        return Update.de_json({'update_id': next(self._update_ids), 'message': self._message(chat_id, user_id, text=text)}, self.bot)
+
+    def join_update(self, chat_id, user_ids):
+        message = self._message(chat_id, user_ids[0], new_chat_members=[self._user(user_id) for user_id in user_ids])
+        return Update.de_json({'update_id': next(self._update_ids), 'message': message}, self.bot)
+
+    def callback_update(self, chat_id, user_id, captcha_message_id, data):
+        message = self._message(chat_id, BOT_USER_ID, message_id=captcha_message_id, text="captcha")
+        return Update.de_json({'update_id': next(self._update_ids), 'callback_query': {
+            'id': str(next(self._update_ids)), 'from': self._user(user_id), 'chat_instance': str(chat_id),
+            'data': data, 'message': message
+        }}, self.bot)
+
+    def new_user_ids(self, count):
+        return [next(self._user_ids) for _ in range(count)]
+
+    def reset_counters(self):
+        self.bot.calls.clear()
+        self.storage.calls.clear()
+
+    async def raid(self, user_ids, chat_ids=None):
+        """Challenge `user_ids` spread over `chat_ids` (all chats by default), outside of any measurement."""
+        chat_ids = chat_ids or self.chat_ids
+        # Without rate limits, so the setup neither takes minutes nor uses up the tokens of the measured scheduler
+        outbound, deleter = captcha_bot.outbound, captcha_bot.deleter
+        captcha_bot.outbound = OutboundScheduler(global_rate=10 ** 9, chat_rate_per_minute=10 ** 9, max_in_flight=10 ** 6)
+        captcha_bot.deleter = DeletionBatcher(captcha_bot.outbound, window=0)
+        try:
+            for i, user_id in enumerate(user_ids):
+                chat_id = chat_ids[i % len(chat_ids)]
+                await captcha_bot.handle_new_member(self.join_update(chat_id, [user_id]), self.context())
+            await self.application.wait()
+            # Send the queued deletions now, so they are not counted in the measurement
+            await captcha_bot.deleter.stop()
+        finally:
+            await captcha_bot.outbound.stop()
+            captcha_bot.outbound, captcha_bot.deleter = outbound, deleter
+
+
+async def measure(harness, operations, concurrency):
+    """Run the `operations` (coroutine functions) with at most `concurrency` at once; return their latencies."""
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def run(operation):
+        async with semaphore:
+            started = time.perf_counter()
+            await operation()
+            latencies.append(time.perf_counter() - started)
+
+    harness.reset_counters()
+    started = time.perf_counter()
+    await asyncio.gather(*(run(operation) for operation in operations))
+    # Captchas are sent in tasks the handlers start
+    await harness.application.wait()
+    # Let batched deletions that were queued by the handlers reach the fake API
+    await asyncio.sleep(harness.args.delete_window)
+    return latencies, time.perf_counter() - started
+
+
+async def scenario_chatter(harness):
+    args = harness.args
+    await harness.raid(harness.new_user_ids(args.chats))  # A few pending captchas, like in a live group
+    speakers = harness.new_user_ids(max(args.users // 10, 1))
+    updates = [harness.message_update(random.choice(harness.chat_ids), random.choice(speakers), "hello there")
+               for _ in range(args.messages)]
+
+    async def dispatch(update):
+        # Mirrors the dispatcher: the handler only runs when its filters pass
+        if harness.answer_filter.check_update(update):
+            await captcha_bot.check_captcha_answer(update, harness.context())
+
+    return await measure(harness, [lambda update=update: dispatch(update) for update in updates], args.concurrency)
+
+
+async def scenario_raid(harness):
+    args = harness.args
+    operations = []
+    for i, user_id in enumerate(harness.new_user_ids(args.users)):
+        update = harness.join_update(harness.chat_ids[i % len(harness.chat_ids)], [user_id])
+        operations.append(lambda update=update: captcha_bot.handle_new_member(update, harness.context()))
+    return await measure(harness, operations, args.concurrency)
+
+
+async def scenario_answers(harness):
+    args = harness.args
+    user_ids = harness.new_user_ids(args.users)
+    await harness.raid(user_ids)
+    operations = []
+    for i, user_id in enumerate(user_ids):
+        text = "four" if random.random() < args.correct_ratio else "five"
+        update = harness.message_update(harness.chat_ids[i % len(harness.chat_ids)], user_id, text)
+        operations.append(lambda update=update: captcha_bot.check_captcha_answer(update, harness.context()))
+    return await measure(harness, operations, args.concurrency)
+
+
+async def scenario_buttons(harness):
+    args = harness.args
+    for chat_id in harness.chat_ids:
+        await captcha_bot.settings_cache.set_captcha(chat_id, **MULTIPLE_CAPTCHA)
+    user_ids = harness.new_user_ids(args.users)
+    await harness.raid(user_ids)
+    operations = []
+    for i, user_id in enumerate(user_ids):
+        chat_id = harness.chat_ids[i % len(harness.chat_ids)]
+        row = await harness.storage.get_pending_captcha(chat_id, user_id)
+        correct = random.random() < args.correct_ratio
+        # The token of the correct option or of a wrong one, as build_captcha() signs them
+        data = captcha_bot.callback_signer.sign(chat_id, user_id, 0 if correct else 1, time.time() + 60, correct)
+        update = harness.callback_update(chat_id, user_id, row['captcha_message_id'], data)
+        operations.append(lambda update=update: captcha_bot.button_callback(update, harness.context()))
+    return await measure(harness, operations, args.concurrency)
+
+
+async def scenario_neighbours(harness):
+    """
+    Answers in the other chats while the first chat is raided by --raid-users
+    members, one join update each. Updates arrive every --arrival-interval ms
+    and are handled in arrival order by --concurrency dispatchers, like the
+    Application's update queue; the latency of an answer is counted from its
+    arrival, and the raid's own updates are not counted.
+    """
+    args = harness.args
+    if len(harness.chat_ids) < 2:
+        raise SystemExit("The neighbours scenario needs --chats 2 or more")
+    raided, others = harness.chat_ids[0], harness.chat_ids[1:]
+    answerers = harness.new_user_ids(args.raid_users)
+    await harness.raid(answerers, others)
+    updates = []
+    for i, (raider, answerer) in enumerate(zip(harness.new_user_ids(args.raid_users), answerers)):
+        updates.append((captcha_bot.handle_new_member, harness.join_update(raided, [raider]), False))
+        updates.append((captcha_bot.check_captcha_answer, harness.message_update(others[i % len(others)], answerer, "four"), True))
+
+    queue = asyncio.Queue()
+    latencies = []
+
+    async def dispatcher():
+        while True:
+            handler, update, counted, arrived = await queue.get()
+            await handler(update, harness.context())
+            if counted:
+                latencies.append(time.perf_counter() - arrived)
+            queue.task_done()
+
+    harness.reset_counters()
+    started = time.perf_counter()
+    dispatchers = [asyncio.get_running_loop().create_task(dispatcher()) for _ in range(args.concurrency)]
+    for handler, update, counted in updates:
+        queue.put_nowait((handler, update, counted, time.perf_counter()))
+        await asyncio.sleep(args.arrival_interval / 1000)
+    await queue.join()
+    for task in dispatchers:
+        task.cancel()
+    # The raided chat's captchas go out at its rate limit
+    await harness.application.wait()
+    await asyncio.sleep(args.delete_window)
+    return latencies, time.perf_counter() - started
+
+
+async def scenario_kicks(harness):
+    args = harness.args
+    await harness.raid(harness.new_user_ids(args.users))
+    # Expire every deadline at once, as if the timeout had passed
+    expired = captcha_bot.deadlines.pop_expired(time.monotonic() + 86400)
+    return await measure(harness, [lambda deadline=deadline: captcha_bot.kick_user(harness.context(), *deadline)
+                                   for deadline in expired], args.concurrency)
+
+
+SCENARIOS = {
+    'chatter': scenario_chatter,
+    'raid': scenario_raid,
+    'answers': scenario_answers,
+    'buttons': scenario_buttons,
+    'kicks': scenario_kicks,
+    'neighbours': scenario_neighbours,
+}
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))] if sorted_values else 0.0
+
+
+async def run_scenario(name, args):
+    random.seed(args.seed)
+    harness = Harness(args)
+    try:
+        await harness.setup()
+        latencies, elapsed = await SCENARIOS[name](harness)
+    finally:
+        await captcha_bot.outbound.stop()
+        harness.storage.close()
+    latencies.sort()
+    return {
+        'operations': len(latencies),
+        'elapsed': elapsed,
+        'throughput': len(latencies) / elapsed if elapsed else 0.0,
+        'p50_ms': statistics.median(latencies) * 1000 if latencies else 0.0,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'api_calls': dict(harness.bot.calls),
+        'db_calls': dict(harness.storage.calls),
+    }
+
+
+def print_result(name, result):
+    print(f"{name}: {result['operations']} operations in {result['elapsed']:.2f}s ({result['throughput']:.1f}/s), "
+          f"p50 {result['p50_ms']:.2f}ms, p99 {result['p99_ms']:.2f}ms")
+    for label, calls in (('api', result['api_calls']), ('db', result['db_calls'])):
+        summary = ', '.join(f"{method}={count}" for method, count in sorted(calls.items())) or "none"
+        print(f"  {label} calls ({sum(calls.values())}): {summary}")
+
+
+def regressions(results, baseline, tolerance, min_delta_ms):
+    """Return descriptions of the ways `results` are worse than `baseline`."""
+    found = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result['p99_ms'] > base['p99_ms'] * (1 + tolerance) and result['p99_ms'] - base['p99_ms'] > min_delta_ms:
+            found.append(f"{name}: p99 {result['p99_ms']:.2f}ms > baseline {base['p99_ms']:.2f}ms")
+        for label in ('api_calls', 'db_calls'):
+            calls, base_calls = sum(result[label].values()), sum(base[label].values())
+            if calls > base_calls:
+                found.append(f"{name}: {calls} {label.replace('_', ' ')} > baseline {base_calls}")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the captcha flow against a fake Bot API and database.")
+    parser.add_argument('scenarios', nargs='*', help=f"Scenarios to run: {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument('--users', type=int, default=200, help="Members joining in the raid, answers and kicks scenarios")
+    parser.add_argument('--chats', type=int, default=10, help="Chats the traffic is spread over")
+    parser.add_argument('--messages', type=int, default=10000, help="Messages in the chatter scenario")
+    parser.add_argument('--correct-ratio', type=float, default=0.7, help="Fraction of correct answers")
+    parser.add_argument('--concurrency', type=int, default=1, help="Updates handled at once (1 matches the default Application)")
+    parser.add_argument('--api-latency', type=float, default=0, help="Milliseconds each fake Bot API call takes")
+    parser.add_argument('--storage', choices=('memory', 'sqlite'), default='memory',
+                        help="Database stand-in: dicts, or the SQLite backend on an in-memory database")
+    parser.add_argument('--db-latency', type=float, default=0, help="Milliseconds added to each database call")
+    parser.add_argument('--raid-users', type=int, default=40, help="Members raiding the first chat in the neighbours scenario")
+    parser.add_argument('--arrival-interval', type=float, default=10, help="Milliseconds between updates in the neighbours scenario")
+    parser.add_argument('--delete-window', type=float, default=captcha_bot.DELETE_BATCH_WINDOW,
+                        help="Deletion batching window in seconds (default: DELETE_BATCH_WINDOW)")
+    parser.add_argument('--rate-limits', action=argparse.BooleanOptionalAction, default=True,
+                        help="Keep the outbound scheduler's configured rate limits (OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE)")
+    parser.add_argument('--seed', type=int, default=1, help="Random seed of the answer mix")
+    parser.add_argument('--json', help="Write the results to this file")
+    parser.add_argument('--baseline', help="Fail on regressions against results written earlier with --json")
+    parser.add_argument('--tolerance', type=float, default=0.25, help="Allowed relative p99 growth against the baseline")
+    parser.add_argument('--min-delta', type=float, default=1.0, help="p99 growth in ms that is always tolerated, to ignore timer noise")
+    parser.add_argument('--verbose', action='store_true', help="Keep the bot's INFO logging")
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    if not args.verbose:
+        for module_name in ('captcha_bot', 'database', 'sqlite_database', 'caches', 'deadlines', 'outbound'):
+            logging.getLogger(module_name).setLevel(logging.WARNING)
+
+    results = {}
+    for name in args.scenarios or SCENARIOS:
+        results[name] = asyncio.run(run_scenario(name, args))
+        print_result(name, results[name])
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            found = regressions(results, json.load(f), args.tolerance, args.min_delta)
+        for regression in found:
+            print(f"REGRESSION {regression}")
+        return 1 if found else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
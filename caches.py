@@ -0,0 +1,197 @@
+"""
+In-process state that mirrors the database, so hot paths can answer without I/O.
+"""
+import asyncio
+import time
+from collections import OrderedDict
+
+_MISSING = object()
+
+
+class LRUCache:
+    """Size-bounded mapping whose entries expire `ttl` seconds after they were stored."""
+
+    def __init__(self, maxsize=10000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, value)
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return default
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SettingsCache:
+    """
+    Read-through, write-through cache of the chat_settings and captchas rows.
+
+    Rows (including "no row") are cached per chat. The setters write to the
+    database first and then update the cached row, so the join and answer
+    paths do not query settings again until the entry expires or is evicted.
+    Concurrent misses for the same chat share a single query.
+    """
+
+    def __init__(self, db, maxsize=10000, ttl=300):
+        self._db = db
+        self._settings = LRUCache(maxsize, ttl)
+        self._captchas = LRUCache(maxsize, ttl)
+        self._inflight = {}
+        # Bumped on every write, so a load that raced with a write is not cached
+        self._generation = 0
+
+    async def _load(self, cache, key, loader):
+        value = cache.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+        future = self._inflight.get((cache, key))
+        if future is not None:
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[(cache, key)] = future
+        generation = self._generation
+        try:
+            value = await loader(key)
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # Mark the exception as retrieved in case nobody else was waiting
+            future.exception()
+            raise
+        else:
+            if generation == self._generation:
+                cache.set(key, value)
+            future.set_result(value)
+            return value
+        finally:
+            if self._inflight.get((cache, key)) is future:
+                del self._inflight[(cache, key)]
+
+    async def get_settings(self, chat_id):
+        return await self._load(self._settings, chat_id, self._db.get_chat_settings)
+
+    async def get_captcha(self, chat_id):
+        return await self._load(self._captchas, chat_id, self._db.get_captcha)
+
+    async def set_chat_setting(self, chat_id, column, value):
+        await self._db.set_chat_setting(chat_id, column, value)
+        self._generation += 1
+        settings = self._settings.get(chat_id)
+        if settings:
+            self._settings.set(chat_id, {**settings, column: value})
+        else:
+            # A new row was created with database defaults for the other columns
+            self._settings.invalidate(chat_id)
+
+    async def set_captcha(self, chat_id, mode, question, answers):
+        await self._db.set_captcha(chat_id, mode, question, answers)
+        self._generation += 1
+        self._captchas.set(chat_id, {'chat_id': chat_id, 'mode': mode, 'question': question, 'answers': answers})
+
+    def invalidate(self, chat_id):
+        self._generation += 1
+        self._settings.invalidate(chat_id)
+        self._captchas.invalidate(chat_id)
+
+
+class PendingCaptchaIndex:
+    """
+    Set of (chat_id, user_id) pairs that have a pending captcha.
+
+    It is rebuilt from the pending_captchas table at startup and updated by
+    every code path that inserts or deletes a pending captcha, so a message
+    from a user who is not being challenged is recognised without a query.
+    """
+
+    def __init__(self):
+        self._pending = set()
+
+    def rebuild(self, pairs):
+        self._pending.clear()
+        for chat_id, user_id in pairs:
+            self.add(chat_id, user_id)
+
+    def add(self, chat_id, user_id):
+        self._pending.add((chat_id, user_id))
+
+    def discard(self, chat_id, user_id):
+        self._pending.discard((chat_id, user_id))
+
+    def contains(self, chat_id, user_id):
+        return (chat_id, user_id) in self._pending
+
+    def __len__(self):
+        return len(self._pending)
+
+
+class AdminCache:
+    """
+    User ids of the administrators of each chat, fetched with getChatAdministrators.
+
+    Entries expire after `ttl` seconds and are kept current in between by
+    feeding ChatMemberUpdated events to update_member().
+    """
+
+    ADMIN_STATUSES = ('creator', 'administrator')
+
+    def __init__(self, maxsize=10000, ttl=600):
+        self._admins = LRUCache(maxsize, ttl)
+        self._inflight = {}
+
+    async def _fetch(self, bot, chat_id):
+        administrators = await bot.get_chat_administrators(chat_id)
+        admins = {member.user.id for member in administrators}
+        self._admins.set(chat_id, admins)
+        return admins
+
+    async def get_admins(self, bot, chat_id):
+        admins = self._admins.get(chat_id)
+        if admins is not None:
+            return admins
+
+        task = self._inflight.get(chat_id)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(bot, chat_id))
+            self._inflight[chat_id] = task
+            task.add_done_callback(lambda _: self._inflight.pop(chat_id, None))
+        return await asyncio.shield(task)
+
+    async def is_admin(self, bot, chat_id, user_id):
+        return user_id in await self.get_admins(bot, chat_id)
+
+    def update_member(self, chat_id, user_id, status):
+        admins = self._admins.get(chat_id)
+        if admins is None:
+            return
+        if status in self.ADMIN_STATUSES:
+            admins.add(user_id)
+        else:
+            admins.discard(user_id)
+
+    def invalidate(self, chat_id):
+        self._admins.invalidate(chat_id)
@@ -0,0 +1,65 @@
+"""
+Signed callback_data of the multiple-choice captcha buttons.
+
+A button's callback_data is a compact token packing the chat, the challenged
+user, the index of the option, the expiry of the captcha and a truncated
+HMAC-SHA256. Whether the option is the correct one is not written in the
+token but folded into the MAC, so the token does not reveal the answer, while
+the bot learns it in-process by checking which of the two possible MACs
+matches. A button press is therefore checked for ownership, expiry and
+correctness without reading pending_captchas.
+
+Tokens are "c1:" followed by 42 base64url characters, well within the
+64-byte limit of callback_data, whatever the answers are.
+"""
+import base64
+import hashlib
+import hmac
+import struct
+import time
+from collections import namedtuple
+
+PREFIX = 'c1:'
+MAC_SIZE = 10  # 80-bit MAC; a token can only be tried by pressing a button
+
+_PAYLOAD = struct.Struct('>qqBI')  # chat_id, user_id, option, expires_at (Unix time)
+
+CallbackToken = namedtuple('CallbackToken', 'chat_id user_id option expires_at correct')
+
+
+class CallbackSigner:
+    def __init__(self, secret):
+        self._secret = secret if isinstance(secret, bytes) else secret.encode()
+
+    def _mac(self, payload, correct):
+        return hmac.new(self._secret, payload + (b'\x01' if correct else b'\x00'), hashlib.sha256).digest()[:MAC_SIZE]
+
+    def sign(self, chat_id, user_id, option, expires_at, correct):
+        """Return the callback_data of option number `option` of a user's captcha."""
+        payload = _PAYLOAD.pack(chat_id, user_id, option, int(expires_at))
+        return PREFIX + base64.urlsafe_b64encode(payload + self._mac(payload, correct)).decode().rstrip('=')
+
+    def verify(self, data, now=None):
+        """
+        Return the CallbackToken of `data`, or None when it is malformed, forged or expired.
+        """
+        if not data or not data.startswith(PREFIX):
+            return None
+        encoded = data[len(PREFIX):]
+        try:
+            raw = base64.urlsafe_b64decode(encoded + '=' * (-len(encoded) % 4))
+        except ValueError:
+            return None
+        if len(raw) != _PAYLOAD.size + MAC_SIZE:
+            return None
+        payload, mac = raw[:_PAYLOAD.size], raw[_PAYLOAD.size:]
+        if hmac.compare_digest(mac, self._mac(payload, True)):
+            correct = True
+        elif hmac.compare_digest(mac, self._mac(payload, False)):
+            correct = False
+        else:
+            return None
+        token = CallbackToken(*_PAYLOAD.unpack(payload), correct)
+        if token.expires_at < (time.time() if now is None else now):
+            return None
+        return token
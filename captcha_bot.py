@@ -1,4 +1,6 @@
 import asyncio
+import functools
+import hashlib
 import random
 import html
 import json
@@ -8,33 +10,83 @@ import datetime
 import pytz
 import sys
 import signal
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Message
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, JobQueue, CallbackQueryHandler
+import multiprocessing
+import time
+from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup, Message
+from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes, JobQueue, CallbackQueryHandler, ChatMemberHandler
 from telegram.error import TelegramError, BadRequest
 from telegram.constants import ParseMode
 from collections import defaultdict
-from datetime import time as dt_time
 from datetime import datetime, timedelta
 from logging.handlers import RotatingFileHandler
 
 import os
 from dotenv import load_dotenv
-import mysql.connector
-from mysql.connector import Error
+from storage import DatabaseError
+from caches import AdminCache, PendingCaptchaIndex, SettingsCache
+from deadlines import DeadlineScheduler
+from outbound import DeletionBatcher, OutboundScheduler, Priority
+from update_filters import PendingChallengeFilter, allowed_update_types
+import metrics
+from metrics import InstrumentedRequest, LoopLagSampler, MetricsServer, timed
+from health import HealthMonitor, LoopWatchdog
+from leader import LeaderElection, StandingLeader
+from answers import compile_answers, normalize
+from callback_tokens import PREFIX as CALLBACK_PREFIX, CallbackSigner
+from workers import WorkerPool, route_updates, serve_updates, shard_of
 
 load_dotenv() # This reads the environment variables inside .env
 
 # Get environment variables
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'mysql').lower()  # 'mysql' or 'sqlite'
+SQLITE_PATH = os.getenv('SQLITE_PATH', 'captcha_bot.sqlite3')  # ':memory:' keeps everything in memory
 DB_HOST = os.getenv('DB_HOST')
 DB_PORT = int(os.getenv('DB_PORT', 3306))
 DB_NAME = os.getenv('DB_NAME')
 DB_USER = os.getenv('DB_USER')
 DB_PASSWORD = os.getenv('DB_PASSWORD')
 TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
+CALLBACK_SECRET = os.getenv('CALLBACK_SECRET')  # Key of the captcha button tokens; derived from the bot token when unset
+
+# Update delivery: "polling" (default) or "webhook"
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', 8443))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # Public URL Telegram posts to, e.g. https://bot.example.com/telegram; required in webhook mode
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')  # Checked against the X-Telegram-Bot-Api-Secret-Token header; required in webhook mode
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', 40))
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 8))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 10))  # Seconds to wait for a free connection
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 3600))  # Seconds before a connection is replaced
+SETTINGS_CACHE_SIZE = int(os.getenv('SETTINGS_CACHE_SIZE', 10000))  # Chats kept in the settings cache
+SETTINGS_CACHE_TTL = int(os.getenv('SETTINGS_CACHE_TTL', 300))  # Seconds before cached settings are re-read
+ADMIN_CACHE_TTL = int(os.getenv('ADMIN_CACHE_TTL', 600))  # Seconds before a chat's administrator list is re-fetched
+DEADLINE_OVERDUE_BATCH_SIZE = int(os.getenv('DEADLINE_OVERDUE_BATCH_SIZE', 20))  # Overdue kicks fired per second after a restart
+DEADLINE_TICK = float(os.getenv('DEADLINE_TICK', 1.0))  # Resolution of the captcha deadlines in seconds
+DEADLINE_SWEEP_INTERVAL = int(os.getenv('DEADLINE_SWEEP_INTERVAL', 5))  # Seconds between the leader's checks for deadlines of other replicas
+LEADER_LEASE_TTL = int(os.getenv('LEADER_LEASE_TTL', 10))  # Seconds before the lease of a replica that stopped renewing expires
+OUTBOUND_GLOBAL_RATE = int(os.getenv('OUTBOUND_GLOBAL_RATE', 30))  # Bot API requests per second
+OUTBOUND_CHAT_RATE = int(os.getenv('OUTBOUND_CHAT_RATE', 20))  # Messages per minute in one chat
+DELETE_BATCH_WINDOW = float(os.getenv('DELETE_BATCH_WINDOW', 0.5))  # Seconds deletions are collected before a bulk delete
+CLEANUP_BATCH_SIZE = int(os.getenv('CLEANUP_BATCH_SIZE', 500))  # Stale pending captchas purged per statement
+STATISTICS_SLOTS = int(os.getenv('STATISTICS_SLOTS', 24))  # Parts of the day the statistics collection is spread over
+STATISTICS_CONCURRENCY = int(os.getenv('STATISTICS_CONCURRENCY', 8))  # Member counts fetched in parallel
+# Address all members of a multi-member join with one open-ended captcha message instead of one message each
+COMBINE_CAPTCHA_MESSAGES = os.getenv('COMBINE_CAPTCHA_MESSAGES', 'false').lower() in ('1', 'true', 'yes')
+ANSWER_MAX_DISTANCE = int(os.getenv('ANSWER_MAX_DISTANCE', 0))  # Typos tolerated in open-ended answers that are words, 0 requires an exact match
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')  # Loopback only by default, so other hosts reach /healthz through HEALTH_PORT
+METRICS_PORT = int(os.getenv('METRICS_PORT', 9464))  # Port of the /metrics and /healthz endpoints, 0 disables them
+WATCHDOG_LAG_THRESHOLD = float(os.getenv('WATCHDOG_LAG_THRESHOLD', 1.0))  # Seconds the event loop may be blocked before its stack is logged
+HEALTH_CHECK_INTERVAL = int(os.getenv('HEALTH_CHECK_INTERVAL', 60))  # Seconds between the getMe and database health checks
+HEALTH_LISTEN = os.getenv('HEALTH_LISTEN', '0.0.0.0')  # Address of the separate /healthz listener for load balancers and orchestrators
+HEALTH_PORT = int(os.getenv('HEALTH_PORT', 0))  # Port of that listener, 0 serves /healthz only next to /metrics on METRICS_LISTEN
+WORKERS = int(os.getenv('WORKERS', 1))  # Worker processes updates are sharded over by chat_id; 1 handles them in-process
+WORKER_QUEUE_SIZE = int(os.getenv('WORKER_QUEUE_SIZE', 1000))  # Updates buffered for each worker before the ingress waits
 
 # Set up logging
 log_formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-log_file = '/var/log/telegram-captcha-bot/telegram-captcha-bot.log'
+log_file = os.getenv('LOG_FILE', '/var/log/telegram-captcha-bot/telegram-captcha-bot.log')
 log_handler = RotatingFileHandler(log_file, maxBytes=1024 * 1024 * 5, backupCount=5)  # 5MB file size, keep 5 backups
 log_handler.setFormatter(log_formatter)
 
@@ -47,6 +99,10 @@ console_handler = logging.StreamHandler()
 console_handler.setFormatter(log_formatter)
 logger.addHandler(console_handler)
 
+# Send the log records of the helper modules to the same file
+for module_name in ('database', 'sqlite_database', 'caches', 'deadlines', 'schema', 'outbound', 'update_filters', 'metrics', 'health', 'workers', 'leader'):
+    logging.getLogger(module_name).addHandler(log_handler)
+
 # Store pending captchas: {user_id: correct_answer}
 pending_captchas = {}
 
@@ -77,19 +133,113 @@ strict_mode = {}  # {chat_id: bool}
 # Enable logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 
-def get_db_connection():
-    try:
-        connection = mysql.connector.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            database=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD
-        )
-        return connection
-    except Error as e:
-        logger.error(f"Error connecting to MySQL database: {e}")
-        return None
+# All handlers access the database through this non-blocking storage backend (see storage.Storage)
+if STORAGE_BACKEND == 'sqlite':
+    from sqlite_database import SQLiteDatabase
+    db = SQLiteDatabase(SQLITE_PATH)
+else:
+    from database import Database
+    db = Database(
+        host=DB_HOST,
+        port=DB_PORT,
+        database=DB_NAME,
+        user=DB_USER,
+        password=DB_PASSWORD,
+        pool_size=DB_POOL_SIZE,
+        pool_timeout=DB_POOL_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE
+    )
+
+# chat_settings and captchas rows; the setter commands write through it
+settings_cache = SettingsCache(db, maxsize=SETTINGS_CACHE_SIZE, ttl=SETTINGS_CACHE_TTL)
+
+# Administrators of each chat, used to authorize the admin commands
+admin_cache = AdminCache(maxsize=SETTINGS_CACHE_SIZE, ttl=ADMIN_CACHE_TTL)
+
+# (chat_id, user_id) pairs with a pending captcha, kept in sync with the pending_captchas table
+pending_index = PendingCaptchaIndex()
+
+# Outbound Bot API calls made during joins, kicks and cleanup go through this rate-limited queue
+outbound = OutboundScheduler(global_rate=OUTBOUND_GLOBAL_RATE, chat_rate_per_minute=OUTBOUND_CHAT_RATE)
+
+# Message deletions are coalesced per chat and sent with deleteMessages; handlers queue them without waiting
+deleter = DeletionBatcher(outbound, window=DELETE_BATCH_WINDOW)
+
+# Kick deadlines of the pending captchas, kept in a timing wheel and persisted as pending_captchas.expires_at
+deadlines = DeadlineScheduler(tick=DEADLINE_TICK, overdue_batch_size=DEADLINE_OVERDUE_BATCH_SIZE,
+                              fired_memory=4 * DEADLINE_SWEEP_INTERVAL)
+
+# Event-loop lag and the Prometheus-style /metrics endpoint
+loop_lag = LoopLagSampler()
+metrics_server = MetricsServer(METRICS_LISTEN, METRICS_PORT) if METRICS_PORT else None
+
+# Liveness of the event loop (watched through the lag sampler's heartbeat), the Bot API and the database, served as /healthz
+loop_watchdog = LoopWatchdog(loop_lag, threshold=WATCHDOG_LAG_THRESHOLD)
+health = HealthMonitor(db, loop_watchdog, interval=HEALTH_CHECK_INTERVAL)
+# /healthz on a listener of its own, so probes from other hosts reach it without /metrics being exposed
+health_server = MetricsServer(HEALTH_LISTEN, HEALTH_PORT, registry=None) if HEALTH_PORT else None
+
+# Signs the callback_data of the captcha buttons, so presses are checked without a database read
+callback_signer = CallbackSigner(CALLBACK_SECRET or hashlib.sha256(b'captcha-callback:' + (TELEGRAM_BOT_TOKEN or '').encode()).digest())
+
+# Wrong button presses per (chat_id, user_id); only the final pass or fail reaches the database
+choice_attempts = {}
+
+# Members that still have to answer each captcha message shared by a multi-member join: (chat_id, message_id) -> user ids
+shared_captchas = {}
+# (chat_id, user_id) -> id of the shared captcha message the member answers
+shared_captcha_of = {}
+
+def add_shared_captcha(chat_id: int, message_id: int, user_ids) -> None:
+    shared_captchas.setdefault((chat_id, message_id), set()).update(user_ids)
+    for user_id in user_ids:
+        shared_captcha_of[(chat_id, user_id)] = message_id
+
+def release_shared_captcha(chat_id: int, user_id: int) -> list:
+    """Take a member off their shared captcha message; returns [message_id] when nobody else has to answer it, else []."""
+    message_id = shared_captcha_of.pop((chat_id, user_id), None)
+    if message_id is None:
+        return []
+    members = shared_captchas.get((chat_id, message_id), set())
+    members.discard(user_id)
+    if members:
+        return []
+    shared_captchas.pop((chat_id, message_id), None)
+    return [message_id]
+
+def forget_pending_captcha(chat_id: int, user_id: int) -> list:
+    """
+    Drop the in-memory state of a pending captcha that was solved, failed or purged.
+    Returns the ids of the messages no pending captcha needs any more, i.e. the
+    shared captcha message once its last member is resolved.
+    """
+    pending_index.discard(chat_id, user_id)
+    choice_attempts.pop((chat_id, user_id), None)
+    return release_shared_captcha(chat_id, user_id)
+
+# Replicas elect one leader that runs the periodic jobs and fires the captcha deadlines
+election = LeaderElection(db, 'captcha_bot', ttl=LEADER_LEASE_TTL)
+
+# Shard of the chats this process handles; set by configure_shard() in the worker processes
+WORKER_INDEX = 0
+WORKER_COUNT = 1
+
+def owns_chat(chat_id) -> bool:
+    return shard_of(chat_id, WORKER_COUNT) == WORKER_INDEX
+
+def configure_shard(index: int, count: int) -> None:
+    """Make this process the worker of shard `index` of `count`."""
+    global WORKER_INDEX, WORKER_COUNT, outbound, deleter, election
+    WORKER_INDEX, WORKER_COUNT = index, count
+    # Workers only run while their ingress process holds the lease
+    election = StandingLeader(f'captcha_bot:{index}/{count}')
+    # The bot-wide Bot API rate is shared by all workers; the per-chat rate needs no split as a chat has one worker
+    outbound = OutboundScheduler(global_rate=max(OUTBOUND_GLOBAL_RATE // count, 1), chat_rate_per_minute=OUTBOUND_CHAT_RATE)
+    deleter = DeletionBatcher(outbound, window=DELETE_BATCH_WINDOW)
+    if metrics_server is not None:
+        metrics_server.port = METRICS_PORT + index
+    if health_server is not None:
+        health_server.port = HEALTH_PORT + index
 
 def handle_exception(exc_type, exc_value, exc_traceback):
     if issubclass(exc_type, KeyboardInterrupt):
@@ -108,54 +258,64 @@ def signal_handler(signum, frame):
 signal.signal(signal.SIGINT, signal_handler)
 signal.signal(signal.SIGTERM, signal_handler)
 
+def admin_only(handler):
+    """Only run the command handler when the sender is an administrator of the chat."""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        message = update.effective_message
+        if not message:
+            return
+
+        chat_id = update.effective_chat.id
+        # Anonymous administrators post on behalf of the chat itself
+        if message.sender_chat and message.sender_chat.id == chat_id:
+            return await handler(update, context)
+
+        try:
+            is_admin = await admin_cache.is_admin(context.bot, chat_id, update.effective_user.id)
+        except TelegramError as e:
+            # E.g. private chats, which have no administrators
+            logger.info(f"Could not get administrators of chat {chat_id}: {e}")
+            is_admin = False
+
+        if not is_admin:
+            await message.reply_text("Sorry, only admins can use this command.")
+            return
+        return await handler(update, context)
+    return wrapper
+
+async def track_chat_admins(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Keep the administrator cache current when members are promoted or demoted."""
+    member_update = update.chat_member
+    admin_cache.update_member(member_update.chat.id, member_update.new_chat_member.user.id, member_update.new_chat_member.status)
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Send a message when the command /start is issued."""
     await update.message.reply_text('Hi! I am a captcha bot.')
 
-async def watchdog(context: ContextTypes.DEFAULT_TYPE):
-    try:
-        me = await context.bot.get_me()
-        logger.info(f"Bot is responsive. Username: {me.username}")
-    except Exception as e:
-        logger.error(f"Bot is not responsive: {e}")
-        # restart TBD
-
 async def get_timeout(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.effective_chat.id
-    
-    connection = get_db_connection()
-    if connection is None:
-        await update.message.reply_text("Sorry, there was a problem connecting to the database. Please try again later.")
-        return
 
-    cursor = connection.cursor()
     try:
-        cursor.execute("SELECT timeout FROM chat_settings WHERE chat_id = %s", (chat_id,))
-        result = cursor.fetchone()
-        
-        if result:
-            timeout = result[0]
-        else:
-            timeout = 60  # Default timeout if not set
-        
-        await update.message.reply_text(f"The current captcha timeout is set to {timeout} seconds.")
-    except Error as e:
+        result = await settings_cache.get_settings(chat_id)
+    except DatabaseError as e:
         logger.error(f"Error getting timeout: {e}")
         await update.message.reply_text("Sorry, there was a problem retrieving the timeout. Please try again later.")
-    finally:
-        cursor.close()
-        connection.close()
+        return
+
+    if result:
+        timeout = result['timeout']
+    else:
+        timeout = 60  # Default timeout if not set
+
+    await update.message.reply_text(f"The current captcha timeout is set to {timeout} seconds.")
 
+@admin_only
 async def set_timeout(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     message = update.message or update.edited_message
     if not message:
         return
 
-    user = await update.effective_chat.get_member(message.from_user.id)
-    if user.status not in ['creator', 'administrator']:
-        await message.reply_text("Sorry, only admins can use this command.")
-        return
-
     if len(context.args) != 1:
         await message.reply_text("Usage: /settimeout <seconds>")
         return
@@ -169,37 +329,22 @@ async def set_timeout(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         return
 
     chat_id = update.effective_chat.id
-    
-    connection = get_db_connection()
-    if connection is None:
-        await message.reply_text("Sorry, there was a problem connecting to the database. Please try again later.")
-        return
 
-    cursor = connection.cursor()
     try:
-        cursor.execute(
-            "INSERT INTO chat_settings (chat_id, timeout) VALUES (%s, %s) ON DUPLICATE KEY UPDATE timeout = %s",
-            (chat_id, timeout, timeout)
-        )
-        connection.commit()
-        await message.reply_text(f"Captcha timeout set to {timeout} seconds.")
-    except Error as e:
+        await settings_cache.set_chat_setting(chat_id, 'timeout', timeout)
+    except DatabaseError as e:
         logger.error(f"Error setting timeout: {e}")
         await message.reply_text("Sorry, there was a problem setting the timeout. Please try again later.")
-    finally:
-        cursor.close()
-        connection.close()
+        return
+
+    await message.reply_text(f"Captcha timeout set to {timeout} seconds.")
 
+@admin_only
 async def set_attempt_limit(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     message = update.message or update.edited_message
     if not message:
         return
 
-    user = await update.effective_chat.get_member(message.from_user.id)
-    if user.status not in ['creator', 'administrator']:
-        await message.reply_text("Sorry, only admins can use this command.")
-        return
-
     if len(context.args) != 1:
         await message.reply_text("Usage: /setattemptlimit <number>")
         return
@@ -213,59 +358,35 @@ async def set_attempt_limit(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return
 
     chat_id = update.effective_chat.id
-    
-    connection = get_db_connection()
-    if connection is None:
-        await message.reply_text("Sorry, there was a problem connecting to the database. Please try again later.")
-        return
 
-    cursor = connection.cursor()
     try:
-        cursor.execute(
-            "INSERT INTO chat_settings (chat_id, attempt_limit) VALUES (%s, %s) ON DUPLICATE KEY UPDATE attempt_limit = %s",
-            (chat_id, limit, limit)
-        )
-        connection.commit()
-        await message.reply_text(f"Captcha attempt limit set to {limit}.")
-    except Error as e:
+        await settings_cache.set_chat_setting(chat_id, 'attempt_limit', limit)
+    except DatabaseError as e:
         logger.error(f"Error setting attempt limit: {e}")
         await message.reply_text("Sorry, there was a problem setting the attempt limit. Please try again later.")
-    finally:
-        cursor.close()
-        connection.close()
+        return
+
+    await message.reply_text(f"Captcha attempt limit set to {limit}.")
 
 async def get_attempt_limit(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.effective_chat.id
-    
-    connection = get_db_connection()
-    if connection is None:
-        await update.message.reply_text("Sorry, there was a problem connecting to the database. Please try again later.")
-        return
 
-    cursor = connection.cursor()
     try:
-        cursor.execute("SELECT attempt_limit FROM chat_settings WHERE chat_id = %s", (chat_id,))
-        result = cursor.fetchone()
-        
-        if result:
-            limit = result[0]
-        else:
-            limit = 3  # Default attempt limit if not set
-        
-        await update.message.reply_text(f"The current captcha attempt limit is set to {limit}.")
-    except Error as e:
+        result = await settings_cache.get_settings(chat_id)
+    except DatabaseError as e:
         logger.error(f"Error getting attempt limit: {e}")
         await update.message.reply_text("Sorry, there was a problem retrieving the attempt limit. Please try again later.")
-    finally:
-        cursor.close()
-        connection.close()
-
-async def set_welcome_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user = await update.effective_chat.get_member(update.effective_user.id)
-    if user.status not in ['creator', 'administrator']:
-        await update.message.reply_text("Sorry, only admins can use this command.")
         return
 
+    if result:
+        limit = result['attempt_limit']
+    else:
+        limit = 3  # Default attempt limit if not set
+
+    await update.message.reply_text(f"The current captcha attempt limit is set to {limit}.")
+
+@admin_only
+async def set_welcome_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.effective_chat.id
     
     if not context.args:
@@ -273,141 +394,81 @@ async def set_welcome_message(update: Update, context: ContextTypes.DEFAULT_TYPE
         return
 
     welcome_message = ' '.join(context.args)
-    
-    connection = get_db_connection()
-    if connection is None:
-        await update.message.reply_text("Sorry, there was a problem connecting to the database. Please try again later.")
-        return
 
-    cursor = connection.cursor()
     try:
-        cursor.execute(
-            "INSERT INTO chat_settings (chat_id, welcome_message) VALUES (%s, %s) ON DUPLICATE KEY UPDATE welcome_message = %s",
-            (chat_id, welcome_message, welcome_message)
-        )
-        connection.commit()
-        await update.message.reply_text(f"Welcome message has been set to:\n\n{welcome_message}")
-    except Error as e:
+        await settings_cache.set_chat_setting(chat_id, 'welcome_message', welcome_message)
+    except DatabaseError as e:
         logger.error(f"Error setting welcome message: {e}")
         await update.message.reply_text("Sorry, there was a problem setting the welcome message. Please try again later.")
-    finally:
-        cursor.close()
-        connection.close()
+        return
+
+    await update.message.reply_text(f"Welcome message has been set to:\n\n{welcome_message}")
 
 async def get_welcome_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.effective_chat.id
-    
-    connection = get_db_connection()
-    if connection is None:
-        await update.message.reply_text("Sorry, there was a problem connecting to the database. Please try again later.")
-        return
 
-    cursor = connection.cursor()
     try:
-        cursor.execute("SELECT welcome_message FROM chat_settings WHERE chat_id = %s", (chat_id,))
-        result = cursor.fetchone()
-        
-        if result and result[0]:
-            welcome_message = result[0]
-            await update.message.reply_text(f"The current welcome message is:\n\n{welcome_message}")
-        else:
-            await update.message.reply_text("No custom welcome message has been set for this chat. The default welcome message will be used.")
-    except Error as e:
+        result = await settings_cache.get_settings(chat_id)
+    except DatabaseError as e:
         logger.error(f"Error getting welcome message: {e}")
         await update.message.reply_text("Sorry, there was a problem retrieving the welcome message. Please try again later.")
-    finally:
-        cursor.close()
-        connection.close()
-
-async def set_strict_mode(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user = await update.effective_chat.get_member(update.effective_user.id)
-    if user.status not in ['creator', 'administrator']:
-        await update.message.reply_text("Sorry, only admins can use this command.")
         return
 
+    if result and result['welcome_message']:
+        welcome_message = result['welcome_message']
+        await update.message.reply_text(f"The current welcome message is:\n\n{welcome_message}")
+    else:
+        await update.message.reply_text("No custom welcome message has been set for this chat. The default welcome message will be used.")
+
+@admin_only
+async def set_strict_mode(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.effective_chat.id
-    
-    connection = get_db_connection()
-    if connection is None:
-        await update.message.reply_text("Sorry, there was a problem connecting to the database. Please try again later.")
-        return
 
-    cursor = connection.cursor()
     try:
-        cursor.execute(
-            "INSERT INTO chat_settings (chat_id, strict_mode) VALUES (%s, TRUE) ON DUPLICATE KEY UPDATE strict_mode = TRUE",
-            (chat_id,)
-        )
-        connection.commit()
-        await update.message.reply_text("Strict mode enabled. Users who fail the captcha will be permanently banned.")
-    except Error as e:
+        await settings_cache.set_chat_setting(chat_id, 'strict_mode', True)
+    except DatabaseError as e:
         logger.error(f"Error setting strict mode: {e}")
         await update.message.reply_text("Sorry, there was a problem enabling strict mode. Please try again later.")
-    finally:
-        cursor.close()
-        connection.close()
-
-async def unset_strict_mode(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user = await update.effective_chat.get_member(update.effective_user.id)
-    if user.status not in ['creator', 'administrator']:
-        await update.message.reply_text("Sorry, only admins can use this command.")
         return
 
+    await update.message.reply_text("Strict mode enabled. Users who fail the captcha will be permanently banned.")
+
+@admin_only
+async def unset_strict_mode(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.effective_chat.id
-    
-    connection = get_db_connection()
-    if connection is None:
-        await update.message.reply_text("Sorry, there was a problem connecting to the database. Please try again later.")
-        return
 
-    cursor = connection.cursor()
     try:
-        cursor.execute(
-            "INSERT INTO chat_settings (chat_id, strict_mode) VALUES (%s, FALSE) ON DUPLICATE KEY UPDATE strict_mode = FALSE",
-            (chat_id,)
-        )
-        connection.commit()
-        await update.message.reply_text("Strict mode disabled. Users who fail the captcha will be kicked but not banned.")
-    except Error as e:
+        await settings_cache.set_chat_setting(chat_id, 'strict_mode', False)
+    except DatabaseError as e:
         logger.error(f"Error unsetting strict mode: {e}")
         await update.message.reply_text("Sorry, there was a problem disabling strict mode. Please try again later.")
-    finally:
-        cursor.close()
-        connection.close()
-
-async def get_all_settings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user = await update.effective_chat.get_member(update.effective_user.id)
-    if user.status not in ['creator', 'administrator']:
-        await update.message.reply_text("Sorry, only admins can use this command.")
         return
 
+    await update.message.reply_text("Strict mode disabled. Users who fail the captcha will be kicked but not banned.")
+
+@admin_only
+async def get_all_settings(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.effective_chat.id
-    
-    connection = get_db_connection()
-    if connection is None:
-        await update.message.reply_text("Sorry, there was a problem connecting to the database. Please try again later.")
-        return
 
-    cursor = connection.cursor(dictionary=True)
     try:
-        # Get chat settings
-        cursor.execute("SELECT * FROM chat_settings WHERE chat_id = %s", (chat_id,))
-        chat_settings = cursor.fetchone()
-        
-        if not chat_settings:
-            chat_settings = {
-                'timeout': 60,
-                'attempt_limit': 3,
-                'welcome_message': "Welcome to the group!",
-                'strict_mode': False,
-                'welcome_timeout': 10
-            }
-        
-        # Get captcha settings
-        cursor.execute("SELECT * FROM captchas WHERE chat_id = %s", (chat_id,))
-        captcha_settings = cursor.fetchone()
-        
-        settings_message = f"""
+        # Get chat settings and captcha settings
+        chat_settings = await settings_cache.get_settings(chat_id)
+        captcha_settings = await settings_cache.get_captcha(chat_id)
+    except DatabaseError as e:
+        logger.error(f"Error getting all settings: {e}")
+        await update.message.reply_text("Sorry, there was a problem retrieving the settings. Please try again later.")
+        return
+
+    if not chat_settings:
+        chat_settings = {
+            'timeout': 60,
+            'attempt_limit': 3,
+            'welcome_message': "Welcome to the group!",
+            'strict_mode': False,
+            'welcome_timeout': 10
+        }
+
+    settings_message = f"""
 Current settings for this chat:
 
 1. Captcha timeout: {chat_settings.get('timeout', 60)} seconds
@@ -418,68 +479,61 @@ Current settings for this chat:
 
 """
 
-        if captcha_settings:
-            settings_message += f"""
+    if captcha_settings:
+        settings_message += f"""
 6. Captcha type: {captcha_settings['mode']}
 7. Captcha question: "{captcha_settings['question']}"
 8. Captcha answer(s): {captcha_settings['answers']}
 """
-        else:
-            settings_message += """
+    else:
+        settings_message += """
 6. Captcha type: Default
 7. Captcha question: "What is 2+2?"
 8. Captcha answer(s): 4, four
 """
 
-        await update.message.reply_text(settings_message)
-    except Error as e:
-        logger.error(f"Error getting all settings: {e}")
-        await update.message.reply_text("Sorry, there was a problem retrieving the settings. Please try again later.")
-    finally:
-        cursor.close()
-        connection.close()
+    await update.message.reply_text(settings_message)
 
+@timed('update_group_statistics')
 async def update_group_statistics(context: ContextTypes.DEFAULT_TYPE) -> None:
-    bot = context.bot
-    connection = get_db_connection()
-    if connection is None:
-        logger.error("Failed to connect to the database")
-        return
+    """
+    Record the member count of the chats in the current statistics slot.
+    Chats are spread over STATISTICS_SLOTS slots of the UTC day by chat_id, and
+    the counts of a slot are fetched concurrently through the outbound
+    scheduler and stored with one INSERT.
+    """
+    now = datetime.now(pytz.UTC)
+    seconds_since_midnight = now.hour * 3600 + now.minute * 60 + now.second
+    # The job runs at slot boundaries; rounding tolerates a job that fires slightly early or late
+    slot = round(seconds_since_midnight * STATISTICS_SLOTS / 86400) % STATISTICS_SLOTS
 
-    cursor = connection.cursor()
     try:
-        # Get all unique chat_ids from the chat_settings table
-        cursor.execute("SELECT DISTINCT chat_id FROM chat_settings")
-        chat_ids = cursor.fetchall()
-
-        for (chat_id,) in chat_ids:
-            try:
-                # Get the member count for the chat
-                chat_member_count = await bot.get_chat_member_count(chat_id)
+        chat_ids = [chat_id for chat_id in await db.get_chat_ids() if chat_id % STATISTICS_SLOTS == slot and owns_chat(chat_id)]
+    except DatabaseError as e:
+        logger.error(f"Database error in update_group_statistics: {e}")
+        return
 
-                # Insert the data into the group_statistics table
-                cursor.execute("""
-                    INSERT INTO group_statistics (chat_id, member_count)
-                    VALUES (%s, %s)
-                """, (chat_id, chat_member_count))
+    semaphore = asyncio.Semaphore(STATISTICS_CONCURRENCY)
 
-                logger.info(f"Updated statistics for chat {chat_id}: {chat_member_count} members")
+    async def member_count(chat_id):
+        async with semaphore:
+            try:
+                return chat_id, await outbound.call(Priority.BACKGROUND, context.bot.get_chat_member_count, chat_id=chat_id)
             except TelegramError as e:
                 logger.error(f"Error getting member count for chat {chat_id}: {e}")
+                return chat_id, None
 
-        connection.commit()
-    except Error as e:
+    results = await asyncio.gather(*(member_count(chat_id) for chat_id in chat_ids))
+    statistics = [(chat_id, count) for chat_id, count in results if count is not None]
+
+    try:
+        await db.add_group_statistics(statistics)
+        logger.info(f"Updated statistics for {len(statistics)} of {len(chat_ids)} chats in slot {slot}")
+    except DatabaseError as e:
         logger.error(f"Database error in update_group_statistics: {e}")
-    finally:
-        cursor.close()
-        connection.close()
 
+@admin_only
 async def set_open_captcha(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user = await update.effective_chat.get_member(update.effective_user.id)
-    if user.status not in ['creator', 'administrator']:
-        await update.message.reply_text("Sorry, only admins can use this command.")
-        return
-
     if len(context.args) < 2:
         await update.message.reply_text("Usage: /setopencaptcha <question> | <answer1>, <answer2>, ...")
         return
@@ -491,36 +545,27 @@ async def set_open_captcha(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         return
 
     question, answers_part = [part.strip() for part in parts]
-    answers = [answer.strip().lower() for answer in answers_part.split(',')]
+    # Answers are matched in normalized form (see answers.normalize), so only keep those that normalize to something
+    answers = [answer.strip() for answer in answers_part.split(',') if normalize(answer)]
+    if not answers:
+        await update.message.reply_text("Please give at least one answer that contains letters or digits.")
+        return
 
     chat_id = update.effective_chat.id
-    
-    connection = get_db_connection()
-    if connection is None:
-        await update.message.reply_text("Sorry, there was a problem connecting to the database. Please try again later.")
-        return
 
-    cursor = connection.cursor()
     try:
-        cursor.execute(
-            "INSERT INTO captchas (chat_id, mode, question, answers) VALUES (%s, %s, %s, %s) ON DUPLICATE KEY UPDATE mode = %s, question = %s, answers = %s",
-            (chat_id, "open", question, ','.join(answers), "open", question, ','.join(answers))
-        )
-        connection.commit()
-        await update.message.reply_text(f"Open-ended captcha set. Question: {question}\nPossible answers: {', '.join(answers)}")
-    except Error as e:
+        await settings_cache.set_captcha(chat_id, "open", question, ','.join(answers))
+    except DatabaseError as e:
         logger.error(f"Error setting open captcha: {e}")
         await update.message.reply_text("Sorry, there was a problem setting the captcha. Please try again later.")
-    finally:
-        cursor.close()
-        connection.close()
-
-async def set_multiple_captcha(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user = await update.effective_chat.get_member(update.effective_user.id)
-    if user.status not in ['creator', 'administrator']:
-        await update.message.reply_text("Sorry, only admins can use this command.")
         return
 
+    # Compiled now, so the first reply is matched with a set probe
+    compile_answers(','.join(answers), ANSWER_MAX_DISTANCE)
+    await update.message.reply_text(f"Open-ended captcha set. Question: {question}\nPossible answers: {', '.join(answers)}")
+
+@admin_only
+async def set_multiple_captcha(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if len(context.args) < 3:
         await update.message.reply_text("Usage: /setmultiplechoice <question> | <correct_answer> | <wrong_answer1>, <wrong_answer2>, ...")
         return
@@ -536,33 +581,18 @@ async def set_multiple_captcha(update: Update, context: ContextTypes.DEFAULT_TYP
     all_answers = [correct_answer] + wrong_answers
 
     chat_id = update.effective_chat.id
-    
-    connection = get_db_connection()
-    if connection is None:
-        await update.message.reply_text("Sorry, there was a problem connecting to the database. Please try again later.")
-        return
 
-    cursor = connection.cursor()
     try:
-        cursor.execute(
-            "INSERT INTO captchas (chat_id, mode, question, answers) VALUES (%s, %s, %s, %s) ON DUPLICATE KEY UPDATE mode = %s, question = %s, answers = %s",
-            (chat_id, "multiple", question, ','.join(all_answers), "multiple", question, ','.join(all_answers))
-        )
-        connection.commit()
-        await update.message.reply_text(f"Multiple-choice captcha set. Question: {question}\nCorrect answer: {correct_answer}\nAll options: {', '.join(all_answers)}")
-    except Error as e:
+        await settings_cache.set_captcha(chat_id, "multiple", question, ','.join(all_answers))
+    except DatabaseError as e:
         logger.error(f"Error setting multiple choice captcha: {e}")
         await update.message.reply_text("Sorry, there was a problem setting the captcha. Please try again later.")
-    finally:
-        cursor.close()
-        connection.close()
-
-async def set_welcome_timeout(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    user = await update.effective_chat.get_member(update.effective_user.id)
-    if user.status not in ['creator', 'administrator']:
-        await update.message.reply_text("Sorry, only admins can use this command.")
         return
 
+    await update.message.reply_text(f"Multiple-choice captcha set. Question: {question}\nCorrect answer: {correct_answer}\nAll options: {', '.join(all_answers)}")
+
+@admin_only
+async def set_welcome_timeout(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if len(context.args) != 1:
         await update.message.reply_text("Usage: /setwelcometimeout <seconds>")
         return
@@ -576,199 +606,173 @@ async def set_welcome_timeout(update: Update, context: ContextTypes.DEFAULT_TYPE
         return
 
     chat_id = update.effective_chat.id
-    
-    connection = get_db_connection()
-    if connection is None:
-        await update.message.reply_text("Sorry, there was a problem connecting to the database. Please try again later.")
-        return
 
-    cursor = connection.cursor()
     try:
-        cursor.execute(
-            "INSERT INTO chat_settings (chat_id, welcome_timeout) VALUES (%s, %s) ON DUPLICATE KEY UPDATE welcome_timeout = %s",
-            (chat_id, timeout, timeout)
-        )
-        connection.commit()
-        await update.message.reply_text(f"Welcome message timeout set to {timeout} seconds.")
-    except Error as e:
+        await settings_cache.set_chat_setting(chat_id, 'welcome_timeout', timeout)
+    except DatabaseError as e:
         logger.error(f"Error setting welcome timeout: {e}")
         await update.message.reply_text("Sorry, there was a problem setting the welcome timeout. Please try again later.")
-    finally:
-        cursor.close()
-        connection.close()
+        return
+
+    await update.message.reply_text(f"Welcome message timeout set to {timeout} seconds.")
 
 async def get_welcome_timeout(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     chat_id = update.effective_chat.id
-    
-    connection = get_db_connection()
-    if connection is None:
-        await update.message.reply_text("Sorry, there was a problem connecting to the database. Please try again later.")
-        return
 
-    cursor = connection.cursor()
     try:
-        cursor.execute("SELECT welcome_timeout FROM chat_settings WHERE chat_id = %s", (chat_id,))
-        result = cursor.fetchone()
-        
-        if result:
-            timeout = result[0]
-        else:
-            timeout = 10  # Default welcome timeout if not set
-        
-        await update.message.reply_text(f"The current welcome message timeout is set to {timeout} seconds.")
-    except Error as e:
+        result = await settings_cache.get_settings(chat_id)
+    except DatabaseError as e:
         logger.error(f"Error getting welcome timeout: {e}")
         await update.message.reply_text("Sorry, there was a problem retrieving the welcome timeout. Please try again later.")
-    finally:
-        cursor.close()
-        connection.close()
+        return
 
-async def delete_welcome_message(context: ContextTypes.DEFAULT_TYPE) -> None:
-    job = context.job
-    chat_id, message_id = job.data['chat_id'], job.data['message_id']
-    
-    try:
-        await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
-        logger.info(f"Welcome message (ID: {message_id}) deleted in chat {chat_id}")
-    except TelegramError as e:
-        logger.error(f"Error deleting welcome message (ID: {message_id}) in chat {chat_id}: {e}")
+    if result:
+        timeout = result['welcome_timeout']
+    else:
+        timeout = 10  # Default welcome timeout if not set
 
+    await update.message.reply_text(f"The current welcome message timeout is set to {timeout} seconds.")
+
+@timed('button_callback')
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Handle a press of a multiple-choice captcha button. The signed token in
+    callback_data tells who the captcha is for and whether the option is
+    right, so wrong presses are counted in memory and the database is only
+    written when the captcha is passed (or failed, by the kick).
+
+    Buttons sent before the tokens were introduced carry captcha:<user_id>:<answer>;
+    they are still checked against the pending_captchas row, as they were before.
+    """
     query = update.callback_query
-    await query.answer()
+    chat_id = query.message.chat.id
+    token = callback_signer.verify(query.data)
+    legacy_answer = None
 
-    data = query.data.split(':')
-    if data[0] == 'captcha':
-        user_id = int(data[1])
-        answer = data[2]
+    if token is not None:
+        user_id = token.user_id if token.chat_id == chat_id else None
+    else:
+        try:
+            prefix, user_id, legacy_answer = query.data.split(':', 2)
+            user_id = int(user_id) if prefix == 'captcha' else None
+        except ValueError:
+            user_id = None
 
-        logger.info(f"Received captcha answer from user {user_id}")
+    if user_id is not None and query.from_user.id != user_id:
+        await query.answer("This captcha is not for you.")
+        return
 
-        connection = get_db_connection()
-        if connection is None:
-            logger.error("Failed to connect to the database in button_callback")
-            await query.edit_message_text("Sorry, there was a problem processing your response. Please try again later.")
-            return
+    if user_id is None or not pending_index.contains(chat_id, user_id):
+        await query.answer()
+        await query.edit_message_text("This captcha is no longer valid.")
+        return
+    await query.answer()
 
-        cursor = connection.cursor(dictionary=True)
-        try:
-            cursor.execute("SELECT * FROM pending_captchas WHERE user_id = %s", (user_id,))
-            pending_captcha = cursor.fetchone()
+    logger.info(f"Received captcha answer from user {user_id}")
 
+    try:
+        if token is not None:
+            correct = token.correct
+        else:
+            pending_captcha = await db.get_pending_captcha(chat_id, user_id)
             if not pending_captcha:
                 logger.warning(f"No pending captcha found for user {user_id}")
+                forget_pending_captcha(chat_id, user_id)
                 await query.edit_message_text("This captcha is no longer valid.")
                 return
-
-            chat_id = pending_captcha['chat_id']
-            captcha_message_id = pending_captcha['captcha_message_id']
             correct_answers = pending_captcha['correct_answers'].split(',')
+            correct = legacy_answer.lower() in [ans.lower() for ans in correct_answers]
 
-            cursor.execute("SELECT * FROM chat_settings WHERE chat_id = %s", (chat_id,))
-            chat_settings = cursor.fetchone()
-            attempt_limit = chat_settings['attempt_limit'] if chat_settings else 3
-            strict_mode = chat_settings['strict_mode'] if chat_settings else False
-            welcome_message = chat_settings['welcome_message'] if chat_settings else f"Welcome to the group, {query.from_user.full_name}!"
-            welcome_timeout = chat_settings['welcome_timeout'] if chat_settings else 10
-
-            if answer.lower() in [ans.lower() for ans in correct_answers]:
-                logger.info(f"User {user_id} answered captcha correctly in chat {chat_id}")
-                welcome_msg = await query.edit_message_text(f"Correct! {welcome_message}")
-                cursor.execute("DELETE FROM pending_captchas WHERE user_id = %s", (user_id,))
-                connection.commit()
-
-                # Remove the kick job if it exists
-                current_jobs = context.job_queue.get_jobs_by_name(f'kick_user_{chat_id}_{user_id}')
-                for job in current_jobs:
-                    job.schedule_removal()
-
-                # Schedule welcome message deletion
-                context.job_queue.run_once(
-                    delete_welcome_message, 
-                    welcome_timeout,
-                    data={'chat_id': chat_id, 'message_id': welcome_msg.message_id},
-                    name=f'delete_welcome_{chat_id}_{user_id}'
+        chat_settings = await settings_cache.get_settings(chat_id)
+        attempt_limit = chat_settings['attempt_limit'] if chat_settings else 3
+        strict_mode = chat_settings['strict_mode'] if chat_settings else False
+        welcome_message = chat_settings['welcome_message'] if chat_settings else f"Welcome to the group, {query.from_user.full_name}!"
+        welcome_timeout = chat_settings['welcome_timeout'] if chat_settings else 10
+
+        if correct:
+            logger.info(f"User {user_id} answered captcha correctly in chat {chat_id}")
+            welcome_msg = await query.edit_message_text(f"Correct! {welcome_message}")
+            await db.delete_pending_captcha(chat_id, user_id)
+            forget_pending_captcha(chat_id, user_id)
+
+            # Remove the kick job if it exists
+            deadlines.cancel(chat_id, user_id)
+
+            # Schedule welcome message deletion
+            context.job_queue.run_once(
+                delete_welcome_message, 
+                welcome_timeout,
+                data={'chat_id': chat_id, 'message_id': welcome_msg.message_id},
+                name=f'delete_welcome_{chat_id}_{user_id}'
+            )
+        else:
+            logger.info(f"User {user_id} answered captcha incorrectly in chat {chat_id}")
+            new_attempts = choice_attempts.get((chat_id, user_id), 0) + 1
+            choice_attempts[(chat_id, user_id)] = new_attempts
+
+            if new_attempts >= attempt_limit:
+                logger.info(f"User {user_id} exceeded attempt limit in chat {chat_id}")
+                # Move the kick deadline to now
+                deadlines.schedule(
+                    chat_id,
+                    user_id,
+                    0,  # Run immediately
+                    data={
+                        'user_name': query.from_user.full_name,
+                        'captcha_message_id': query.message.message_id,
+                        'strict_mode': strict_mode
+                    }
                 )
             else:
-                logger.info(f"User {user_id} answered captcha incorrectly in chat {chat_id}")
-                new_attempts = pending_captcha['attempts'] + 1
-                cursor.execute("UPDATE pending_captchas SET attempts = %s WHERE user_id = %s", (new_attempts, user_id))
-                connection.commit()
-
-                if new_attempts >= attempt_limit:
-                    logger.info(f"User {user_id} exceeded attempt limit in chat {chat_id}")
-                    # Schedule the kick job immediately
-                    context.job_queue.run_once(
-                        kick_user,
-                        0,  # Run immediately
-                        data={
-                            'chat_id': chat_id,
-                            'user_id': user_id,
-                            'user_name': query.from_user.full_name,
-                            'captcha_message_id': captcha_message_id,
-                            'strict_mode': strict_mode
-                        },
-                        name=f'kick_user_{chat_id}_{user_id}'
-                    )
-                else:
-                    remaining_attempts = attempt_limit - new_attempts
-                    await query.edit_message_text(
-                        f"Sorry, that's incorrect. You have {remaining_attempts} attempt{'s' if remaining_attempts > 1 else ''} remaining.\n\n"
-                        f"Please try again: {pending_captcha['question']}",
-                        reply_markup=query.message.reply_markup
-                    )
-        except Error as e:
-            logger.error(f"Database error in button_callback: {e}")
-        finally:
-            cursor.close()
-            connection.close()
+                remaining_attempts = attempt_limit - new_attempts
+                custom_captcha = await settings_cache.get_captcha(chat_id)
+                question = custom_captcha['question'] if custom_captcha else ""
+                await query.edit_message_text(
+                    f"Sorry, that's incorrect. You have {remaining_attempts} attempt{'s' if remaining_attempts > 1 else ''} remaining.\n\n"
+                    f"Please try again: {question}",
+                    reply_markup=query.message.reply_markup
+                )
+    except DatabaseError as e:
+        logger.error(f"Database error in button_callback: {e}")
 
+@timed('check_captcha_answer')
 async def check_captcha_answer(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = update.message.from_user.id
-    
-    logger.info(f"Received text message from user {user_id}, checking if it's a captcha answer")
+    chat_id = update.effective_chat.id
 
-    connection = get_db_connection()
-    if connection is None:
-        logger.error("Failed to connect to the database in check_captcha_answer")
-        await update.message.reply_text("Sorry, there was a problem processing your response. Please try again later.")
-        return
+    if not pending_index.contains(chat_id, user_id):
+        return  # No pending captcha for this user, answered without touching the database
+
+    logger.info(f"Received text message from user {user_id}, checking if it's a captcha answer")
 
-    cursor = connection.cursor(dictionary=True)
     try:
-        cursor.execute("SELECT * FROM pending_captchas WHERE user_id = %s", (user_id,))
-        pending_captcha = cursor.fetchone()
+        pending_captcha = await db.get_pending_captcha(chat_id, user_id)
 
         if not pending_captcha:
             logger.info(f"No pending captcha found for user {user_id}")
-            return  # No pending captcha for this user
+            forget_pending_captcha(chat_id, user_id)
+            return
 
-        chat_id = pending_captcha['chat_id']
         captcha_message_id = pending_captcha['captcha_message_id']
-        correct_answers = pending_captcha['correct_answers'].split(',')
+        matcher = compile_answers(pending_captcha['correct_answers'], ANSWER_MAX_DISTANCE)
         messages_to_delete = json.loads(pending_captcha.get('messages_to_delete', '[]'))
         messages_to_delete.append(update.message.message_id)
 
-        cursor.execute("SELECT * FROM chat_settings WHERE chat_id = %s", (chat_id,))
-        chat_settings = cursor.fetchone()
+        chat_settings = await settings_cache.get_settings(chat_id)
         attempt_limit = chat_settings['attempt_limit'] if chat_settings else 3
         strict_mode = chat_settings['strict_mode'] if chat_settings else False
         welcome_message = chat_settings['welcome_message'] if chat_settings else f"Welcome to the group, {update.message.from_user.full_name}!"
         welcome_timeout = chat_settings['welcome_timeout'] if chat_settings else 10
 
-        user_answer = update.message.text.strip().lower()
-
-        if user_answer in [ans.lower() for ans in correct_answers]:
+        if matcher.matches(update.message.text):
             logger.info(f"User {user_id} answered captcha correctly in chat {chat_id}")
             success_message = await update.message.reply_text(f"Correct! {welcome_message}")
             messages_to_delete.append(success_message.message_id)
-            cursor.execute("DELETE FROM pending_captchas WHERE user_id = %s", (user_id,))
-            connection.commit()
+            await db.delete_pending_captcha(chat_id, user_id)
+            messages_to_delete.extend(forget_pending_captcha(chat_id, user_id))
 
             # Remove the kick job if it exists
-            current_jobs = context.job_queue.get_jobs_by_name(f'kick_user_{chat_id}_{user_id}')
-            for job in current_jobs:
-                job.schedule_removal()
+            deadlines.cancel(chat_id, user_id)
 
             # Schedule welcome message deletion
             context.job_queue.run_once(
@@ -782,7 +786,7 @@ async def check_captcha_answer(update: Update, context: ContextTypes.DEFAULT_TYP
             context.job_queue.run_once(
                 delete_captcha_messages, 
                 15, 
-                data={'chat_id': chat_id, 'user_id': user_id, 'message_ids': messages_to_delete},
+                data={'chat_id': chat_id, 'user_id': user_id, 'messages_to_delete': messages_to_delete},
                 name=f'delete_captcha_{chat_id}_{user_id}'
             )
         else:
@@ -791,19 +795,17 @@ async def check_captcha_answer(update: Update, context: ContextTypes.DEFAULT_TYP
             
             if new_attempts >= attempt_limit:
                 logger.info(f"User {user_id} exceeded attempt limit in chat {chat_id}")
-                # Schedule the kick job immediately
-                context.job_queue.run_once(
-                    kick_user,
+                # Move the kick deadline to now
+                deadlines.schedule(
+                    chat_id,
+                    user_id,
                     0,  # Run immediately
                     data={
-                        'chat_id': chat_id,
-                        'user_id': user_id,
                         'user_name': update.message.from_user.full_name,
                         'captcha_message_id': captcha_message_id,
                         'strict_mode': strict_mode,
                         'messages_to_delete': messages_to_delete
-                    },
-                    name=f'kick_user_{chat_id}_{user_id}'
+                    }
                 )
             else:
                 remaining_attempts = attempt_limit - new_attempts
@@ -811,97 +813,114 @@ async def check_captcha_answer(update: Update, context: ContextTypes.DEFAULT_TYP
                 messages_to_delete.append(reply_message.message_id)
                 
                 # Update the pending captcha with new attempt count and messages to delete
-                cursor.execute("UPDATE pending_captchas SET attempts = %s, messages_to_delete = %s WHERE user_id = %s", 
-                               (new_attempts, json.dumps(messages_to_delete), user_id))
-                connection.commit()
+                await db.update_pending_captcha(chat_id, user_id, new_attempts, messages_to_delete)
 
-    except Error as e:
+    except DatabaseError as e:
         logger.error(f"Database error in check_captcha_answer: {e}")
-    finally:
-        cursor.close()
-        connection.close()
 
-async def kick_user(context: ContextTypes.DEFAULT_TYPE) -> None:
-    job = context.job
-    chat_id = job.data['chat_id']
-    user_id = job.data['user_id']
-    user_name = job.data['user_name']
-    captcha_message_id = job.data['captcha_message_id']
-    strict_mode = job.data.get('strict_mode', False)
+@timed('kick_user')
+async def kick_user(context: ContextTypes.DEFAULT_TYPE, chat_id: int, user_id: int, data: dict) -> None:
+    """
+    First stage of a kick, called by the deadline scheduler: ban the user and forget the pending captcha.
+    The cleanup, notice and notice deletion run as separate jobs, so no stage
+    sleeps while holding a database connection or a job slot.
+    """
+    user_name = data['user_name']
+    strict_mode = data.get('strict_mode', False)
 
     logger.info(f"Attempting to kick user {user_id} from chat {chat_id}")
 
-    connection = get_db_connection()
-    if connection is None:
-        logger.error(f"Failed to connect to the database while trying to kick user {user_id} from chat {chat_id}")
-        return
-
-    cursor = connection.cursor(dictionary=True)
     try:
         # Check if the captcha is still pending
-        cursor.execute("SELECT * FROM pending_captchas WHERE user_id = %s AND chat_id = %s", (user_id, chat_id))
-        pending_captcha = cursor.fetchone()
-
-        if pending_captcha:
-            messages_to_delete = json.loads(pending_captcha.get('messages_to_delete', '[]'))
-            messages_to_delete.append(captcha_message_id)
+        pending_captcha = await db.get_pending_captcha(chat_id, user_id)
+    except DatabaseError as e:
+        logger.error(f"Database error in kick_user: {e}")
+        return
 
-            try:
-                # Send a message right before kicking the user
-                temp_message = await context.bot.send_message(chat_id=chat_id, text=".")
-                last_message_id = temp_message.message_id
-
-                if strict_mode:
-                    await context.bot.ban_chat_member(chat_id, user_id)
-                    action_text = "banned permanently"
-                else:
-                    await context.bot.ban_chat_member(chat_id, user_id)
-                    await context.bot.unban_chat_member(chat_id, user_id)
-                    action_text = "removed"
-
-                logger.info(f"User {user_id} has been {action_text} from chat {chat_id}")
-
-                # Wait a moment for the system message to appear
-                await asyncio.sleep(1)
-
-                # Delete a range of messages to catch the system message
-                for i in range(last_message_id, last_message_id + 5):
-                    try:
-                        await context.bot.delete_message(chat_id=chat_id, message_id=i)
-                    except TelegramError:
-                        pass  # Message doesn't exist or can't be deleted, move on
-
-                # Delete all captcha-related messages
-                for msg_id in messages_to_delete:
-                    try:
-                        await context.bot.delete_message(chat_id=chat_id, message_id=msg_id)
-                    except TelegramError as e:
-                        logger.error(f"Error deleting message {msg_id}: {e}")
-
-                # Send a temporary notification about the action taken
-                action_message = await context.bot.send_message(
-                    chat_id=chat_id,
-                    text=f"{user_name} has been {action_text} for not completing the captcha."
-                )
-                await asyncio.sleep(5)  # Show the message for 5 seconds
-                await context.bot.delete_message(chat_id=chat_id, message_id=action_message.message_id)
+    if not pending_captcha:
+        forget_pending_captcha(chat_id, user_id)
+        logger.warning(f"Kick job ran for user {user_id} in chat {chat_id}, but they were not in pending_captchas.")
+        return
 
-                # Remove the pending captcha from the database
-                cursor.execute("DELETE FROM pending_captchas WHERE user_id = %s AND chat_id = %s", (user_id, chat_id))
-                connection.commit()
-                logger.info(f"Removed pending captcha for user {user_id} in chat {chat_id}")
+    # Contains the user's own captcha message; a captcha message shared with other new members is added once they are all resolved
+    messages_to_delete = json.loads(pending_captcha.get('messages_to_delete', '[]'))
 
-            except TelegramError as e:
-                logger.error(f"Error kicking/banning user {user_id} from chat {chat_id}: {e}")
+    try:
+        # Send a message right before kicking the user
+        temp_message = await outbound.call(Priority.KICK, context.bot.send_message, chat_id=chat_id, text=".")
 
+        if strict_mode:
+            await outbound.call(Priority.KICK, context.bot.ban_chat_member, chat_id=chat_id, user_id=user_id)
+            action_text = "banned permanently"
         else:
-            logger.warning(f"Kick job ran for user {user_id} in chat {chat_id}, but they were not in pending_captchas.")
+            await outbound.call(Priority.KICK, context.bot.ban_chat_member, chat_id=chat_id, user_id=user_id)
+            await outbound.call(Priority.KICK, context.bot.unban_chat_member, chat_id=chat_id, user_id=user_id)
+            action_text = "removed"
+    except TelegramError as e:
+        logger.error(f"Error kicking/banning user {user_id} from chat {chat_id}: {e}")
+        return
+
+    logger.info(f"User {user_id} has been {action_text} from chat {chat_id}")
 
-    except Error as e:
+    try:
+        # Remove the pending captcha from the database
+        await db.delete_pending_captcha(chat_id, user_id)
+        logger.info(f"Removed pending captcha for user {user_id} in chat {chat_id}")
+    except DatabaseError as e:
         logger.error(f"Database error in kick_user: {e}")
-    finally:
-        cursor.close()
-        connection.close()
+    messages_to_delete.extend(forget_pending_captcha(chat_id, user_id))
+
+    # Give the system message a moment to appear before cleaning up
+    context.job_queue.run_once(
+        kick_cleanup,
+        1,
+        data={
+            'chat_id': chat_id,
+            'user_id': user_id,
+            'user_name': user_name,
+            'action_text': action_text,
+            'last_message_id': temp_message.message_id,
+            'messages_to_delete': messages_to_delete
+        },
+        name=f'kick_cleanup_{chat_id}_{user_id}'
+    )
+
+async def kick_cleanup(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Second stage of a kick: delete the system message and the captcha-related messages."""
+    job = context.job
+    chat_id = job.data['chat_id']
+    user_id = job.data['user_id']
+    last_message_id = job.data['last_message_id']
+
+    # Delete a range of messages to catch the system message, and all captcha-related messages, in one request
+    deleter.delete(context.bot, chat_id, list(range(last_message_id, last_message_id + 5)) + job.data['messages_to_delete'])
+
+    context.job_queue.run_once(kick_notice, 0, data=job.data, name=f'kick_notice_{chat_id}_{user_id}')
+
+async def kick_notice(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Third stage of a kick: show a temporary notification about the action taken."""
+    job = context.job
+    chat_id = job.data['chat_id']
+    user_id = job.data['user_id']
+
+    try:
+        action_message = await outbound.call(
+            Priority.MESSAGE,
+            context.bot.send_message,
+            chat_id=chat_id,
+            text=f"{job.data['user_name']} has been {job.data['action_text']} for not completing the captcha."
+        )
+    except TelegramError as e:
+        logger.error(f"Error sending kick notice for user {user_id} in chat {chat_id}: {e}")
+        return
+
+    # Show the message for 5 seconds
+    context.job_queue.run_once(
+        delete_captcha_messages,
+        5,
+        data={'chat_id': chat_id, 'user_id': user_id, 'messages_to_delete': [action_message.message_id]},
+        name=f'delete_kick_notice_{chat_id}_{user_id}'
+    )
 
 def is_service_message(message: Message) -> bool:
     """
@@ -922,108 +941,174 @@ async def delete_welcome_message(context: ContextTypes.DEFAULT_TYPE) -> None:
     job = context.job
     chat_id, message_id = job.data['chat_id'], job.data['message_id']
     
+    deleter.delete(context.bot, chat_id, [message_id])
+    logger.info(f"Queued deletion of welcome message (ID: {message_id}) in chat {chat_id}")
+
+def build_captcha(chat_id: int, user_id: int, user_name: str, mode: str, question: str, answers: str, timeout: int, send_delay: float = 0):
+    """
+    Return the text, keyboard and correct answers of the captcha for one new member.
+    `send_delay` is the longest the message may wait for the chat's rate limit, which the buttons stay valid for on top of the timeout.
+    """
+    if mode == "multiple":
+        all_answers = answers.split(',')
+        correct_answer = all_answers[0]  # Assuming the first answer is correct
+        random.shuffle(all_answers)
+        captcha_text = f"Welcome {user_name}!\n\nPlease answer this captcha within {timeout} seconds:\n{question}"
+        expires_at = time.time() + send_delay + timeout
+        keyboard = [
+            [InlineKeyboardButton(answer, callback_data=callback_signer.sign(chat_id, user_id, option, expires_at, answer == correct_answer))]
+            for option, answer in enumerate(all_answers)
+        ]
+        return captcha_text, InlineKeyboardMarkup(keyboard), [correct_answer]
+
+    captcha_text = f"Welcome {user_name}!\n\nPlease answer this captcha within {timeout} seconds: {question}"
+    return captcha_text, None, answers.split(',')
+
+async def store_challenges(context: ContextTypes.DEFAULT_TYPE, chat_id: int, challenges, question: str, timeout: int, strict_mode: bool,
+                           sent_at: float, shared_message_id: int = None) -> None:
+    """
+    Store the captchas sent at `sent_at` (monotonic time) with a single upsert and start their deadlines,
+    `timeout` seconds after that time. `challenges` are (member, captcha_message_id, messages_to_delete, correct_answers).
+    """
+    # The upsert replaces the captcha of a member who rejoins while still pending, so the messages of the old one are kept in the new list
+    for member, _, messages_to_delete, _ in challenges:
+        if pending_index.contains(chat_id, member.id):
+            previous = await db.get_pending_captcha(chat_id, member.id)
+            if previous:
+                messages_to_delete.extend(json.loads(previous.get('messages_to_delete') or '[]'))
+            messages_to_delete.extend(release_shared_captcha(chat_id, member.id))
+
     try:
-        await context.bot.delete_message(chat_id=chat_id, message_id=message_id)
-        logger.info(f"Welcome message (ID: {message_id}) deleted in chat {chat_id}")
-    except TelegramError as e:
-        logger.error(f"Error deleting welcome message (ID: {message_id}) in chat {chat_id}: {e}")
+        await db.add_pending_captchas([
+            (member.id, chat_id, correct_answers, captcha_message_id, messages_to_delete, question, member.full_name, timeout)
+            for member, captcha_message_id, messages_to_delete, correct_answers in challenges
+        ])
+    except DatabaseError as e:
+        # Without a row nobody could answer these captchas and no deadline would remove them, so take them back
+        sent = sorted({captcha_message_id for _, captcha_message_id, _, _ in challenges})
+        logger.error(f"Could not store the captchas of {len(challenges)} new members in chat {chat_id}; deleting messages {sent}: {e}")
+        deleter.delete(context.bot, chat_id, sent)
+        return
 
-async def handle_new_member(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    chat_id = update.effective_chat.id
-    join_message_id = update.message.message_id
-    
-    logger.info(f"New member(s) joined chat {chat_id}. Message ID: {join_message_id}")
+    if shared_message_id is not None:
+        add_shared_captcha(chat_id, shared_message_id, [member.id for member, _, _, _ in challenges])
+
+    # The promised time counts from the member's own message, however long the messages sent before it waited
+    remaining = timeout - (time.monotonic() - sent_at)
+    for member, captcha_message_id, _, _ in challenges:
+        pending_index.add(chat_id, member.id)
+        # A member who rejoins starts the new captcha without the wrong presses of the old one
+        choice_attempts.pop((chat_id, member.id), None)
+
+        # Schedule job to kick user if they don't answer in time
+        deadlines.schedule(
+            chat_id,
+            member.id,
+            remaining,
+            data={
+                'user_name': member.full_name,
+                'captcha_message_id': captcha_message_id,
+                'strict_mode': strict_mode
+            }
+        )
+
+        logger.info(f"New member {member.full_name} (ID: {member.id}) joined chat {chat_id}. Captcha sent.")
+
+async def challenge_new_members(context: ContextTypes.DEFAULT_TYPE, chat_id: int, join_message_id: int, new_members) -> None:
+    """
+    Send the captchas for all members of one join update. The captchas whose
+    messages went out together are stored with a single upsert as soon as they
+    are sent, so members answer (and their deadlines start) without waiting for
+    the messages that the chat's rate limit holds back.
+    """
+    # Settings are loaded once per update, not once per member
+    settings = await settings_cache.get_settings(chat_id)
+    timeout = settings['timeout'] if settings and 'timeout' in settings else 60
+    strict_mode = settings['strict_mode'] if settings else False
+
+    # Get custom captcha if exists
+    custom_captcha = await settings_cache.get_captcha(chat_id)
+    if custom_captcha:
+        mode, question, answers = custom_captcha['mode'], custom_captcha['question'], custom_captcha['answers']
+    else:
+        mode, question, answers = "default", "What is 2+2?", "4,four"
+
+    if mode != "multiple" and COMBINE_CAPTCHA_MESSAGES and len(new_members) > 1:
+        # Open-ended captchas have no per-user buttons, so one message can address everybody
+        names = ', '.join(member.full_name for member in new_members)
+        captcha_message = await outbound.call(
+            Priority.MESSAGE,
+            context.bot.send_message,
+            chat_id=chat_id,
+            text=f"Welcome {names}!\n\nPlease answer this captcha within {timeout} seconds: {question}"
+        )
+        sent_at = time.monotonic()
+
+        # Remove the shared message once every deadline has passed, in case it was not removed with its last member
+        context.job_queue.run_once(
+            delete_captcha_messages,
+            timeout + 1,
+            data={'chat_id': chat_id, 'user_id': [member.id for member in new_members], 'messages_to_delete': [captcha_message.message_id]},
+            name=f'delete_captcha_{chat_id}_{captcha_message.message_id}'
+        )
+        logger.info(f"Combined {mode} captcha sent for {len(new_members)} members in chat {chat_id}")
 
-    connection = get_db_connection()
-    if connection is None:
-        logger.error("Failed to connect to the database")
+        # The shared message is not deleted with a single user's messages, but with those of its last pending member
+        challenges = [(member, captcha_message.message_id, [join_message_id], answers.split(',')) for member in new_members]
+        await store_challenges(context, chat_id, challenges, question, timeout, strict_mode, sent_at, captcha_message.message_id)
         return
 
-    cursor = connection.cursor(dictionary=True)
-    
-    for new_member in update.message.new_chat_members:
-        user_id = new_member.id
-        user_name = new_member.full_name
+    # The n-th message of the join may wait n intervals of the per-chat rate
+    send_delay = len(new_members) * 60 / OUTBOUND_CHAT_RATE
+    sends = {}
+    for member in new_members:
+        captcha_text, reply_markup, correct_answers = build_captcha(chat_id, member.id, member.full_name, mode, question, answers, timeout, send_delay)
+        send = asyncio.ensure_future(outbound.call(Priority.MESSAGE, context.bot.send_message, chat_id=chat_id, text=captcha_text, reply_markup=reply_markup))
+        sends[send] = (member, correct_answers)
 
-        logger.info(f"Processing new member: {user_name} (ID: {user_id})")
+    try:
+        while sends:
+            done, _ = await asyncio.wait(sends, return_when=asyncio.FIRST_COMPLETED)
+            sent_at = time.monotonic()
+            challenges = []
+            for send in done:
+                member, correct_answers = sends.pop(send)
+                if isinstance(send.exception(), TelegramError):
+                    logger.error(f"Telegram error sending captcha to {member.full_name} (ID: {member.id}) in chat {chat_id}: {send.exception()}")
+                    continue
+                message = send.result()
+                challenges.append((member, message.message_id, [message.message_id, join_message_id], correct_answers))
+                logger.info(f"{mode.capitalize()} captcha sent for {member.full_name} (ID: {member.id}) in chat {chat_id}")
+            if challenges:
+                await store_challenges(context, chat_id, challenges, question, timeout, strict_mode, sent_at)
+    finally:
+        # Only left after an unexpected error; the scheduler skips the calls of cancelled sends
+        for send in sends:
+            send.cancel()
 
-        try:
-            # Get chat settings
-            cursor.execute("SELECT * FROM chat_settings WHERE chat_id = %s", (chat_id,))
-            settings = cursor.fetchone()
-            timeout = settings['timeout'] if settings and 'timeout' in settings else 60
-            attempt_limit = settings['attempt_limit'] if settings and 'attempt_limit' in settings else 3
-            strict_mode = settings['strict_mode'] if settings else False
-
-            # Get custom captcha if exists
-            cursor.execute("SELECT * FROM captchas WHERE chat_id = %s", (chat_id,))
-            custom_captcha = cursor.fetchone()
-
-            if custom_captcha:
-                mode, question, answers = custom_captcha['mode'], custom_captcha['question'], custom_captcha['answers']
-                if mode == "open":
-                    captcha_text = f"Welcome {user_name}!\n\nPlease answer this captcha within {timeout} seconds: {question}"
-                    correct_answers = answers.split(',')
-                    reply_markup = None
-                    logger.info(f"Open captcha sent for {user_name} (ID: {user_id}) in chat {chat_id}")
-                elif mode == "multiple":
-                    all_answers = answers.split(',')
-                    correct_answer = all_answers[0]  # Assuming the first answer is correct
-                    random.shuffle(all_answers)
-                    captcha_text = f"Welcome {user_name}!\n\nPlease answer this captcha within {timeout} seconds:\n{question}"
-                    keyboard = [[InlineKeyboardButton(answer, callback_data=f"captcha:{user_id}:{answer}")] for answer in all_answers]
-                    reply_markup = InlineKeyboardMarkup(keyboard)
-                    correct_answers = [correct_answer]
-                    logger.info(f"Multiple options captcha sent for {user_name} (ID: {user_id}) in chat {chat_id}")
-            else:
-                question = "What is 2+2?"
-                correct_answers = ["4", "four"]
-                captcha_text = f"Welcome {user_name}!\n\nPlease answer this captcha within {timeout} seconds: {question}"
-                reply_markup = None
-                logger.info(f"Default captcha sent for {user_name} (ID: {user_id}) in chat {chat_id}")
-
-            captcha_message = await context.bot.send_message(chat_id=chat_id, text=captcha_text, reply_markup=reply_markup)
-
-            messages_to_delete = [captcha_message.message_id, join_message_id]
-            cursor.execute("""
-                INSERT INTO pending_captchas (user_id, chat_id, correct_answers, captcha_message_id, messages_to_delete, question)
-                VALUES (%s, %s, %s, %s, %s, %s)
-            """, (user_id, chat_id, ','.join(correct_answers), captcha_message.message_id, json.dumps(messages_to_delete), question))
-            connection.commit()
-
-            # Schedule job to kick user if they don't answer in time
-            if context.job_queue:
-                context.job_queue.run_once(
-                    kick_user, 
-                    timeout, 
-                    data={
-                        'chat_id': chat_id, 
-                        'user_id': user_id, 
-                        'user_name': user_name,
-                        'captcha_message_id': captcha_message.message_id,
-                        'strict_mode': strict_mode
-                    },
-                    name=f'kick_user_{chat_id}_{user_id}'
-                )
-            else:
-                logger.warning(f"Warning: Job queue is not available. Unable to schedule kick job for user {user_id} in chat {chat_id}")
+@timed('handle_new_member')
+async def handle_new_member(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    chat_id = update.effective_chat.id
+    join_message_id = update.message.message_id
+    new_members = update.message.new_chat_members
 
-            logger.info(f"New member {user_name} (ID: {user_id}) joined chat {chat_id}. Captcha sent.")
+    logger.info(f"{len(new_members)} new member(s) joined chat {chat_id}. Message ID: {join_message_id}")
 
-        except Error as e:
+    async def challenge() -> None:
+        try:
+            await challenge_new_members(context, chat_id, join_message_id, new_members)
+        except DatabaseError as e:
             logger.error(f"Database error in handle_new_member: {e}")
         except TelegramError as e:
             logger.error(f"Telegram error in handle_new_member: {e}")
 
-    cursor.close()
-    connection.close()
+    # The per-chat rate limit can hold the captchas of a large join for a minute, so they are sent in a task
+    # the application awaits on stop, and the updates of this and every other chat are handled meanwhile
+    context.application.create_task(challenge(), update=update)
 
-    # Try to delete the join message
-    try:
-        await context.bot.delete_message(chat_id=chat_id, message_id=join_message_id)
-        logger.info(f"Deleted join message (ID: {join_message_id}) in chat {chat_id}")
-    except TelegramError as e:
-        logger.error(f"Error deleting join message: {e}")
+    # Delete the join message with the chat's next batch of deletions
+    deleter.delete(context.bot, chat_id, [join_message_id])
+    logger.info(f"Queued deletion of join message (ID: {join_message_id}) in chat {chat_id}")
         
 async def captcha_timeout(context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle captcha timeout."""
@@ -1058,13 +1143,8 @@ async def delete_captcha_messages(context: ContextTypes.DEFAULT_TYPE) -> None:
     user_id = job.data['user_id']
     messages_to_delete = job.data['messages_to_delete']
 
-    for msg_id in messages_to_delete:
-        try:
-            await context.bot.delete_message(chat_id=chat_id, message_id=msg_id)
-        except TelegramError as e:
-            logger.error(f"Error deleting message {msg_id} in chat {chat_id}: {e}")
-
-    logger.info(f"Deleted all captcha-related messages for user {user_id} in chat {chat_id}")
+    deleter.delete(context.bot, chat_id, messages_to_delete)
+    logger.info(f"Queued deletion of all captcha-related messages for user {user_id} in chat {chat_id}")
 
 async def check_permissions(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Check the bot's permissions in the chat."""
@@ -1157,104 +1237,327 @@ async def handle_edited_command(update: Update, context: ContextTypes.DEFAULT_TY
         await get_attempt_limit(update, context)
     # Add other commands here if needed
 
+@timed('cleanup_pending_captchas')
 async def cleanup_pending_captchas(context: ContextTypes.DEFAULT_TYPE) -> None:
-    connection = get_db_connection()
-    if connection is None:
-        logger.error("Failed to connect to the database during cleanup")
-        return
-
-    cursor = connection.cursor()
+    """
+    Purge pending captchas older than two hours that have no live deadline.
+    Rows are read and deleted in chunks of CLEANUP_BATCH_SIZE, one statement
+    each, yielding to the event loop between chunks.
+    """
+    two_hours_ago = datetime.now() - timedelta(hours=2)
+    live = deadlines.live_keys()
+    after = None
+    purged = 0
     try:
-        # Delete entries older than 2 hours
-        two_hours_ago = datetime.now() - timedelta(hours=2)
-        
-        # First, select the entries to be deleted
-        cursor.execute("SELECT user_id, chat_id FROM pending_captchas WHERE created_at < %s", (two_hours_ago,))
-        old_entries = cursor.fetchall()
-        
-        for user_id, chat_id in old_entries:
-            # Check if there's an active kick job for this user
-            job_name = f'kick_user_{chat_id}_{user_id}'
-            jobs = context.job_queue.get_jobs_by_name(job_name)
-            
-            if not jobs:  # If no active kick job, it's safe to delete
-                cursor.execute("DELETE FROM pending_captchas WHERE user_id = %s", (user_id,))
-                logger.info(f"Cleaned up pending captcha for user {user_id} in chat {chat_id}")
-        
-        connection.commit()
-    except Error as e:
+        while True:
+            chunk = await db.get_stale_pending_captchas(two_hours_ago, CLEANUP_BATCH_SIZE, after)
+            if not chunk:
+                break
+            after = tuple(chunk[-1])
+            stale_entries = [(chat_id, user_id) for chat_id, user_id in chunk if (chat_id, user_id) not in live and owns_chat(chat_id)]
+            await db.delete_pending_captchas(stale_entries)
+            for chat_id, user_id in stale_entries:
+                forget_pending_captcha(chat_id, user_id)
+            purged += len(stale_entries)
+            if len(chunk) < CLEANUP_BATCH_SIZE:
+                break
+            await asyncio.sleep(0)
+    except DatabaseError as e:
         logger.error(f"Error during cleanup of pending captchas: {e}")
-    finally:
-        cursor.close()
-        connection.close()
+    if purged:
+        logger.info(f"Cleaned up {purged} stale pending captchas")
 
 import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+async def restore_deadlines(rows) -> None:
+    """Reschedule the kick deadlines persisted in pending_captchas, given as the rows of get_pending_deadlines()."""
+    restored = []
+    for row in rows:
+        settings = await settings_cache.get_settings(row['chat_id'])
+        restored.append((row['chat_id'], row['user_id'], row['remaining'], {
+            'user_name': row['user_name'] or "User",
+            'captcha_message_id': row['captcha_message_id'],
+            'strict_mode': settings['strict_mode'] if settings else False
+        }))
+    deadlines.restore(restored)
+
+async def adopt_expired_deadlines(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Fire the deadlines that expired on other replicas, which drop them. The
+    sweep looks at rows that expired one to three sweep intervals ago and skips
+    every deadline this replica has scheduled, is kicking or has fired within
+    the last four intervals, so no kick (successful or not) is run twice.
+    """
+    try:
+        rows = await db.get_expired_pending_captchas(DEADLINE_SWEEP_INTERVAL, 3 * DEADLINE_SWEEP_INTERVAL)
+    except DatabaseError as e:
+        logger.error(f"Database error in adopt_expired_deadlines: {e}")
+        return
+    adopted = 0
+    for row in rows:
+        chat_id, user_id = row['chat_id'], row['user_id']
+        if not owns_chat(chat_id) or deadlines.contains(chat_id, user_id) or deadlines.recently_fired(chat_id, user_id):
+            continue
+        settings = await settings_cache.get_settings(chat_id)
+        deadlines.schedule(chat_id, user_id, 0, {
+            'user_name': row['user_name'] or "User",
+            'captcha_message_id': row['captcha_message_id'],
+            'strict_mode': settings['strict_mode'] if settings else False
+        })
+        adopted += 1
+    if adopted:
+        logger.info(f"Adopted {adopted} expired captcha deadlines of other replicas")
+
+async def load_pending_captchas() -> None:
+    """Load the pending captchas and deadlines of every replica, before this replica receives updates as the leader."""
+    pending_index.rebuild(key for key in await db.get_pending_captcha_keys() if owns_chat(key[0]))
+    choice_attempts.clear()
+    logger.info(f"Loaded {len(pending_index)} pending captchas")
+    rows = [row for row in await db.get_pending_deadlines() if owns_chat(row['chat_id'])]
+    # A captcha message answered by several pending members is a shared one; a shared one with a single member
+    # left cannot be told from that member's own message and is not tracked
+    shared_captchas.clear()
+    shared_captcha_of.clear()
+    members = defaultdict(list)
+    for row in rows:
+        members[(row['chat_id'], row['captcha_message_id'])].append(row['user_id'])
+    for (chat_id, message_id), user_ids in members.items():
+        if message_id is not None and len(user_ids) > 1:
+            add_shared_captcha(chat_id, message_id, user_ids)
+    await restore_deadlines(rows)
+
+def receive_updates(application: Application):
+    """Return the coroutine functions that start and stop receiving updates by long polling or webhook, depending on BOT_MODE."""
+    # Only subscribe to the update types some handler uses
+    allowed_updates = allowed_update_types(application)
+
+    async def start() -> None:
+        logger.info(f"Subscribing to updates: {', '.join(allowed_updates)}")
+        if BOT_MODE == 'webhook':
+            logger.info(f"Listening for webhook updates on {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}")
+            await application.updater.start_webhook(
+                listen=WEBHOOK_LISTEN,
+                port=WEBHOOK_PORT,
+                url_path=WEBHOOK_PATH,
+                webhook_url=WEBHOOK_URL,
+                secret_token=WEBHOOK_SECRET,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+                allowed_updates=allowed_updates
+            )
+        else:
+            # Bounded, so a takeover that cannot reach Telegram fails and steps down instead of retrying forever
+            await application.updater.start_polling(allowed_updates=allowed_updates, bootstrap_retries=3)
+
+    async def stop() -> None:
+        if application.updater.running:
+            logger.info("Stopped receiving updates")
+            await application.updater.stop()
+
+    return start, stop
+
+async def post_init(application: Application) -> None:
+    """Load the state that has to be in memory before the first update is handled."""
+    await db.migrate()
+    deadlines.bind(application.job_queue, kick_user, active=lambda: election.is_leader)
+    # Only the leader receives updates; it takes over the pending captchas and deadlines of every replica first
+    election.on_elected(load_pending_captchas)
+    if application.updater is not None:
+        start_receiving, stop_receiving = receive_updates(application)
+        election.on_elected(start_receiving)
+        election.on_deposed(stop_receiving)
+    await election.start()
+
+    metrics.PENDING_CAPTCHAS.set_function(lambda: len(pending_index))
+    metrics.JOB_QUEUE_DEPTH.set_function(lambda: len(application.job_queue.jobs()))
+    metrics.OUTBOUND_QUEUE_DEPTH.set_function(outbound.queue_depth)
+    loop_lag.start()
+    loop_watchdog.start()
+    health.start(application.bot)
+    for server in (metrics_server, health_server):
+        if server is not None:
+            server.route('/healthz', health.healthz)
+            await server.start()
+
+async def post_shutdown(application: Application) -> None:
+    for server in (metrics_server, health_server):
+        if server is not None:
+            await server.stop()
+    await health.stop()
+    await election.stop()
+    await deadlines.stop()
+    await loop_watchdog.stop()
+    await loop_lag.stop()
+    # Queued deletions go out before the scheduler that sends them stops
+    await deleter.stop()
+    await outbound.stop()
+
+async def serve_application(application: Application) -> None:
+    """Run the application until SIGINT or SIGTERM; post_init starts receiving updates once this replica leads."""
+    stopping = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopping.set)
+
+    await application.initialize()
+    try:
+        await application.post_init(application)
+        await application.start()
+        await stopping.wait()
+        logger.info("Received a stop signal. Shutting down gracefully...")
+    finally:
+        if application.updater.running:
+            await application.updater.stop()
+        if application.running:
+            await application.stop()
+        await application.post_shutdown(application)
+        await application.shutdown()
+
+def run_application(application: Application) -> None:
+    asyncio.run(serve_application(application))
+
+def build_application(updater: bool = True) -> Application:
+    """Create the Application with every handler and periodic job registered."""
+    builder = (
+        Application.builder()
+        .token(TELEGRAM_BOT_TOKEN)
+        # Record the latency and status code of every Bot API request
+        .request(InstrumentedRequest(connection_pool_size=256))
+        .get_updates_request(InstrumentedRequest())
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if not updater:
+        # Workers of the multi-process mode receive their updates from the ingress process
+        builder = builder.updater(None)
+    application = builder.build()
+
+    # Set up the job queue
+    job_queue = application.job_queue
+
+    # Command handlers
+    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("settimeout", set_timeout))
+    application.add_handler(CommandHandler("gettimeout", get_timeout))
+    application.add_handler(CommandHandler("setattemptlimit", set_attempt_limit))
+    application.add_handler(CommandHandler("getattemptlimit", get_attempt_limit))
+    application.add_handler(CommandHandler("setopencaptcha", set_open_captcha))
+    application.add_handler(CommandHandler("setmultiplechoice", set_multiple_captcha))
+    application.add_handler(CommandHandler("setwelcomemessage", set_welcome_message))
+    application.add_handler(CommandHandler("getwelcomemessage", get_welcome_message))
+    application.add_handler(CommandHandler("setstrictmode", set_strict_mode))
+    application.add_handler(CommandHandler("unsetstrictmode", unset_strict_mode))
+    application.add_handler(CommandHandler("getallsettings", get_all_settings))
+    application.add_handler(CommandHandler("checkpermissions", check_permissions))
+    application.add_handler(CommandHandler("setwelcometimeout", set_welcome_timeout))
+    application.add_handler(CommandHandler("getwelcometimeout", get_welcome_timeout))
+
+    # Keep the administrator cache current
+    application.add_handler(ChatMemberHandler(track_chat_admins, ChatMemberHandler.CHAT_MEMBER))
+
+    # Handle new chat members
+    application.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, handle_new_member))
+
+    # Handle captcha button callbacks; "captcha:" buttons sent before the signed tokens are answered as no longer valid
+    application.add_handler(CallbackQueryHandler(button_callback, pattern=f"^({CALLBACK_PREFIX}|captcha:)"))
+
+    # Handle text messages (for open-ended captchas), only from users with a pending captcha in that chat
+    application.add_handler(MessageHandler(
+        filters.UpdateType.MESSAGE & filters.TEXT & ~filters.COMMAND & PendingChallengeFilter(pending_index),
+        check_captcha_answer
+    ))
+
+    # Handle edited messages for commands
+    application.add_handler(MessageHandler(filters.UpdateType.EDITED_MESSAGE & filters.COMMAND, handle_edited_command))
+
+    # Periodic jobs run on the elected leader only, so replicas do not duplicate their work
+    if job_queue:
+        job_queue.run_repeating(election.leader_only(cleanup_pending_captchas), interval=3600, first=10)
+        job_queue.run_repeating(election.leader_only(adopt_expired_deadlines), interval=DEADLINE_SWEEP_INTERVAL,
+                                first=DEADLINE_SWEEP_INTERVAL)
+        # Collect group statistics in STATISTICS_SLOTS slots spread over the day
+        slot_length = 86400 / STATISTICS_SLOTS
+        now = datetime.now(pytz.UTC)
+        seconds_since_midnight = now.hour * 3600 + now.minute * 60 + now.second
+        job_queue.run_repeating(election.leader_only(update_group_statistics), interval=slot_length,
+                                first=slot_length - seconds_since_midnight % slot_length)
+    else:
+        logger.warning("Warning: Job queue is not available. Scheduled tasks will not run.")
+
+    return application
+
+def run_worker(index: int, count: int, updates) -> None:
+    """Entry point of a worker process of the multi-process mode."""
+    configure_shard(index, count)
+    logger.info(f"Worker {index} of {count} is starting...")
+    try:
+        asyncio.run(serve_updates(build_application(updater=False), updates))
+    finally:
+        db.close()
+
+def run_workers() -> None:
+    """Receive updates in this process and handle them in WORKERS worker processes, sharded by chat."""
+    allowed_updates = allowed_update_types(build_application())
+    logger.info(f"Routing updates to {WORKERS} workers; subscribing to {', '.join(allowed_updates)}")
+    webhook = None
+    if BOT_MODE == 'webhook':
+        webhook = {
+            'listen': WEBHOOK_LISTEN,
+            'port': WEBHOOK_PORT,
+            'url_path': WEBHOOK_PATH,
+            'webhook_url': WEBHOOK_URL,
+            'secret_token': WEBHOOK_SECRET,
+            'max_connections': WEBHOOK_MAX_CONNECTIONS
+        }
+
+    # Spawned, not forked, so no worker inherits the ingress' threads or connections
+    pool = WorkerPool(multiprocessing.get_context('spawn'), run_worker, WORKERS, queue_size=WORKER_QUEUE_SIZE)
+    bot = Bot(TELEGRAM_BOT_TOKEN, request=InstrumentedRequest(), get_updates_request=InstrumentedRequest())
+
+    async def ingress():
+        # The lease table must exist before the first election
+        await db.migrate()
+        # The ingress competes for the lease and only runs the workers while it leads
+        await route_updates(bot, pool, allowed_updates, election, webhook=webhook)
+
+    try:
+        asyncio.run(ingress())
+    finally:
+        pool.stop()
+
+def check_webhook_settings() -> None:
+    """Exit when webhook mode lacks its public URL or secret token."""
+    if BOT_MODE != 'webhook':
+        return
+    # Without a URL the listen address would be registered as the webhook, and without a secret anybody could post updates
+    missing = [name for name, value in (('WEBHOOK_URL', WEBHOOK_URL), ('WEBHOOK_SECRET', WEBHOOK_SECRET)) if not value]
+    if missing:
+        logger.error(f"Webhook mode requires {' and '.join(missing)} to be set")
+        sys.exit(1)
+
 def main() -> None:
     """Start the bot."""
     logger.info("Bot is starting...")
+    check_webhook_settings()
     try:
-        # Create the Application and pass it your bot's token.
-        application = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
-
         logging.getLogger('httpx').setLevel(logging.INFO)
 
-        # Set up the job queue
-        job_queue = application.job_queue
-
-        # Command handlers
-        application.add_handler(CommandHandler("start", start))
-        application.add_handler(CommandHandler("help", help_command))
-        application.add_handler(CommandHandler("settimeout", set_timeout))
-        application.add_handler(CommandHandler("gettimeout", get_timeout))
-        application.add_handler(CommandHandler("setattemptlimit", set_attempt_limit))
-        application.add_handler(CommandHandler("getattemptlimit", get_attempt_limit))
-        application.add_handler(CommandHandler("setopencaptcha", set_open_captcha))
-        application.add_handler(CommandHandler("setmultiplechoice", set_multiple_captcha))
-        application.add_handler(CommandHandler("setwelcomemessage", set_welcome_message))
-        application.add_handler(CommandHandler("getwelcomemessage", get_welcome_message))
-        application.add_handler(CommandHandler("setstrictmode", set_strict_mode))
-        application.add_handler(CommandHandler("unsetstrictmode", unset_strict_mode))
-        application.add_handler(CommandHandler("getallsettings", get_all_settings))
-        application.add_handler(CommandHandler("checkpermissions", check_permissions))
-        application.add_handler(CommandHandler("setwelcometimeout", set_welcome_timeout))
-        application.add_handler(CommandHandler("getwelcometimeout", get_welcome_timeout))
-
-        # Handle new chat members
-        application.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, handle_new_member))
-
-        # Handle captcha button callbacks
-        application.add_handler(CallbackQueryHandler(button_callback, pattern="^captcha:"))
-
-        # Handle text messages (for open-ended captchas)
-        application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, check_captcha_answer))
-
-        # Handle edited messages for commands
-        application.add_handler(MessageHandler(filters.UpdateType.EDITED_MESSAGE & filters.COMMAND, handle_edited_command))
-
-        # Schedule the cleanup job to run every hour
-        if job_queue:
-            job_queue.run_repeating(cleanup_pending_captchas, interval=3600, first=10)
-            # Schedule the group statistics update job to run once per day
-            job_queue.run_daily(update_group_statistics, time=dt_time(0, 0, tzinfo=pytz.UTC))
+        if WORKERS > 1:
+            run_workers()
         else:
-            logger.warning("Warning: Job queue is not available. Scheduled tasks will not run.")
-
-        # Start the Bot
-        logger.info("Starting the bot...")
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
-        
-        # Watchdog
-        job_queue.run_repeating(watchdog, interval=900)  # Check every 15 minutes
+            application = build_application()
 
-        application.run_polling(allowed_updates=Update.ALL_TYPES)
+            # Start the Bot
+            logger.info("Starting the bot...")
+            run_application(application)
 
     except Exception as e:
         logger.error(f"Error in main loop: {e}")
     finally:
         logger.info("Bot is shutting down...")
+        db.close()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
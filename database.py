@@ -0,0 +1,371 @@
+"""
+MySQL storage backend of the captcha bot.
+
+mysql.connector is a blocking driver, so every statement runs on a dedicated
+thread pool and is awaited by the handlers. A slow MySQL round-trip in one
+group therefore no longer stalls the event loop that serves every other chat.
+Connections are borrowed from a bounded pool instead of being opened per call.
+"""
+import asyncio
+import json
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+
+import mysql.connector
+from mysql.connector import Error, InterfaceError, OperationalError
+
+from metrics import DB_QUERY_SECONDS, statement_name
+from schema import migrate
+from storage import SETTINGS_COLUMNS, DatabaseError, Storage
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionPool:
+    """
+    Bounded, thread-safe pool of MySQL connections.
+
+    At most `size` connections exist at once. acquire() waits up to
+    `acquire_timeout` seconds for a free slot, connections idle for longer than
+    `ping_after` seconds are pinged before reuse, and connections older than
+    `recycle` seconds are closed and replaced.
+    """
+
+    def __init__(self, connect, size=8, acquire_timeout=10, recycle=3600, ping_after=30):
+        self._connect = connect
+        self.size = size
+        self._acquire_timeout = acquire_timeout
+        self._recycle = recycle
+        self._ping_after = ping_after
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = queue.LifoQueue()  # (connection, created_at, last_used)
+        self._lock = threading.Lock()
+        self._open = 0
+        self._closed = False
+
+    def _new_connection(self):
+        try:
+            connection = self._connect()
+        except Error as e:
+            raise DatabaseError(f"Error connecting to MySQL database: {e}") from e
+        with self._lock:
+            self._open += 1
+        return connection, time.monotonic()
+
+    def _discard(self, connection):
+        with self._lock:
+            self._open -= 1
+        try:
+            connection.close()
+        except Error:
+            pass
+
+    def _is_usable(self, connection, created_at, last_used):
+        now = time.monotonic()
+        if now - created_at > self._recycle:
+            return False
+        if now - last_used > self._ping_after:
+            try:
+                connection.ping(reconnect=False)
+            except Error:
+                return False
+        return True
+
+    def acquire(self):
+        if self._closed:
+            raise DatabaseError("Connection pool is closed")
+        if not self._slots.acquire(timeout=self._acquire_timeout):
+            raise DatabaseError(f"Timed out after {self._acquire_timeout}s waiting for a database connection")
+        try:
+            while True:
+                try:
+                    connection, created_at, last_used = self._idle.get_nowait()
+                except queue.Empty:
+                    return self._new_connection()
+                if self._is_usable(connection, created_at, last_used):
+                    return connection, created_at
+                self._discard(connection)
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def release(self, connection, created_at, broken=False):
+        try:
+            if broken or self._closed or time.monotonic() - created_at > self._recycle:
+                self._discard(connection)
+            else:
+                self._idle.put((connection, created_at, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        connection, created_at = self.acquire()
+        broken = False
+        try:
+            yield connection
+        except (InterfaceError, OperationalError):
+            broken = True
+            raise
+        except Error:
+            try:
+                connection.rollback()
+            except Error:
+                broken = True
+            raise
+        finally:
+            self.release(connection, created_at, broken)
+
+    def stats(self):
+        with self._lock:
+            open_connections = self._open
+        return {'size': self.size, 'open': open_connections, 'idle': self._idle.qsize()}
+
+    def close(self):
+        self._closed = True
+        while True:
+            try:
+                connection, _, _ = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            self._discard(connection)
+
+
+class Database(Storage):
+    def __init__(self, host, port, database, user, password, pool_size=8, pool_timeout=10, pool_recycle=3600):
+        self._config = {
+            'host': host,
+            'port': port,
+            'database': database,
+            'user': user,
+            'password': password,
+        }
+        self.pool = ConnectionPool(self._connect, size=pool_size, acquire_timeout=pool_timeout, recycle=pool_recycle)
+        # One worker per pooled connection, so a query never waits for a thread while a connection is free
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='db')
+
+    def _connect(self):
+        return mysql.connector.connect(**self._config)
+
+    def _run(self, statements, fetch=None, dictionary=False):
+        """
+        Execute (query, params) pairs on a worker thread inside one transaction.
+        Returns the result of the last statement: a row, a list of rows or a rowcount.
+        """
+        try:
+            with self.pool.connection() as connection:
+                cursor = connection.cursor(dictionary=dictionary)
+                try:
+                    for query, params in statements:
+                        with DB_QUERY_SECONDS.time(statement=statement_name(query)):
+                            if isinstance(params, list):
+                                cursor.executemany(query, params)
+                            else:
+                                cursor.execute(query, params)
+                    if fetch == 'one':
+                        result = cursor.fetchone()
+                    elif fetch == 'all':
+                        result = cursor.fetchall()
+                    else:
+                        result = cursor.rowcount
+                    # Also ends read transactions, so a reused connection never sees a stale snapshot
+                    connection.commit()
+                    return result
+                finally:
+                    cursor.close()
+        except Error as e:
+            raise DatabaseError(str(e)) from e
+
+    async def _submit(self, statements, fetch=None, dictionary=False):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(self._run, statements, fetch, dictionary))
+
+    async def fetchone(self, query, params=(), dictionary=True):
+        return await self._submit([(query, params)], fetch='one', dictionary=dictionary)
+
+    async def fetchall(self, query, params=(), dictionary=True):
+        return await self._submit([(query, params)], fetch='all', dictionary=dictionary)
+
+    async def execute(self, query, params=()):
+        """Execute a write statement and commit it. A list of params runs executemany()."""
+        return await self._submit([(query, params)])
+
+    async def execute_many(self, statements):
+        """Execute several write statements in a single transaction."""
+        return await self._submit(statements)
+
+    def _run_function(self, function):
+        try:
+            with self.pool.connection() as connection:
+                result = function(connection)
+                connection.commit()
+                return result
+        except Error as e:
+            raise DatabaseError(str(e)) from e
+
+    async def run(self, function):
+        """
+        Run `function(connection)` on a worker thread with one pooled connection and commit.
+        For work that needs a single session, such as holding a named lock.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(self._run_function, function))
+
+    async def migrate(self):
+        return await migrate(self)
+
+    async def ping(self):
+        await self.fetchone("SELECT 1", dictionary=False)
+
+    def stats(self):
+        return {'backend': 'mysql', 'pool': self.pool.stats()}
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.pool.close()
+
+    # Chat settings
+
+    async def get_chat_settings(self, chat_id):
+        return await self.fetchone("SELECT * FROM chat_settings WHERE chat_id = %s", (chat_id,))
+
+    async def set_chat_setting(self, chat_id, column, value):
+        if column not in SETTINGS_COLUMNS:
+            raise ValueError(f"Unknown chat setting: {column}")
+        await self.execute(
+            f"INSERT INTO chat_settings (chat_id, {column}) VALUES (%s, %s) ON DUPLICATE KEY UPDATE {column} = %s",
+            (chat_id, value, value)
+        )
+
+    async def get_chat_ids(self):
+        rows = await self.fetchall("SELECT DISTINCT chat_id FROM chat_settings", dictionary=False)
+        return [chat_id for (chat_id,) in rows]
+
+    # Captchas
+
+    async def get_captcha(self, chat_id):
+        return await self.fetchone("SELECT * FROM captchas WHERE chat_id = %s", (chat_id,))
+
+    async def set_captcha(self, chat_id, mode, question, answers):
+        await self.execute(
+            "INSERT INTO captchas (chat_id, mode, question, answers) VALUES (%s, %s, %s, %s) ON DUPLICATE KEY UPDATE mode = %s, question = %s, answers = %s",
+            (chat_id, mode, question, answers, mode, question, answers)
+        )
+
+    # Pending captchas
+
+    async def get_pending_captcha(self, chat_id, user_id):
+        return await self.fetchone("SELECT * FROM pending_captchas WHERE chat_id = %s AND user_id = %s", (chat_id, user_id))
+
+    async def add_pending_captchas(self, captchas):
+        """
+        Insert or replace pending captchas with one multi-row upsert. Each item is
+        (user_id, chat_id, correct_answers, captcha_message_id, messages_to_delete, question, user_name, timeout).
+        """
+        if not captchas:
+            return
+        placeholders = ', '.join(["(%s, %s, %s, %s, %s, %s, %s, NOW() + INTERVAL %s SECOND)"] * len(captchas))
+        params = []
+        for user_id, chat_id, correct_answers, captcha_message_id, messages_to_delete, question, user_name, timeout in captchas:
+            params.extend((user_id, chat_id, ','.join(correct_answers), captcha_message_id, json.dumps(messages_to_delete),
+                           question, user_name, timeout))
+        # A member who rejoins while still pending gets a fresh captcha instead of failing the whole join
+        await self.execute(
+            "INSERT INTO pending_captchas (user_id, chat_id, correct_answers, captcha_message_id, messages_to_delete, question, user_name, expires_at) "
+            f"VALUES {placeholders} "
+            "ON DUPLICATE KEY UPDATE correct_answers = VALUES(correct_answers), captcha_message_id = VALUES(captcha_message_id), "
+            "messages_to_delete = VALUES(messages_to_delete), question = VALUES(question), attempts = 0, "
+            "user_name = VALUES(user_name), created_at = CURRENT_TIMESTAMP, expires_at = VALUES(expires_at)",
+            tuple(params)
+        )
+
+    async def update_pending_captcha(self, chat_id, user_id, attempts, messages_to_delete=None):
+        if messages_to_delete is None:
+            await self.execute("UPDATE pending_captchas SET attempts = %s WHERE chat_id = %s AND user_id = %s",
+                               (attempts, chat_id, user_id))
+        else:
+            await self.execute("UPDATE pending_captchas SET attempts = %s, messages_to_delete = %s WHERE chat_id = %s AND user_id = %s",
+                               (attempts, json.dumps(messages_to_delete), chat_id, user_id))
+
+    async def delete_pending_captcha(self, chat_id, user_id):
+        await self.execute("DELETE FROM pending_captchas WHERE chat_id = %s AND user_id = %s", (chat_id, user_id))
+
+    async def get_stale_pending_captchas(self, created_before, limit, after=None):
+        """
+        Return up to `limit` (chat_id, user_id) of pending captchas created before
+        `created_before`, in key order and after the key `after` when given.
+        """
+        if after is None:
+            return await self.fetchall(
+                "SELECT chat_id, user_id FROM pending_captchas WHERE created_at < %s ORDER BY chat_id, user_id LIMIT %s",
+                (created_before, limit), dictionary=False
+            )
+        return await self.fetchall(
+            "SELECT chat_id, user_id FROM pending_captchas WHERE created_at < %s AND (chat_id, user_id) > (%s, %s) "
+            "ORDER BY chat_id, user_id LIMIT %s",
+            (created_before, after[0], after[1], limit), dictionary=False
+        )
+
+    async def delete_pending_captchas(self, keys):
+        """Delete the pending captchas with the given (chat_id, user_id) keys with one statement."""
+        if not keys:
+            return
+        placeholders = ', '.join(["(%s, %s)"] * len(keys))
+        params = tuple(value for key in keys for value in key)
+        await self.execute(f"DELETE FROM pending_captchas WHERE (chat_id, user_id) IN ({placeholders})", params)
+
+    async def get_pending_deadlines(self):
+        """
+        Return every pending captcha with the seconds left until its deadline (negative when overdue).
+        Rows created before expires_at existed fall back to created_at plus the chat timeout.
+        """
+        return await self.fetchall("""
+            SELECT p.chat_id, p.user_id, p.user_name, p.captcha_message_id,
+                   TIMESTAMPDIFF(SECOND, NOW(), COALESCE(p.expires_at, p.created_at + INTERVAL COALESCE(s.timeout, 60) SECOND)) AS remaining
+            FROM pending_captchas p
+            LEFT JOIN chat_settings s ON s.chat_id = p.chat_id
+        """)
+
+    async def get_expired_pending_captchas(self, min_age, max_age):
+        return await self.fetchall("""
+            SELECT chat_id, user_id, user_name, captcha_message_id
+            FROM pending_captchas
+            WHERE expires_at > NOW() - INTERVAL %s SECOND AND expires_at <= NOW() - INTERVAL %s SECOND
+        """, (max_age, min_age))
+
+    async def get_pending_captcha_keys(self):
+        """Return (chat_id, user_id) of every pending captcha."""
+        return await self.fetchall("SELECT chat_id, user_id FROM pending_captchas", dictionary=False)
+
+    # Leases
+
+    async def acquire_lease(self, name, holder, ttl):
+        # holder is assigned first, so the expires_at assignment sees whether this holder won the lease
+        row = await self._submit([
+            ("""
+                INSERT INTO leases (name, holder, expires_at) VALUES (%s, %s, NOW(3) + INTERVAL %s SECOND)
+                ON DUPLICATE KEY UPDATE
+                    holder = IF(holder = VALUES(holder) OR expires_at <= NOW(3), VALUES(holder), holder),
+                    expires_at = IF(holder = VALUES(holder), VALUES(expires_at), expires_at)
+            """, (name, holder, ttl)),
+            ("SELECT holder FROM leases WHERE name = %s", (name,))
+        ], fetch='one')
+        return row is not None and row[0] == holder
+
+    async def release_lease(self, name, holder):
+        await self.execute("DELETE FROM leases WHERE name = %s AND holder = %s", (name, holder))
+
+    # Group statistics
+
+    async def add_group_statistics(self, rows):
+        """Insert (chat_id, member_count) rows with one multi-row INSERT."""
+        if not rows:
+            return
+        placeholders = ', '.join(["(%s, %s)"] * len(rows))
+        params = tuple(value for row in rows for value in row)
+        await self.execute(f"INSERT INTO group_statistics (chat_id, member_count) VALUES {placeholders}", params)
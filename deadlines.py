@@ -0,0 +1,169 @@
+"""
+Kick deadlines of pending captchas.
+
+Deadlines are persisted as pending_captchas.expires_at and kept in memory in
+a timing wheel: time is divided into ticks of `tick` seconds and every
+deadline is put in the bucket of the tick it expires in, indexed by
+(chat_id, user_id). Scheduling and cancelling are O(1) dictionary
+operations, and a single repeating JobQueue job advances the wheel and fires
+the expired deadlines in batches, instead of the job queue holding one job
+per challenged user. After a restart the deadlines are reloaded from the
+database instead of being lost.
+
+With several replicas, only the leader fires deadlines (see leader.py);
+the other replicas drop theirs as they expire and the leader picks them up
+from the database.
+"""
+import asyncio
+import logging
+import math
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class DeadlineScheduler:
+    def __init__(self, tick=1.0, batch_size=100, overdue_batch_size=20, overdue_batch_interval=1.0, fired_memory=60):
+        """
+        Deadlines fire up to `tick` seconds late, each callback in its own
+        task, with at most `batch_size` callbacks running at a time. Deadlines
+        that already expired while the bot was down are fired in batches of
+        `overdue_batch_size`, one batch every `overdue_batch_interval` seconds.
+        Fired deadlines are remembered for `fired_memory` seconds (see
+        recently_fired()).
+        """
+        self.tick = tick
+        self._batch_size = batch_size
+        self._overdue_batch_size = overdue_batch_size
+        self._overdue_batch_interval = overdue_batch_interval
+        self._callback = None
+        self._active = None
+        self._job = None
+        self._semaphore = asyncio.Semaphore(batch_size)
+        self._tasks = set()   # Running callbacks, referenced so they are not garbage-collected
+        self._firing = set()  # (chat_id, user_id) of the deadlines whose callback has not finished yet
+        self._fired_memory = fired_memory
+        self._fired = {}      # (chat_id, user_id) -> monotonic time it fired, oldest first
+        self._buckets = {}    # tick number -> {(chat_id, user_id): data}
+        self._deadlines = {}  # (chat_id, user_id) -> tick number
+        self._cursor = self._tick_number(time.monotonic())  # First tick that has not been fired yet
+
+    def _tick_number(self, when):
+        return math.floor(when / self.tick)
+
+    def bind(self, job_queue, callback, active=None):
+        """
+        Advance the wheel with a repeating job on `job_queue` and call
+        `callback(context, chat_id, user_id, data)` for every expired deadline.
+        While `active()` returns False, expired deadlines are dropped instead.
+        """
+        self._callback = callback
+        self._active = active
+        if job_queue is None:
+            logger.warning("Job queue is not available. Captcha deadlines will not fire.")
+            return
+        self._job = job_queue.run_repeating(self._advance, interval=self.tick, first=self.tick, name='captcha_deadlines')
+
+    def schedule(self, chat_id, user_id, delay, data):
+        """Schedule (or reschedule) the deadline of a user in a chat `delay` seconds from now."""
+        key = (chat_id, user_id)
+        self.cancel(chat_id, user_id)
+        # Round up, so a deadline never fires early; a tick that was already fired is not revisited
+        tick = max(math.ceil((time.monotonic() + max(delay, 0)) / self.tick), self._cursor)
+        self._buckets.setdefault(tick, {})[key] = data
+        self._deadlines[key] = tick
+
+    def cancel(self, chat_id, user_id):
+        key = (chat_id, user_id)
+        tick = self._deadlines.pop(key, None)
+        if tick is None:
+            return False
+        bucket = self._buckets[tick]
+        del bucket[key]
+        if not bucket:
+            del self._buckets[tick]
+        return True
+
+    def contains(self, chat_id, user_id):
+        """Whether a deadline is scheduled or its callback is still running."""
+        return (chat_id, user_id) in self._deadlines or (chat_id, user_id) in self._firing
+
+    def recently_fired(self, chat_id, user_id):
+        """Whether the deadline fired within the last `fired_memory` seconds, whatever the outcome of its callback."""
+        return (chat_id, user_id) in self._fired
+
+    def live_keys(self):
+        return set(self._deadlines) | self._firing
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def pop_expired(self, now=None):
+        """Remove and return (chat_id, user_id, data) of every deadline that expired by `now`."""
+        real_current = self._tick_number(time.monotonic())
+        current = real_current if now is None else self._tick_number(now)
+        expired = []
+        if current - self._cursor < len(self._buckets):
+            ticks = range(self._cursor, current + 1)
+        else:
+            # After a long pause, visiting the occupied buckets is cheaper than every elapsed tick
+            ticks = sorted(tick for tick in self._buckets if tick <= current)
+        for tick in ticks:
+            bucket = self._buckets.pop(tick, None)
+            if bucket:
+                for key, data in bucket.items():
+                    del self._deadlines[key]
+                    expired.append((key[0], key[1], data))
+        # Ticks ahead of the clock stay open for new deadlines
+        self._cursor = max(self._cursor, min(current, real_current) + 1)
+        return expired
+
+    async def _fire(self, context, chat_id, user_id, data):
+        try:
+            async with self._semaphore:
+                await self._callback(context, chat_id, user_id, data)
+        except Exception as e:
+            logger.error(f"Error handling the captcha deadline of user {user_id} in chat {chat_id}: {e}")
+        finally:
+            self._firing.discard((chat_id, user_id))
+
+    async def _advance(self, context):
+        """
+        Start a task for every expired deadline and return at once, so a slow
+        batch of kicks never makes the repeating job skip the following ticks.
+        """
+        expired = self.pop_expired()
+        if expired and self._active is not None and not self._active():
+            logger.debug(f"Dropped {len(expired)} expired captcha deadlines; the leader fires them")
+            return
+        now = time.monotonic()
+        while self._fired and next(iter(self._fired.values())) < now - self._fired_memory:
+            del self._fired[next(iter(self._fired))]
+        loop = asyncio.get_running_loop()
+        for deadline in expired:
+            self._firing.add(deadline[:2])
+            self._fired.pop(deadline[:2], None)
+            self._fired[deadline[:2]] = now
+            task = loop.create_task(self._fire(context, *deadline))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def stop(self):
+        """Wait for the callbacks that are still running."""
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    def restore(self, deadlines):
+        """
+        Schedule persisted deadlines, given as (chat_id, user_id, remaining_seconds, data).
+        Overdue deadlines are spread out in rate-limited batches instead of all firing at once.
+        """
+        overdue = 0
+        for chat_id, user_id, remaining, data in deadlines:
+            if remaining > 0:
+                self.schedule(chat_id, user_id, remaining, data)
+            else:
+                batch = overdue // self._overdue_batch_size
+                self.schedule(chat_id, user_id, batch * self._overdue_batch_interval, data)
+                overdue += 1
+        logger.info(f"Restored {len(deadlines)} captcha deadlines ({overdue} overdue)")
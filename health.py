@@ -0,0 +1,154 @@
+"""
+Liveness checks of the bot: event loop, Bot API and database.
+
+LoopWatchdog runs on its own thread, so it still sees the event loop when a
+handler blocks it (e.g. with a synchronous MySQL call), and logs the stack of
+the loop thread at that moment. HealthMonitor periodically calls getMe and
+pings the database, and serves the combined state as /healthz for
+systemd or load-balancer probes.
+"""
+import asyncio
+import json
+import logging
+import sys
+import threading
+import time
+import traceback
+
+from metrics import Counter, Gauge, registry
+
+logger = logging.getLogger(__name__)
+
+LOOP_STALLS = registry.register(Counter(
+    'captcha_bot_event_loop_stalls_total', "Times the event loop was blocked for longer than the watchdog threshold."))
+HEALTH = registry.register(Gauge(
+    'captcha_bot_health', "Result of the last health check (1 healthy, 0 failing).", ('check',)))
+
+
+class LoopWatchdog:
+    """
+    Detects an event loop that is blocked for more than `threshold` seconds.
+
+    The heartbeat is the `last_beat` of the metrics.LoopLagSampler running on
+    the loop; a daemon thread checks it every `interval` seconds. When the
+    heartbeat is late, the stack of the loop thread (which shows the blocking
+    handler) is logged once per stall.
+    """
+
+    def __init__(self, sampler, threshold=1.0, interval=0.25):
+        self._sampler = sampler
+        self.threshold = threshold
+        self.interval = interval
+        self.stalls = 0
+        self.longest_stall = 0.0
+        self._loop_thread_id = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        """Start watching the running event loop; the sampler must be started on it."""
+        self._loop_thread_id = threading.get_ident()
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._watch, name='loop-watchdog', daemon=True)
+        self._thread.start()
+
+    def current_stall(self):
+        """Seconds the loop has been blocked beyond the sampler's interval."""
+        return max(time.monotonic() - self._sampler.last_beat - self._sampler.interval, 0.0)
+
+    def _watch(self):
+        reported_heartbeat = None
+        while not self._stopped.wait(self.interval):
+            stall = self.current_stall()
+            if stall <= self.threshold:
+                continue
+            self.longest_stall = max(self.longest_stall, stall)
+            heartbeat = self._sampler.last_beat
+            if heartbeat == reported_heartbeat:
+                continue
+            reported_heartbeat = heartbeat
+            self.stalls += 1
+            LOOP_STALLS.inc()
+            frame = sys._current_frames().get(self._loop_thread_id)
+            stack = ''.join(traceback.format_stack(frame)) if frame is not None else "unavailable\n"
+            logger.warning(f"Event loop blocked for {stall:.2f}s; stack of the loop thread:\n{stack}")
+
+    async def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout=self.interval * 2)
+            self._thread = None
+
+
+class HealthMonitor:
+    """
+    Checks the Bot API with getMe and the database with a ping every
+    `interval` seconds. A check that has not succeeded within `grace`
+    seconds (three intervals by default) makes the bot unhealthy.
+    """
+
+    def __init__(self, db, watchdog, interval=60, timeout=10, grace=None):
+        self._db = db
+        self._watchdog = watchdog
+        self.interval = interval
+        self.timeout = timeout
+        self.grace = grace if grace is not None else interval * 3
+        self._last_ok = {}      # check -> monotonic time of the last success
+        self._last_error = {}   # check -> message of the last failure
+        self._task = None
+
+    def start(self, bot):
+        self._task = asyncio.get_running_loop().create_task(self._run(bot))
+
+    async def _check(self, name, coroutine):
+        try:
+            await asyncio.wait_for(coroutine, timeout=self.timeout)
+        except Exception as e:
+            self._last_error[name] = f"{type(e).__name__}: {e}"
+            HEALTH.set(0, check=name)
+            logger.error(f"Health check {name} failed: {self._last_error[name]}")
+        else:
+            self._last_ok[name] = time.monotonic()
+            self._last_error.pop(name, None)
+            HEALTH.set(1, check=name)
+
+    async def _run(self, bot):
+        while True:
+            await asyncio.gather(
+                self._check('bot_api', bot.get_me()),
+                self._check('database', self._db.ping())
+            )
+            await asyncio.sleep(self.interval)
+
+    def status(self):
+        now = time.monotonic()
+        checks = {}
+        for name in ('bot_api', 'database'):
+            last_ok = self._last_ok.get(name)
+            checks[name] = {
+                'ok': last_ok is not None and now - last_ok <= self.grace,
+                'seconds_since_ok': round(now - last_ok, 1) if last_ok is not None else None,
+                'error': self._last_error.get(name)
+            }
+        checks['database'].update(self._db.stats())
+        stall = self._watchdog.current_stall()
+        checks['event_loop'] = {
+            'ok': stall <= self._watchdog.threshold,
+            'stalls': self._watchdog.stalls,
+            'longest_stall': round(self._watchdog.longest_stall, 3)
+        }
+        return {'ok': all(check['ok'] for check in checks.values()), 'checks': checks}
+
+    def healthz(self):
+        """Handler of the /healthz route: 200 when every check passes, 503 otherwise."""
+        status = self.status()
+        return (200 if status['ok'] else 503), 'application/json', json.dumps(status) + '\n'
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,233 @@
+"""
+Leader election between replicas of the bot.
+
+Replicas share the database, so the periodic jobs (cleanup, statistics) and
+the firing of captcha deadlines must run on one of them only. The replicas
+compete for a named lease row in the database: the holder renews it every
+`renew_interval` seconds and keeps it for `ttl` seconds after its last
+renewal. Expiry is computed by the database clock, so clock skew between
+nodes does not matter. A leader that stops releases the lease, so another
+replica takes over within one renew interval; a leader that crashes or loses
+the database is replaced once its lease expires.
+
+Only the leader receives updates (it starts polling or its webhook server
+when elected and stops when it loses the lease), because the index of
+pending captchas and the counts of wrong button presses are kept in the
+memory of the process that handles a chat's updates.
+
+A replica only considers itself the leader until `ttl` seconds after it sent
+its last successful renewal, which is never later than the database expiry,
+so two replicas never act as leader at the same time. A renewal is given up
+when it has not returned by then, and a timer steps the replica down at that
+moment whether or not a renewal is still pending. Taking over and stepping
+down run in tasks of their own, one after the other, so a slow takeover does
+not hold up the renewals; a takeover that fails steps down and releases the
+lease, and the replica competes for it again at its next renewal.
+"""
+import asyncio
+import functools
+import logging
+import os
+import socket
+import time
+import uuid
+
+from metrics import Gauge, registry
+from storage import DatabaseError
+
+logger = logging.getLogger(__name__)
+
+LEADER = registry.register(Gauge(
+    'captcha_bot_leader', "Whether this replica holds the lease of the singleton jobs (1) or not (0).", ('lease',)))
+
+
+class LeaderElection:
+    def __init__(self, db, name, ttl=10, renew_interval=None, holder=None):
+        self._db = db
+        self.name = name
+        self.ttl = ttl
+        self.renew_interval = renew_interval if renew_interval is not None else ttl / 3
+        self.holder = holder or f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self._valid_until = 0.0
+        self._leader = False
+        self._term = 0  # Incremented on every step-down, so a renewal sent before it is not taken as a new lease
+        self._on_elected = []
+        self._on_deposed = []
+        self._task = None
+        self._expiry = None     # Timer handle of the step-down at _valid_until
+        self._takeover = None   # Running takeover task
+        self._transitions = asyncio.Lock()
+        self._transition_tasks = set()
+        LEADER.set(0, lease=name)
+
+    @property
+    def is_leader(self):
+        return self._leader and time.monotonic() < self._valid_until
+
+    def on_elected(self, callback):
+        """Await `callback()` every time this replica becomes the leader; an exception makes it step down."""
+        self._on_elected.append(callback)
+
+    def on_deposed(self, callback):
+        """Await `callback()` every time this replica loses the lease."""
+        self._on_deposed.append(callback)
+
+    def leader_only(self, callback):
+        """Wrap a job callback so it only runs on the leader."""
+        @functools.wraps(callback)
+        async def wrapper(context):
+            if self.is_leader:
+                return await callback(context)
+        return wrapper
+
+    async def _renew(self):
+        started = time.monotonic()
+        term = self._term
+        # A renewal that returns after the lease could have expired proves nothing, so it is not waited for
+        timeout = self._valid_until - started if self._leader else self.ttl
+        try:
+            acquired = await asyncio.wait_for(self._db.acquire_lease(self.name, self.holder, self.ttl), timeout=max(timeout, 0))
+        except asyncio.TimeoutError:
+            logger.error(f"Renewing the {self.name} lease took longer than {timeout:.1f}s")
+            acquired = False
+        except DatabaseError as e:
+            logger.error(f"Could not renew the {self.name} lease: {e}")
+            acquired = False
+        if term != self._term:
+            # Stepped down while the renewal was pending, after which the lease was released
+            return
+        if not acquired:
+            if self._leader and time.monotonic() >= self._valid_until:
+                self._lose()
+            return
+
+        self._valid_until = started + self.ttl
+        if self._expiry is not None:
+            self._expiry.cancel()
+        self._expiry = asyncio.get_running_loop().call_later(self._valid_until - time.monotonic(), self._expire)
+        if not self._leader:
+            self._leader = True
+            LEADER.set(1, lease=self.name)
+            logger.info(f"Became the leader of {self.name} as {self.holder}")
+            self._takeover = self._transition(self._take_over())
+
+    def _expire(self):
+        self._expiry = None
+        if self._leader and time.monotonic() >= self._valid_until:
+            self._lose()
+
+    def _lose(self):
+        """Step down because the lease lapsed: whatever the takeover has not finished is cancelled."""
+        logger.warning(f"Lost the {self.name} lease")
+        self._step_down()
+        if self._takeover is not None:
+            self._takeover.cancel()
+        self._transition(self._run_deposed())
+
+    def _step_down(self):
+        self._term += 1
+        self._leader = False
+        self._valid_until = 0.0
+        LEADER.set(0, lease=self.name)
+        if self._expiry is not None:
+            self._expiry.cancel()
+            self._expiry = None
+
+    def _transition(self, coroutine):
+        """Run a takeover or step-down in a task, after the ones started before it."""
+        async def run():
+            try:
+                async with self._transitions:
+                    await coroutine
+            finally:
+                # A task cancelled before its turn never started the coroutine
+                coroutine.close()
+        task = asyncio.get_running_loop().create_task(run())
+        self._transition_tasks.add(task)
+        task.add_done_callback(self._transition_tasks.discard)
+        return task
+
+    async def _take_over(self):
+        term = self._term
+        try:
+            for callback in self._on_elected:
+                await callback()
+        except Exception as e:
+            logger.error(f"Error taking over as the leader of {self.name}, stepping down: {e}")
+            if term != self._term:
+                return
+            self._step_down()
+            await self._run_deposed()
+            await self._release()
+
+    async def _run_deposed(self):
+        for callback in self._on_deposed:
+            try:
+                await callback()
+            except Exception as e:
+                logger.error(f"Error stepping down as the leader of {self.name}: {e}")
+
+    async def _release(self):
+        try:
+            await asyncio.wait_for(self._db.release_lease(self.name, self.holder), timeout=self.ttl)
+            logger.info(f"Released the {self.name} lease")
+        except (DatabaseError, asyncio.TimeoutError) as e:
+            logger.error(f"Could not release the {self.name} lease: {e!r}")
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.renew_interval)
+            await self._renew()
+
+    async def start(self):
+        """Try to become the leader once, then keep competing for the lease in the background."""
+        await self._renew()
+        if not self._leader:
+            logger.info(f"Following; another replica holds the {self.name} lease")
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._takeover is not None:
+            self._takeover.cancel()
+        if self._transition_tasks:
+            await asyncio.gather(*self._transition_tasks, return_exceptions=True)
+        if self._leader:
+            self._step_down()
+            await self._release()
+
+
+class StandingLeader:
+    """
+    Leadership decided by another process: the worker processes of the
+    multi-process mode only run while their ingress process holds the lease,
+    so they act as the leader from start to stop.
+    """
+
+    is_leader = True
+
+    def __init__(self, name):
+        self.name = name
+        self._on_elected = []
+
+    def on_elected(self, callback):
+        self._on_elected.append(callback)
+
+    def on_deposed(self, callback):
+        pass
+
+    def leader_only(self, callback):
+        return callback
+
+    async def start(self):
+        for callback in self._on_elected:
+            await callback()
+
+    async def stop(self):
+        pass
@@ -0,0 +1,339 @@
+"""
+Prometheus-style metrics of the bot's hot paths.
+
+Metrics live in a process-wide registry and are rendered in the Prometheus
+text exposition format by a small HTTP server on the event loop, so no
+client library is needed:
+
+    curl http://127.0.0.1:9464/metrics
+
+Histograms and counters may be updated from the database worker threads, so
+every metric guards its samples with a lock.
+"""
+import asyncio
+import functools
+import logging
+import re
+import threading
+import time
+
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+# Seconds; covers in-memory handlers up to slow MySQL round-trips and Bot API calls
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class _Metric:
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self._samples())
+        return lines
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            values = dict(self._values)
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {value}" for key, value in sorted(values.items())]
+
+
+class Gauge(_Metric):
+    """A value that is set explicitly, or read from `function()` at scrape time."""
+
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), function=None):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+        self._function = function
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def set_function(self, function):
+        """Read the value from `function()` at scrape time; it may return {label values: value} for labelled gauges."""
+        self._function = function
+
+    def _samples(self):
+        if self._function is not None:
+            try:
+                value = self._function()
+            except Exception as e:
+                logger.warning(f"Could not read gauge {self.name}: {e}")
+                return []
+            values = value if isinstance(value, dict) else {(): value}
+            values = {key if isinstance(key, tuple) else (key,): value for key, value in values.items()}
+        else:
+            with self._lock:
+                values = dict(self._values)
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {value}" for key, value in sorted(values.items())]
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}  # label values -> [count per bucket..., count above the last bucket, sum]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[len(self.buckets)] += 1
+            counts[-1] += value
+
+    def time(self, **labels):
+        """Context manager that observes the seconds spent in its block."""
+        return _Timer(self, labels)
+
+    def _samples(self):
+        with self._lock:
+            values = {key: list(counts) for key, counts in self._values.items()}
+        lines = []
+        for key, counts in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', bound)])} {cumulative}")
+            total = cumulative + counts[len(self.buckets)]
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', '+Inf')])} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {counts[-1]}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self._histogram = histogram
+        self._labels = labels
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._histogram.observe(time.perf_counter() - self._started, **self._labels)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+HANDLER_SECONDS = registry.register(Histogram(
+    'captcha_bot_handler_seconds', "Time spent in update handlers and jobs.", ('handler',)))
+HANDLER_ERRORS = registry.register(Counter(
+    'captcha_bot_handler_errors_total', "Exceptions raised by update handlers and jobs.", ('handler',)))
+DB_QUERY_SECONDS = registry.register(Histogram(
+    'captcha_bot_db_query_seconds', "Execution time of database statements.", ('statement',)))
+API_REQUEST_SECONDS = registry.register(Histogram(
+    'captcha_bot_api_request_seconds', "Latency of Telegram Bot API requests.", ('method',),
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)))
+API_RESPONSES = registry.register(Counter(
+    'captcha_bot_api_responses_total', "Telegram Bot API responses by HTTP status code ('error' when no response was received).",
+    ('method', 'code')))
+PENDING_CAPTCHAS = registry.register(Gauge(
+    'captcha_bot_pending_captchas', "Captchas waiting for an answer."))
+JOB_QUEUE_DEPTH = registry.register(Gauge(
+    'captcha_bot_job_queue_depth', "Jobs scheduled on the job queue."))
+OUTBOUND_QUEUE_DEPTH = registry.register(Gauge(
+    'captcha_bot_outbound_queue_depth', "Bot API calls waiting in the outbound scheduler.", ('priority',)))
+LOOP_LAG_SECONDS = registry.register(Histogram(
+    'captcha_bot_event_loop_lag_seconds', "Delay of the event loop in running a callback that was due.",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)))
+
+
+def timed(name):
+    """Decorator recording the latency (and exceptions) of an async handler or job under `name`."""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return await func(*args, **kwargs)
+            except Exception:
+                HANDLER_ERRORS.inc(handler=name)
+                raise
+            finally:
+                HANDLER_SECONDS.observe(time.perf_counter() - started, handler=name)
+        return wrapper
+    return decorator
+
+
+_STATEMENT_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE|TABLE)\s+`?(\w+)', re.IGNORECASE)
+
+
+@functools.lru_cache(maxsize=256)
+def statement_name(query):
+    """Low-cardinality label of a SQL statement: its verb and first table, e.g. 'SELECT pending_captchas'."""
+    verb = query.split(None, 1)[0].upper() if query.strip() else ''
+    match = _STATEMENT_TABLE.search(query)
+    return f"{verb} {match.group(1)}" if match else verb
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """HTTPXRequest that records the latency and status code of every Bot API request."""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        code = 'error'
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+            return code, payload
+        finally:
+            API_REQUEST_SECONDS.observe(time.perf_counter() - started, method=api_method)
+            API_RESPONSES.inc(method=api_method, code=code)
+
+
+class LoopLagSampler:
+    """
+    Measures how late the event loop runs a callback scheduled every `interval`
+    seconds. The most recent lag is kept in `last_lag`, and the monotonic time
+    the callback last ran in `last_beat`, which health.LoopWatchdog watches.
+    """
+
+    def __init__(self, interval=0.5):
+        self.interval = interval
+        self.last_lag = 0.0
+        self.last_beat = time.monotonic()
+        self._task = None
+
+    def start(self):
+        if self._task is None:
+            self.last_beat = time.monotonic()
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.last_beat = time.monotonic()
+            self.last_lag = max(loop.time() - expected, 0.0)
+            LOOP_LAG_SECONDS.observe(self.last_lag)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+class MetricsServer:
+    """
+    Minimal HTTP/1.0 server on the event loop. GET /metrics returns the
+    registry (unless `registry` is None); other paths can be added with route().
+    """
+
+    def __init__(self, host='127.0.0.1', port=9464, registry=registry):
+        self.host = host
+        self.port = port
+        self._routes = {}
+        if registry is not None:
+            self._routes['/metrics'] = lambda: (200, 'text/plain; version=0.0.4; charset=utf-8', registry.render())
+        self._server = None
+
+    def route(self, path, handler):
+        """Serve `path` with `handler()`, which returns (status, content_type, body) or a coroutine of it."""
+        self._routes[path] = handler
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info(f"Serving {', '.join(sorted(self._routes))} on http://{self.host}:{self.port}")
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            # Discard the headers
+            while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.decode('latin-1').split()
+            path = parts[1].split('?', 1)[0] if len(parts) >= 2 else ''
+            handler = self._routes.get(path)
+            if len(parts) < 2 or parts[0] != 'GET':
+                status, content_type, body = 405, 'text/plain', 'Method not allowed\n'
+            elif handler is None:
+                status, content_type, body = 404, 'text/plain', 'Not found\n'
+            else:
+                result = handler()
+                if asyncio.iscoroutine(result):
+                    result = await result
+                status, content_type, body = result
+            body = body.encode('utf-8')
+            reason = {200: 'OK', 404: 'Not Found', 405: 'Method Not Allowed', 503: 'Service Unavailable'}.get(status, '')
+            writer.write(f"HTTP/1.0 {status} {reason}\r\nContent-Type: {content_type}\r\n"
+                         f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode('latin-1') + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        except Exception as e:
+            logger.error(f"Error serving metrics request: {e}")
+        finally:
+            writer.close()
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
@@ -0,0 +1,275 @@
+"""
+Central scheduler for outbound Telegram Bot API calls.
+
+Every call is queued with a priority and dispatched while honouring the
+global request rate and the per-chat message rate, so a raid does not run
+into flood limits. Kicks and bans are sent before messages, and messages
+before cosmetic deletions. Calls rejected with RetryAfter are put back at the
+front of their queue and the chat (or the whole bot) is paused for the time
+Telegram asks for.
+"""
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from enum import IntEnum
+
+from telegram.error import RetryAfter
+
+logger = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+    KICK = 0      # ban_chat_member / unban_chat_member
+    MESSAGE = 1   # send_message and edits
+    DELETE = 2    # delete_message(s)
+    BACKGROUND = 3  # periodic reads such as get_chat_member_count
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate  # tokens per second
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self, now):
+        """Seconds until a token is available (0 when one is available now)."""
+        self._refill(now)
+        if self._tokens >= 1:
+            return 0
+        return (1 - self._tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self._tokens -= 1
+
+    def is_full(self, now):
+        self._refill(now)
+        return self._tokens >= self.capacity
+
+
+class _Call:
+    __slots__ = ('priority', 'chat_id', 'func', 'kwargs', 'future', 'attempts')
+
+    def __init__(self, priority, chat_id, func, kwargs, future):
+        self.priority = priority
+        self.chat_id = chat_id
+        self.func = func
+        self.kwargs = kwargs
+        self.future = future
+        self.attempts = 0
+
+
+class OutboundScheduler:
+    def __init__(self, global_rate=30, chat_rate_per_minute=20, max_in_flight=16, max_retries=3):
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chat_rate = chat_rate_per_minute / 60
+        self._chat_capacity = chat_rate_per_minute
+        self._chat_buckets = {}
+        self._paused_until = {}  # chat_id (None for the whole bot) -> monotonic time
+        self._max_retries = max_retries
+        self._in_flight = None
+        self._max_in_flight = max_in_flight
+        # priority -> chat_id -> deque of calls; chats are served round-robin within a priority
+        self._queues = {priority: OrderedDict() for priority in Priority}
+        self._wakeup = None
+        self._dispatcher = None
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+
+    def _ensure_started(self):
+        if self._dispatcher is None or self._dispatcher.done():
+            self._wakeup = asyncio.Event()
+            self._in_flight = asyncio.Semaphore(self._max_in_flight)
+            self._dispatcher = asyncio.get_running_loop().create_task(self._dispatch_loop())
+
+    async def call(self, priority, func, **kwargs):
+        """
+        Queue the Bot API coroutine function `func(**kwargs)` and return its result.
+        The chat is taken from the `chat_id` keyword argument.
+        """
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        self._enqueue(_Call(priority, kwargs.get('chat_id'), func, kwargs, future))
+        return await future
+
+    def _enqueue(self, call, front=False):
+        queue = self._queues[call.priority].setdefault(call.chat_id, deque())
+        if front:
+            queue.appendleft(call)
+        else:
+            queue.append(call)
+        self._wakeup.set()
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self._chat_rate, self._chat_capacity)
+        return bucket
+
+    def _chat_delay(self, call, now):
+        delay = max(self._paused_until.get(call.chat_id, 0), self._paused_until.get(None, 0)) - now
+        if call.priority == Priority.MESSAGE and call.chat_id is not None:
+            delay = max(delay, self._chat_bucket(call.chat_id).delay(now))
+        return max(delay, 0)
+
+    def _next_call(self, now):
+        """Pop the first call that may be sent now, or return the seconds until one may be."""
+        wait = None
+        for priority in Priority:
+            chats = self._queues[priority]
+            for chat_id in list(chats):
+                queue = chats[chat_id]
+                delay = self._chat_delay(queue[0], now)
+                if delay == 0:
+                    call = queue.popleft()
+                    if queue:
+                        chats.move_to_end(chat_id)
+                    else:
+                        del chats[chat_id]
+                    return call, None
+                wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    async def _dispatch_loop(self):
+        while True:
+            now = time.monotonic()
+            global_delay = self._global.delay(now)
+            if global_delay:
+                await asyncio.sleep(global_delay)
+                continue
+
+            call, wait = self._next_call(now)
+            if call is None:
+                self._prune(now)
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            self._global.take(now)
+            if call.priority == Priority.MESSAGE and call.chat_id is not None:
+                self._chat_bucket(call.chat_id).take(now)
+
+            await self._in_flight.acquire()
+            asyncio.get_running_loop().create_task(self._execute(call))
+
+    def _prune(self, now):
+        """Forget refilled per-chat buckets and expired pauses, so idle chats cost no memory."""
+        for chat_id in [chat_id for chat_id, bucket in self._chat_buckets.items() if bucket.is_full(now)]:
+            del self._chat_buckets[chat_id]
+        for chat_id in [chat_id for chat_id, until in self._paused_until.items() if until <= now]:
+            del self._paused_until[chat_id]
+
+    async def _execute(self, call):
+        try:
+            if call.future.cancelled():
+                return
+            call.attempts += 1
+            try:
+                result = await call.func(**call.kwargs)
+            except RetryAfter as e:
+                retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, 'total_seconds') else e.retry_after
+                self._paused_until[call.chat_id] = time.monotonic() + retry_after
+                if call.attempts <= self._max_retries:
+                    self.retried += 1
+                    logger.warning(f"Flood limit hit in chat {call.chat_id}, retrying {call.func.__name__} in {retry_after}s")
+                    self._enqueue(call, front=True)
+                else:
+                    self.failed += 1
+                    if not call.future.cancelled():
+                        call.future.set_exception(e)
+            except Exception as e:
+                self.failed += 1
+                if not call.future.cancelled():
+                    call.future.set_exception(e)
+            else:
+                self.sent += 1
+                if not call.future.cancelled():
+                    call.future.set_result(result)
+        finally:
+            self._in_flight.release()
+
+    def queue_depth(self):
+        """Number of queued calls per priority."""
+        return {priority.name.lower(): sum(len(queue) for queue in self._queues[priority].values()) for priority in Priority}
+
+    def stats(self):
+        return {'queued': self.queue_depth(), 'sent': self.sent, 'retried': self.retried, 'failed': self.failed}
+
+    async def stop(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+
+
+class DeletionBatcher:
+    """
+    Coalesces message deletions per chat.
+
+    Message ids queued for a chat within `window` seconds are deleted together
+    with deleteMessages (up to 100 ids per request), sent through the
+    scheduler at DELETE priority. Ids that no longer exist are skipped by
+    Telegram, so guessed ids can be included freely.
+    """
+
+    MAX_IDS_PER_REQUEST = 100
+
+    def __init__(self, scheduler, window=0.5):
+        self._scheduler = scheduler
+        self._window = window
+        self._pending = {}  # chat_id -> (bot, set of message ids)
+        self._timers = {}   # chat_id -> handle of the scheduled flush
+        self._tasks = set()  # Running flushes, referenced so they are not garbage-collected
+        self.flushed_requests = 0
+
+    def delete(self, bot, chat_id, message_ids):
+        """
+        Queue `message_ids` in `chat_id` for the next batch and return at once.
+        The batch owns the request; a failure is logged, not raised to the caller.
+        """
+        message_ids = [message_id for message_id in message_ids if message_id is not None]
+        if not message_ids:
+            return
+        batch = self._pending.get(chat_id)
+        if batch is None:
+            batch = self._pending[chat_id] = (bot, set())
+            self._timers[chat_id] = asyncio.get_running_loop().call_later(self._window, self._start_flush, chat_id)
+        batch[1].update(message_ids)
+
+    def _start_flush(self, chat_id):
+        self._timers.pop(chat_id, None)
+        task = asyncio.get_running_loop().create_task(self._flush(chat_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def stop(self):
+        """Flush the queued deletions now and wait for every flush; the scheduler must still be running."""
+        for chat_id, timer in list(self._timers.items()):
+            timer.cancel()
+            self._start_flush(chat_id)
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def _flush(self, chat_id):
+        bot, message_ids = self._pending.pop(chat_id)
+        message_ids = sorted(message_ids)
+        for start in range(0, len(message_ids), self.MAX_IDS_PER_REQUEST):
+            chunk = message_ids[start:start + self.MAX_IDS_PER_REQUEST]
+            self.flushed_requests += 1
+            try:
+                await self._scheduler.call(Priority.DELETE, bot.delete_messages, chat_id=chat_id, message_ids=chunk)
+            except Exception as e:
+                logger.error(f"Error deleting messages {chunk} in chat {chat_id}: {e}")
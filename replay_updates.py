@@ -0,0 +1,92 @@
+"""
+Post recorded Telegram updates to the bot's webhook endpoint.
+
+Used to exercise a bot started with BOT_MODE=webhook locally. The input file
+holds one update per line (JSON lines) or a JSON array of updates, e.g. as
+returned by getUpdates.
+
+    python3 replay_updates.py updates.jsonl --url http://127.0.0.1:8443/telegram --secret $WEBHOOK_SECRET
+
+The bot handles the replayed updates like real ones, so replies and kicks are
+sent to the chats referenced in the recording.
+"""
+import argparse
+import json
+import statistics
+import sys
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+
+def load_updates(path):
+    with open(path, encoding='utf-8') as f:
+        content = f.read().strip()
+    try:
+        updates = json.loads(content)
+    except json.JSONDecodeError:
+        return [json.loads(line) for line in content.splitlines() if line.strip()]
+    # getUpdates responses wrap the updates in {"ok": true, "result": [...]}
+    if isinstance(updates, dict):
+        return updates['result'] if 'result' in updates else [updates]
+    return updates
+
+
+def post_update(url, secret, update):
+    request = urllib.request.Request(url, data=json.dumps(update).encode('utf-8'), method='POST')
+    request.add_header('Content-Type', 'application/json')
+    if secret:
+        request.add_header('X-Telegram-Bot-Api-Secret-Token', secret)
+    started = time.monotonic()
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            status = response.status
+    except urllib.error.HTTPError as e:
+        status = e.code
+    except urllib.error.URLError as e:
+        status = f"error: {e.reason}"
+    return status, time.monotonic() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Post recorded updates to the bot's webhook.")
+    parser.add_argument('file', help="JSON lines or JSON array of Telegram updates")
+    parser.add_argument('--url', default='http://127.0.0.1:8443/telegram', help="Webhook URL of the bot")
+    parser.add_argument('--secret', help="Value of WEBHOOK_SECRET")
+    parser.add_argument('--concurrency', type=int, default=1, help="Updates posted in parallel")
+    parser.add_argument('--rate', type=float, default=0, help="Updates per second (0 posts as fast as possible)")
+    parser.add_argument('--renumber', action='store_true', help="Rewrite update_id so replaying the same file again is not ignored")
+    args = parser.parse_args()
+
+    updates = load_updates(args.file)
+    if args.renumber:
+        base = int(time.time())
+        for i, update in enumerate(updates):
+            update['update_id'] = base + i
+
+    started = time.monotonic()
+    futures = []
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for i, update in enumerate(updates):
+            if args.rate:
+                delay = started + i / args.rate - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            futures.append(executor.submit(post_update, args.url, args.secret, update))
+    results = [future.result() for future in futures]
+    elapsed = time.monotonic() - started
+
+    statuses = Counter(status for status, _ in results)
+    latencies = sorted(latency for _, latency in results)
+    print(f"Posted {len(results)} updates in {elapsed:.2f}s ({len(results) / elapsed if elapsed else 0:.1f}/s)")
+    print(f"Status codes: {dict(statuses)}")
+    if latencies:
+        print(f"Latency p50: {statistics.median(latencies) * 1000:.1f}ms, "
+              f"p99: {latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000:.1f}ms")
+    return 0 if set(statuses) <= {200} else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
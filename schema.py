@@ -0,0 +1,200 @@
+"""
+Versioned schema of the bot's MySQL database.
+
+migrate() runs at startup. It applies, in order, every migration whose
+version is not yet recorded in schema_migrations, while holding a named lock
+so that several instances starting at once do not race. Migrations are
+written to be safe on databases that were set up by hand before this runner
+existed: they create what is missing and leave what is already there.
+"""
+import logging
+
+logger = logging.getLogger(__name__)
+
+MIGRATION_LOCK = 'captcha_bot_migrations'
+MIGRATION_LOCK_TIMEOUT = 60
+
+
+def _columns(cursor, table):
+    cursor.execute(
+        "SELECT COLUMN_NAME FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s",
+        (table,)
+    )
+    return {column for (column,) in cursor.fetchall()}
+
+
+def _indexes(cursor, table):
+    """Return {index_name: (unique, 'col1,col2')} of a table."""
+    cursor.execute("""
+        SELECT INDEX_NAME, NON_UNIQUE, GROUP_CONCAT(COLUMN_NAME ORDER BY SEQ_IN_INDEX)
+        FROM information_schema.STATISTICS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+        GROUP BY INDEX_NAME, NON_UNIQUE
+    """, (table,))
+    return {name: (not non_unique, columns) for name, non_unique, columns in cursor.fetchall()}
+
+
+def _add_column(cursor, table, column, definition):
+    if column not in _columns(cursor, table):
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+def _add_index(cursor, table, name, columns):
+    if columns not in (index_columns for _, index_columns in _indexes(cursor, table).values()):
+        cursor.execute(f"ALTER TABLE {table} ADD INDEX {name} ({columns})")
+
+
+def create_tables(cursor):
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS chat_settings (
+            chat_id BIGINT NOT NULL PRIMARY KEY,
+            timeout INT NOT NULL DEFAULT 60,
+            attempt_limit INT NOT NULL DEFAULT 3,
+            welcome_message TEXT NULL,
+            strict_mode BOOLEAN NOT NULL DEFAULT FALSE,
+            welcome_timeout INT NOT NULL DEFAULT 10
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS captchas (
+            chat_id BIGINT NOT NULL PRIMARY KEY,
+            mode VARCHAR(16) NOT NULL,
+            question TEXT NOT NULL,
+            answers TEXT NOT NULL
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS pending_captchas (
+            chat_id BIGINT NOT NULL,
+            user_id BIGINT NOT NULL,
+            correct_answers TEXT NOT NULL,
+            captcha_message_id BIGINT NULL,
+            messages_to_delete TEXT NOT NULL,
+            question TEXT NULL,
+            attempts INT NOT NULL DEFAULT 0,
+            user_name VARCHAR(255) NULL,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            expires_at TIMESTAMP NULL,
+            PRIMARY KEY (chat_id, user_id)
+        )
+    """)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS group_statistics (
+            id BIGINT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+            chat_id BIGINT NOT NULL,
+            member_count INT NOT NULL,
+            recorded_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+
+
+def add_pending_deadline_columns(cursor):
+    """Columns used to restore kick deadlines after a restart."""
+    _add_column(cursor, 'pending_captchas', 'user_name', "VARCHAR(255) NULL")
+    _add_column(cursor, 'pending_captchas', 'expires_at', "TIMESTAMP NULL")
+
+
+def key_pending_captchas_by_chat(cursor):
+    """
+    Key pending_captchas by (chat_id, user_id), so a user can be challenged in
+    several chats at once and lookups use a chat-scoped index.
+    """
+    unique_indexes = {name: columns for name, (unique, columns) in _indexes(cursor, 'pending_captchas').items() if unique}
+    if 'chat_id,user_id' in unique_indexes.values():
+        return
+
+    statements = []
+    for name, columns in unique_indexes.items():
+        if columns == 'user_id':
+            # A user_id-only key would still reject a second chat
+            statements.append("DROP PRIMARY KEY" if name == 'PRIMARY' else f"DROP INDEX `{name}`")
+
+    if 'PRIMARY' in unique_indexes and unique_indexes['PRIMARY'] != 'user_id':
+        statements.append("ADD UNIQUE KEY idx_pending_chat_user (chat_id, user_id)")
+    else:
+        statements.append("ADD PRIMARY KEY (chat_id, user_id)")
+
+    # Without a user_id key, duplicates may exist; keep the newest row of each pair
+    if 'user_id' not in unique_indexes.values():
+        cursor.execute("""
+            DELETE older FROM pending_captchas older
+            JOIN pending_captchas newer
+              ON newer.chat_id = older.chat_id AND newer.user_id = older.user_id AND newer.created_at > older.created_at
+        """)
+
+    cursor.execute(f"ALTER TABLE pending_captchas {', '.join(statements)}")
+
+
+def add_hot_path_indexes(cursor):
+    """Indexes for cleanup_pending_captchas, deadline restore and the statistics queries."""
+    _add_index(cursor, 'pending_captchas', 'idx_pending_created_at', 'created_at')
+    _add_index(cursor, 'pending_captchas', 'idx_pending_expires_at', 'expires_at')
+    _add_column(cursor, 'group_statistics', 'recorded_at', "TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP")
+    _add_index(cursor, 'group_statistics', 'idx_statistics_chat_recorded', 'chat_id,recorded_at')
+
+
+def create_leases(cursor):
+    """Lease rows of the leader election between replicas (see leader.py)."""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS leases (
+            name VARCHAR(191) NOT NULL PRIMARY KEY,
+            holder VARCHAR(255) NOT NULL,
+            expires_at TIMESTAMP(3) NOT NULL
+        )
+    """)
+
+
+# (version, name, function); append new migrations, never reorder or edit applied ones
+MIGRATIONS = [
+    (1, 'create tables', create_tables),
+    (2, 'pending captcha deadline columns', add_pending_deadline_columns),
+    (3, 'key pending captchas by chat and user', key_pending_captchas_by_chat),
+    (4, 'hot path indexes', add_hot_path_indexes),
+    (5, 'leases', create_leases),
+]
+
+
+def _migrate(connection):
+    cursor = connection.cursor()
+    try:
+        cursor.execute("SELECT GET_LOCK(%s, %s)", (MIGRATION_LOCK, MIGRATION_LOCK_TIMEOUT))
+        (locked,) = cursor.fetchone()
+        if locked != 1:
+            raise RuntimeError(f"Could not acquire the migration lock within {MIGRATION_LOCK_TIMEOUT}s")
+        try:
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INT NOT NULL PRIMARY KEY,
+                    name VARCHAR(255) NOT NULL,
+                    applied_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            cursor.execute("SELECT version FROM schema_migrations")
+            applied = {version for (version,) in cursor.fetchall()}
+
+            newly_applied = []
+            for version, name, migration in MIGRATIONS:
+                if version in applied:
+                    continue
+                logger.info(f"Applying migration {version}: {name}")
+                migration(cursor)
+                cursor.execute("INSERT INTO schema_migrations (version, name) VALUES (%s, %s)", (version, name))
+                connection.commit()
+                applied.add(version)
+                newly_applied.append(version)
+            return sorted(applied), newly_applied
+        finally:
+            cursor.execute("SELECT RELEASE_LOCK(%s)", (MIGRATION_LOCK,))
+            cursor.fetchone()
+    finally:
+        cursor.close()
+
+
+async def migrate(db):
+    """Bring the schema up to date and return the sorted list of applied versions."""
+    applied, newly_applied = await db.run(_migrate)
+    if newly_applied:
+        logger.info(f"Applied migrations {newly_applied}; schema is at version {applied[-1]}")
+    else:
+        logger.info(f"Schema is up to date at version {applied[-1]} (applied: {applied})")
+    return applied
@@ -0,0 +1,289 @@
+"""
+Embedded SQLite storage backend of the captcha bot.
+
+For single-node installs: the database is a local file in WAL mode (or
+':memory:'), so no statement pays a network round-trip. sqlite3 is blocking
+and its connections belong to one thread, so the connection lives on a
+single worker thread that runs every statement; SQLite serialises writers
+anyway. Timestamps are stored as Unix time in seconds.
+"""
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from metrics import DB_QUERY_SECONDS, statement_name
+from storage import SETTINGS_COLUMNS, DatabaseError, Storage
+
+logger = logging.getLogger(__name__)
+
+# Indexed by version - 1; append new versions, never edit applied ones
+SCHEMA = [
+    [
+        """
+        CREATE TABLE IF NOT EXISTS chat_settings (
+            chat_id INTEGER NOT NULL PRIMARY KEY,
+            timeout INTEGER NOT NULL DEFAULT 60,
+            attempt_limit INTEGER NOT NULL DEFAULT 3,
+            welcome_message TEXT NULL,
+            strict_mode INTEGER NOT NULL DEFAULT 0,
+            welcome_timeout INTEGER NOT NULL DEFAULT 10
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS captchas (
+            chat_id INTEGER NOT NULL PRIMARY KEY,
+            mode TEXT NOT NULL,
+            question TEXT NOT NULL,
+            answers TEXT NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS pending_captchas (
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            correct_answers TEXT NOT NULL,
+            captcha_message_id INTEGER NULL,
+            messages_to_delete TEXT NOT NULL,
+            question TEXT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            user_name TEXT NULL,
+            created_at REAL NOT NULL,
+            expires_at REAL NULL,
+            PRIMARY KEY (chat_id, user_id)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_pending_created_at ON pending_captchas (created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_pending_expires_at ON pending_captchas (expires_at)",
+        """
+        CREATE TABLE IF NOT EXISTS group_statistics (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            member_count INTEGER NOT NULL,
+            recorded_at REAL NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_statistics_chat_recorded ON group_statistics (chat_id, recorded_at)",
+    ],
+    [
+        """
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT NOT NULL PRIMARY KEY,
+            holder TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+        """,
+    ],
+]
+
+
+class SQLiteDatabase(Storage):
+    def __init__(self, path):
+        self.path = path
+        self._connection = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='sqlite')
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path)
+        connection.row_factory = sqlite3.Row
+        connection.execute("PRAGMA busy_timeout = 5000")
+        if self.path != ':memory:':
+            connection.execute("PRAGMA journal_mode = WAL")
+            # Durable at checkpoints only; a power loss can drop the last transactions, never corrupt the file
+            connection.execute("PRAGMA synchronous = NORMAL")
+        return connection
+
+    def _run(self, statements, fetch=None, dictionary=False):
+        """
+        Execute (query, params) pairs on the worker thread inside one transaction.
+        Returns the result of the last statement: a row, a list of rows or a rowcount.
+        """
+        try:
+            if self._connection is None:
+                self._connection = self._connect()
+            connection = self._connection
+            try:
+                cursor = None
+                for query, params in statements:
+                    with DB_QUERY_SECONDS.time(statement=statement_name(query)):
+                        if isinstance(params, list):
+                            cursor = connection.executemany(query, params)
+                        else:
+                            cursor = connection.execute(query, params)
+                if fetch == 'one':
+                    row = cursor.fetchone()
+                    result = None if row is None else dict(row) if dictionary else tuple(row)
+                elif fetch == 'all':
+                    result = [dict(row) if dictionary else tuple(row) for row in cursor.fetchall()]
+                else:
+                    result = cursor.rowcount
+                connection.commit()
+                return result
+            except BaseException:
+                connection.rollback()
+                raise
+        except sqlite3.Error as e:
+            raise DatabaseError(str(e)) from e
+
+    async def _submit(self, statements, fetch=None, dictionary=False):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, partial(self._run, statements, fetch, dictionary))
+
+    async def fetchone(self, query, params=(), dictionary=True):
+        return await self._submit([(query, params)], fetch='one', dictionary=dictionary)
+
+    async def fetchall(self, query, params=(), dictionary=True):
+        return await self._submit([(query, params)], fetch='all', dictionary=dictionary)
+
+    async def execute(self, query, params=()):
+        """Execute a write statement and commit it. A list of params runs executemany()."""
+        return await self._submit([(query, params)])
+
+    async def migrate(self):
+        (version,) = await self.fetchone("PRAGMA user_version", dictionary=False)
+        statements = [(statement, ()) for statements in SCHEMA[version:] for statement in statements]
+        if statements:
+            await self._submit(statements + [(f"PRAGMA user_version = {len(SCHEMA)}", ())])
+            logger.info(f"Applied SQLite schema versions {list(range(version + 1, len(SCHEMA) + 1))} to {self.path}")
+        else:
+            logger.info(f"SQLite schema of {self.path} is up to date at version {version}")
+        return list(range(1, len(SCHEMA) + 1))
+
+    async def ping(self):
+        await self.fetchone("SELECT 1", dictionary=False)
+
+    def stats(self):
+        return {'backend': 'sqlite', 'path': self.path}
+
+    def _close_connection(self):
+        if self._connection is not None:
+            self._connection.close()
+            self._connection = None
+
+    def close(self):
+        self._executor.submit(self._close_connection).result()
+        self._executor.shutdown(wait=True)
+
+    # Chat settings
+
+    async def get_chat_settings(self, chat_id):
+        return await self.fetchone("SELECT * FROM chat_settings WHERE chat_id = ?", (chat_id,))
+
+    async def set_chat_setting(self, chat_id, column, value):
+        if column not in SETTINGS_COLUMNS:
+            raise ValueError(f"Unknown chat setting: {column}")
+        await self.execute(
+            f"INSERT INTO chat_settings (chat_id, {column}) VALUES (?, ?) ON CONFLICT (chat_id) DO UPDATE SET {column} = excluded.{column}",
+            (chat_id, value)
+        )
+
+    async def get_chat_ids(self):
+        rows = await self.fetchall("SELECT chat_id FROM chat_settings", dictionary=False)
+        return [chat_id for (chat_id,) in rows]
+
+    # Captchas
+
+    async def get_captcha(self, chat_id):
+        return await self.fetchone("SELECT * FROM captchas WHERE chat_id = ?", (chat_id,))
+
+    async def set_captcha(self, chat_id, mode, question, answers):
+        await self.execute(
+            "INSERT INTO captchas (chat_id, mode, question, answers) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (chat_id) DO UPDATE SET mode = excluded.mode, question = excluded.question, answers = excluded.answers",
+            (chat_id, mode, question, answers)
+        )
+
+    # Pending captchas
+
+    async def get_pending_captcha(self, chat_id, user_id):
+        return await self.fetchone("SELECT * FROM pending_captchas WHERE chat_id = ? AND user_id = ?", (chat_id, user_id))
+
+    async def add_pending_captchas(self, captchas):
+        if not captchas:
+            return
+        now = time.time()
+        await self.execute(
+            "INSERT INTO pending_captchas (user_id, chat_id, correct_answers, captcha_message_id, messages_to_delete, question, "
+            "user_name, created_at, expires_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            # A member who rejoins while still pending gets a fresh captcha instead of failing the whole join
+            "ON CONFLICT (chat_id, user_id) DO UPDATE SET correct_answers = excluded.correct_answers, "
+            "captcha_message_id = excluded.captcha_message_id, messages_to_delete = excluded.messages_to_delete, "
+            "question = excluded.question, attempts = 0, user_name = excluded.user_name, "
+            "created_at = excluded.created_at, expires_at = excluded.expires_at",
+            [(user_id, chat_id, ','.join(correct_answers), captcha_message_id, json.dumps(messages_to_delete), question,
+              user_name, now, now + timeout)
+             for user_id, chat_id, correct_answers, captcha_message_id, messages_to_delete, question, user_name, timeout in captchas]
+        )
+
+    async def update_pending_captcha(self, chat_id, user_id, attempts, messages_to_delete=None):
+        if messages_to_delete is None:
+            await self.execute("UPDATE pending_captchas SET attempts = ? WHERE chat_id = ? AND user_id = ?",
+                               (attempts, chat_id, user_id))
+        else:
+            await self.execute("UPDATE pending_captchas SET attempts = ?, messages_to_delete = ? WHERE chat_id = ? AND user_id = ?",
+                               (attempts, json.dumps(messages_to_delete), chat_id, user_id))
+
+    async def delete_pending_captcha(self, chat_id, user_id):
+        await self.execute("DELETE FROM pending_captchas WHERE chat_id = ? AND user_id = ?", (chat_id, user_id))
+
+    async def get_stale_pending_captchas(self, created_before, limit, after=None):
+        if after is None:
+            return await self.fetchall(
+                "SELECT chat_id, user_id FROM pending_captchas WHERE created_at < ? ORDER BY chat_id, user_id LIMIT ?",
+                (created_before.timestamp(), limit), dictionary=False
+            )
+        return await self.fetchall(
+            "SELECT chat_id, user_id FROM pending_captchas WHERE created_at < ? AND (chat_id, user_id) > (?, ?) "
+            "ORDER BY chat_id, user_id LIMIT ?",
+            (created_before.timestamp(), after[0], after[1], limit), dictionary=False
+        )
+
+    async def delete_pending_captchas(self, keys):
+        """Delete the pending captchas with the given (chat_id, user_id) keys in one transaction."""
+        if keys:
+            await self.execute("DELETE FROM pending_captchas WHERE chat_id = ? AND user_id = ?", [tuple(key) for key in keys])
+
+    async def get_pending_deadlines(self):
+        return await self.fetchall("""
+            SELECT p.chat_id, p.user_id, p.user_name, p.captcha_message_id,
+                   CAST(COALESCE(p.expires_at, p.created_at + COALESCE(s.timeout, 60)) - ? AS INTEGER) AS remaining
+            FROM pending_captchas p
+            LEFT JOIN chat_settings s ON s.chat_id = p.chat_id
+        """, (time.time(),))
+
+    async def get_expired_pending_captchas(self, min_age, max_age):
+        now = time.time()
+        return await self.fetchall(
+            "SELECT chat_id, user_id, user_name, captcha_message_id FROM pending_captchas WHERE expires_at > ? AND expires_at <= ?",
+            (now - max_age, now - min_age)
+        )
+
+    async def get_pending_captcha_keys(self):
+        return await self.fetchall("SELECT chat_id, user_id FROM pending_captchas", dictionary=False)
+
+    # Leases
+
+    async def acquire_lease(self, name, holder, ttl):
+        now = time.time()
+        row = await self._submit([
+            ("INSERT INTO leases (name, holder, expires_at) VALUES (?, ?, ?) "
+             "ON CONFLICT (name) DO UPDATE SET holder = excluded.holder, expires_at = excluded.expires_at "
+             "WHERE leases.holder = excluded.holder OR leases.expires_at <= ?",
+             (name, holder, now + ttl, now)),
+            ("SELECT holder FROM leases WHERE name = ?", (name,))
+        ], fetch='one')
+        return row is not None and row[0] == holder
+
+    async def release_lease(self, name, holder):
+        await self.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (name, holder))
+
+    # Group statistics
+
+    async def add_group_statistics(self, rows):
+        if rows:
+            now = time.time()
+            await self.execute("INSERT INTO group_statistics (chat_id, member_count, recorded_at) VALUES (?, ?, ?)",
+                               [(chat_id, member_count, now) for chat_id, member_count in rows])
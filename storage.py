@@ -0,0 +1,134 @@
+"""
+Storage interface of the captcha bot.
+
+The handlers only use the methods of Storage, so the backend is chosen by
+configuration (STORAGE_BACKEND): MySQL (database.Database) for shared and
+multi-node deployments, or an embedded SQLite file or in-memory database
+(sqlite_database.SQLiteDatabase) for single-node installs and local runs.
+Every method is a coroutine and raises DatabaseError when the backend fails.
+Storage is an abstract base class, so a backend that misses a method cannot
+be instantiated.
+"""
+from abc import ABC, abstractmethod
+
+
+class DatabaseError(Exception):
+    """Raised when a statement could not be executed against the database."""
+
+
+# Columns of chat_settings that can be changed with set_chat_setting()
+SETTINGS_COLUMNS = ('timeout', 'attempt_limit', 'welcome_message', 'strict_mode', 'welcome_timeout')
+
+
+class Storage(ABC):
+    # Lifecycle
+
+    @abstractmethod
+    async def migrate(self):
+        """Bring the schema up to date; returns the sorted list of applied versions."""
+
+    @abstractmethod
+    async def ping(self):
+        """Run a trivial query, raising DatabaseError when the backend is unavailable."""
+
+    @abstractmethod
+    def stats(self):
+        """Backend state for the health endpoint, e.g. connection pool usage."""
+
+    @abstractmethod
+    def close(self):
+        ...
+
+    # Chat settings
+
+    @abstractmethod
+    async def get_chat_settings(self, chat_id):
+        """Return the chat_settings row of a chat as a dict, or None."""
+
+    @abstractmethod
+    async def set_chat_setting(self, chat_id, column, value):
+        """Set one column of SETTINGS_COLUMNS, creating the row with defaults if needed."""
+
+    @abstractmethod
+    async def get_chat_ids(self):
+        ...
+
+    # Captchas
+
+    @abstractmethod
+    async def get_captcha(self, chat_id):
+        """Return the custom captcha of a chat as a dict with mode, question and answers, or None."""
+
+    @abstractmethod
+    async def set_captcha(self, chat_id, mode, question, answers):
+        ...
+
+    # Pending captchas
+
+    @abstractmethod
+    async def get_pending_captcha(self, chat_id, user_id):
+        ...
+
+    @abstractmethod
+    async def add_pending_captchas(self, captchas):
+        """
+        Insert pending captchas, each given as
+        (user_id, chat_id, correct_answers, captcha_message_id, messages_to_delete, question, user_name, timeout).
+        A captcha that is already pending for the same chat and user is replaced, with its attempts reset.
+        """
+
+    @abstractmethod
+    async def update_pending_captcha(self, chat_id, user_id, attempts, messages_to_delete=None):
+        ...
+
+    @abstractmethod
+    async def delete_pending_captcha(self, chat_id, user_id):
+        ...
+
+    @abstractmethod
+    async def get_stale_pending_captchas(self, created_before, limit, after=None):
+        """
+        Return up to `limit` (chat_id, user_id) of pending captchas created before
+        `created_before`, in key order and after the key `after` when given.
+        """
+
+    @abstractmethod
+    async def delete_pending_captchas(self, keys):
+        """Delete the pending captchas with the given (chat_id, user_id) keys."""
+
+    @abstractmethod
+    async def get_pending_deadlines(self):
+        """
+        Return every pending captcha as a dict with chat_id, user_id, user_name,
+        captcha_message_id and the seconds `remaining` until its deadline (negative when overdue).
+        """
+
+    @abstractmethod
+    async def get_expired_pending_captchas(self, min_age, max_age):
+        """
+        Return the pending captchas whose deadline passed between `max_age` and
+        `min_age` seconds ago, as dicts with chat_id, user_id, user_name and captcha_message_id.
+        """
+
+    @abstractmethod
+    async def get_pending_captcha_keys(self):
+        """Return (chat_id, user_id) of every pending captcha."""
+
+    # Leases
+
+    @abstractmethod
+    async def acquire_lease(self, name, holder, ttl):
+        """
+        Take or renew the lease `name` for `ttl` seconds if it is free, expired or
+        already held by `holder`. Returns whether `holder` holds it afterwards.
+        """
+
+    @abstractmethod
+    async def release_lease(self, name, holder):
+        """Give up the lease `name` if `holder` holds it."""
+
+    # Statistics
+
+    @abstractmethod
+    async def add_group_statistics(self, rows):
+        """Insert (chat_id, member_count) rows."""
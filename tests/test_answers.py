@@ -0,0 +1,38 @@
+from answers import compile_answers, normalize
+
+
+def test_normalize_folds_case_punctuation_and_whitespace():
+    assert normalize("  The Eiffel-Tower! ") == "the eiffel tower"
+    assert normalize("Straße") == "strasse"
+
+
+def test_normalize_turns_number_words_and_digits_into_numbers():
+    assert normalize("Four") == "4"
+    assert normalize("٤") == "4"
+    assert normalize("０４") == "4"
+    assert normalize("twenty-four") == "24"
+    assert normalize("one hundred and five") == "105"
+    assert normalize("one two") == "1 2"
+    assert normalize("forty two apples") == "42 apples"
+    assert normalize("rock and roll") == "rock and roll"
+
+
+def test_normalize_keeps_digits_int_does_not_accept():
+    assert normalize("፩") == "፩"
+    assert normalize("-፩") == "፩"
+
+
+def test_compile_answers_matches_normalized_replies():
+    matcher = compile_answers("4,four")
+    assert matcher.matches("FOUR!")
+    assert matcher.matches(" 4 ")
+    assert not matcher.matches("5")
+    assert not matcher.matches("፩")
+    assert compile_answers("4,four") is matcher
+
+
+def test_compile_answers_tolerates_typos_in_words_only():
+    assert compile_answers("paris", 1).matches("pariss")
+    assert not compile_answers("paris", 1).matches("london")
+    assert not compile_answers("4", 1).matches("5")
+    assert not compile_answers("paris").matches("pariss")
@@ -0,0 +1,38 @@
+import time
+
+from callback_tokens import PREFIX, CallbackSigner
+
+
+def test_sign_and_verify_round_trip():
+    signer = CallbackSigner(b'secret')
+    expires_at = int(time.time()) + 60
+    data = signer.sign(-1001234567890123, 9999999999, 3, expires_at, True)
+
+    assert data.startswith(PREFIX)
+    assert len(data.encode()) <= 64
+    token = signer.verify(data)
+    assert (token.chat_id, token.user_id, token.option, token.expires_at, token.correct) == \
+        (-1001234567890123, 9999999999, 3, expires_at, True)
+    assert signer.verify(signer.sign(-100, 1, 0, expires_at, False)).correct is False
+
+
+def test_token_does_not_reveal_correctness():
+    signer = CallbackSigner(b'secret')
+    expires_at = time.time() + 60
+    right, wrong = signer.sign(-100, 1, 0, expires_at, True), signer.sign(-100, 1, 0, expires_at, False)
+    # Same payload, only the MAC differs
+    assert right[:-14] == wrong[:-14]
+
+
+def test_verify_rejects_tampered_foreign_and_expired_tokens():
+    signer = CallbackSigner(b'secret')
+    data = signer.sign(-100, 1, 2, time.time() + 60, False)
+    tampered = data[:5] + ('A' if data[5] != 'A' else 'B') + data[6:]
+
+    assert signer.verify(tampered) is None
+    assert CallbackSigner(b'other').verify(data) is None
+    assert signer.verify(signer.sign(-100, 1, 2, time.time() - 1, True)) is None
+    assert signer.verify(data, now=time.time() + 120) is None
+    assert signer.verify("captcha:1:4") is None
+    assert signer.verify(PREFIX + "!!!") is None
+    assert signer.verify(data[:-4]) is None
@@ -0,0 +1,69 @@
+import asyncio
+import time
+
+from deadlines import DeadlineScheduler
+
+
+def test_pop_expired_returns_due_deadlines_once():
+    deadlines = DeadlineScheduler(tick=1.0)
+    deadlines.schedule(-100, 1, 5, {'user_name': "A"})
+    deadlines.schedule(-100, 2, 60, {'user_name': "B"})
+    now = time.monotonic()
+
+    assert deadlines.pop_expired(now) == []
+    assert deadlines.pop_expired(now + 7) == [(-100, 1, {'user_name': "A"})]
+    assert deadlines.pop_expired(now + 7) == []
+    assert not deadlines.contains(-100, 1)
+    assert deadlines.contains(-100, 2)
+    assert len(deadlines) == 1
+
+
+def test_schedule_replaces_and_cancel_removes():
+    deadlines = DeadlineScheduler(tick=1.0)
+    deadlines.schedule(-100, 1, 60, {'n': 1})
+    deadlines.schedule(-100, 1, 5, {'n': 2})
+    deadlines.schedule(-100, 2, 5, {'n': 3})
+    assert deadlines.cancel(-100, 2)
+    assert not deadlines.cancel(-100, 2)
+
+    assert deadlines.pop_expired(time.monotonic() + 7) == [(-100, 1, {'n': 2})]
+    assert len(deadlines) == 0
+
+
+def test_restore_spreads_overdue_deadlines_into_batches():
+    deadlines = DeadlineScheduler(tick=1.0, overdue_batch_size=2, overdue_batch_interval=10)
+    deadlines.restore([(-100, user_id, -30, {}) for user_id in range(5)] + [(-100, 99, 100, {})])
+    now = time.monotonic()
+
+    assert len(deadlines.pop_expired(now + 2)) == 2
+    assert len(deadlines.pop_expired(now + 12)) == 2
+    assert len(deadlines.pop_expired(now + 22)) == 1
+    assert deadlines.pop_expired(now + 50) == []
+    assert deadlines.pop_expired(now + 102) == [(-100, 99, {})]
+
+
+def test_advance_fires_in_bounded_tasks_and_returns_at_once():
+    deadlines = DeadlineScheduler(tick=1.0, batch_size=2)
+    release = asyncio.Event()
+    running = []
+
+    async def kick(context, chat_id, user_id, data):
+        running.append(user_id)
+        await release.wait()
+        running.remove(user_id)
+
+    async def run():
+        deadlines.bind(None, kick)
+        for user_id in range(5):
+            deadlines.schedule(-100, user_id, 0, {})
+        due = deadlines.pop_expired(time.monotonic() + 1)
+        deadlines.pop_expired = lambda now=None: due
+        await deadlines._advance(None)
+        await asyncio.sleep(0)
+        assert len(running) == 2
+        assert deadlines.contains(-100, 4) and deadlines.recently_fired(-100, 4)
+        release.set()
+        await deadlines.stop()
+        assert running == [] and not deadlines.contains(-100, 4)
+
+    asyncio.run(run())
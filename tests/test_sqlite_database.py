@@ -0,0 +1,36 @@
+import asyncio
+
+from sqlite_database import SQLiteDatabase
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+def memory_database():
+    db = SQLiteDatabase(':memory:')
+    run(db.migrate())
+    return db
+
+
+def test_add_pending_captchas_replaces_a_member_who_is_still_pending():
+    db = memory_database()
+    try:
+        run(db.add_pending_captchas([(1, -100, ['4'], 10, [10], "What is 2+2?", "Old", 60)]))
+        run(db.update_pending_captcha(-100, 1, 2))
+
+        # Member 1 rejoins together with member 2 before the first deadline
+        run(db.add_pending_captchas([
+            (1, -100, ['5'], 20, [20], "What is 2+3?", "Rejoined", 120),
+            (2, -100, ['5'], 21, [21], "What is 2+3?", "New", 120),
+        ]))
+
+        rejoined = run(db.get_pending_captcha(-100, 1))
+        assert rejoined['captcha_message_id'] == 20
+        assert rejoined['correct_answers'] == '5'
+        assert rejoined['attempts'] == 0
+        assert rejoined['expires_at'] - rejoined['created_at'] == 120
+        assert run(db.get_pending_captcha(-100, 2))['captcha_message_id'] == 21
+        assert sorted(run(db.get_pending_captcha_keys())) == [(-100, 1), (-100, 2)]
+    finally:
+        db.close()
@@ -0,0 +1,44 @@
+"""
+Narrowing of the updates the bot subscribes to and dispatches.
+"""
+from telegram import Update
+from telegram.ext import CallbackQueryHandler, ChatMemberHandler, CommandHandler, MessageHandler, filters
+
+
+class PendingChallengeFilter(filters.MessageFilter):
+    """
+    Passes messages whose sender has a pending captcha in the message's chat.
+
+    Filters run while the dispatcher looks for a matching handler, so ordinary
+    chatter is dropped before a handler coroutine is created.
+    """
+
+    def __init__(self, pending_index):
+        super().__init__(name='PendingChallengeFilter')
+        self._pending_index = pending_index
+
+    def filter(self, message):
+        return message.from_user is not None and self._pending_index.contains(message.chat.id, message.from_user.id)
+
+
+def allowed_update_types(application):
+    """
+    Return the update types the registered handlers can handle, to be passed as
+    allowed_updates. Handlers of unknown types subscribe to everything.
+    """
+    types = set()
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            if isinstance(handler, (CommandHandler, MessageHandler)):
+                # Both match edited messages unless their filters exclude them
+                types.update((Update.MESSAGE, Update.EDITED_MESSAGE))
+            elif isinstance(handler, CallbackQueryHandler):
+                types.add(Update.CALLBACK_QUERY)
+            elif isinstance(handler, ChatMemberHandler):
+                if handler.chat_member_types in (ChatMemberHandler.MY_CHAT_MEMBER, ChatMemberHandler.ANY_CHAT_MEMBER):
+                    types.add(Update.MY_CHAT_MEMBER)
+                if handler.chat_member_types in (ChatMemberHandler.CHAT_MEMBER, ChatMemberHandler.ANY_CHAT_MEMBER):
+                    types.add(Update.CHAT_MEMBER)
+            else:
+                return Update.ALL_TYPES
+    return sorted(types)
@@ -0,0 +1,177 @@
+"""
+Multi-process mode of the bot.
+
+One ingress process receives the updates (by long polling or webhook) and
+routes each of them to one of N worker processes by its chat. Every worker
+runs a complete Application without an updater and handles its updates in
+the order they were received, so updates of one chat stay ordered while the
+total throughput grows with the number of cores. Each worker owns the chats
+of its shard: it only keeps their pending captchas and deadlines in memory
+and only runs the periodic jobs for them. With several replicas, only the
+ingress holding the leader lease receives updates and runs workers.
+"""
+import asyncio
+import logging
+import queue
+import time
+
+from telegram import Update
+from telegram.ext import Updater
+
+logger = logging.getLogger(__name__)
+
+
+def shard_of(chat_id, count):
+    """Index of the worker that owns a chat; updates without a chat go to worker 0."""
+    return chat_id % count if chat_id is not None else 0
+
+
+def routing_key(update):
+    """The chat an update belongs to, or its sender for updates outside of a chat."""
+    if update.effective_chat is not None:
+        return update.effective_chat.id
+    if update.effective_user is not None:
+        return update.effective_user.id
+    return None
+
+
+async def serve_updates(application, updates):
+    """
+    Run `application` on the updates put on the multiprocessing queue `updates`
+    (as dicts) until None is received. post_init and post_shutdown are called
+    like run_polling() would.
+    """
+    loop = asyncio.get_running_loop()
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        await application.start()
+        while True:
+            data = await loop.run_in_executor(None, updates.get)
+            if data is None:
+                break
+            await application.update_queue.put(Update.de_json(data, application.bot))
+    finally:
+        if application.running:
+            await application.stop()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+        await application.shutdown()
+
+
+class WorkerPool:
+    """
+    Worker processes, each fed by its own bounded queue. `target(index, count, queue)`
+    runs in every process; a worker that dies is restarted on the same queue.
+    """
+
+    def __init__(self, context, target, count, queue_size=1000):
+        self._context = context
+        self._target = target
+        self.count = count
+        self.queues = [context.Queue(maxsize=queue_size) for _ in range(count)]
+        self._processes = [None] * count
+
+    def _start(self, index):
+        process = self._context.Process(target=self._target, args=(index, self.count, self.queues[index]), name=f'worker-{index}')
+        process.start()
+        self._processes[index] = process
+        logger.info(f"Started worker {index} (pid {process.pid})")
+
+    def start(self):
+        for index in range(self.count):
+            self._start(index)
+
+    def check(self):
+        for index, process in enumerate(self._processes):
+            if process is not None and not process.is_alive():
+                logger.error(f"Worker {index} exited with code {process.exitcode}, restarting it")
+                self._start(index)
+
+    def put(self, index, data, timeout=1):
+        """Queue `data` for a worker; raises queue.Full when it stays full for `timeout` seconds."""
+        self.queues[index].put(data, timeout=timeout)
+
+    def stop(self, timeout=30):
+        for index, process in enumerate(self._processes):
+            if process is not None and process.is_alive():
+                try:
+                    self.queues[index].put(None, timeout=timeout)
+                except queue.Full:
+                    pass
+        deadline = time.monotonic() + timeout
+        for index, process in enumerate(self._processes):
+            if process is None:
+                continue
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                logger.warning(f"Worker {index} did not stop within {timeout}s, terminating it")
+                process.terminate()
+                process.join()
+            self._processes[index] = None
+
+
+async def route_updates(bot, pool, allowed_updates, election, webhook=None, check_interval=5):
+    """
+    While `election` holds the lease, run the worker pool and receive updates
+    with an Updater, handing each to the worker that owns its chat.
+    `webhook` holds the start_webhook() arguments; without it updates are polled.
+    """
+    loop = asyncio.get_running_loop()
+    update_queue = asyncio.Queue()
+    updater = Updater(bot=bot, update_queue=update_queue)
+    running = False
+
+    async def start():
+        nonlocal running
+        await loop.run_in_executor(None, pool.start)
+        running = True
+        if webhook:
+            await updater.start_webhook(allowed_updates=allowed_updates, **webhook)
+        else:
+            # Bounded, so a takeover that cannot reach Telegram fails and steps down instead of retrying forever
+            await updater.start_polling(allowed_updates=allowed_updates, bootstrap_retries=3)
+
+    async def stop():
+        nonlocal running
+        if updater.running:
+            await updater.stop()
+        # Updates already received are still handed over; the workers finish them before they exit
+        while not update_queue.empty():
+            await hand_over(update_queue.get_nowait())
+        running = False
+        await loop.run_in_executor(None, pool.stop)
+
+    async def hand_over(update):
+        index = shard_of(routing_key(update), pool.count)
+        data = update.to_dict()
+        while True:
+            try:
+                await loop.run_in_executor(None, pool.put, index, data)
+                return
+            except queue.Full:
+                # The worker is behind (or dead); wait for it rather than reorder or drop the chat's updates
+                logger.warning(f"Queue of worker {index} is full")
+                pool.check()
+
+    election.on_elected(start)
+    election.on_deposed(stop)
+    async with updater:
+        await election.start()
+        last_check = time.monotonic()
+        try:
+            while True:
+                try:
+                    update = await asyncio.wait_for(update_queue.get(), timeout=check_interval)
+                except asyncio.TimeoutError:
+                    update = None
+                if running and time.monotonic() - last_check >= check_interval:
+                    pool.check()
+                    last_check = time.monotonic()
+                if update is not None and running:
+                    await hand_over(update)
+        finally:
+            if running:
+                await stop()
+            await election.stop()